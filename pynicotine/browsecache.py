@@ -0,0 +1,137 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module stores the compressed SharedFileList message of a share on
+disk, so that browse requests can be answered right after startup without
+compressing the whole share again.
+
+Every change to the folder streams of a share bumps its generation number,
+which is stored in a small file next to the streams database. The stored
+message is tagged with the generation it was built from, and only used if
+that is still the current generation.
+"""
+
+import mmap
+import os
+import struct
+
+from pynicotine.logfacility import log
+
+MAGIC = b"NSBL"
+
+# magic, generation of the share
+HEADER = struct.Struct("<4sQ")
+
+
+class BrowseCache:
+
+    def __init__(self, directory, name):
+
+        self.generationfile = os.path.join(directory, name + ".gen")
+        self.filename = os.path.join(directory, name + ".browse")
+        self.generation = self._read_generation()
+
+    def _read_generation(self):
+
+        try:
+            with open(self.generationfile, "r") as handle:
+                return int(handle.read())
+
+        except (OSError, ValueError):
+            return 0
+
+    def bump(self):
+        """ Called once changed streams are in place, makes the stored message stale """
+
+        self.generation += 1
+        tmpfile = self.generationfile + ".tmp"
+
+        try:
+            with open(tmpfile, "w") as handle:
+                handle.write(str(self.generation))
+
+            os.replace(tmpfile, self.generationfile)
+
+        except OSError as error:
+            log.addwarning("Failed to save share generation %s: %s" % (self.generationfile, error))
+
+            # Don't leave a message behind that looks current on the next start
+            self.remove()
+
+    def load(self):
+        """ Returns a view of the stored message, or None if there's no message
+        for the current generation """
+
+        try:
+            with open(self.filename, "rb") as handle:
+                data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        except (OSError, ValueError):
+            # ValueError is raised for empty files
+            return None
+
+        try:
+            magic, generation = HEADER.unpack_from(data)
+        except struct.error:
+            magic = generation = None
+
+        if magic != MAGIC or generation != self.generation:
+            data.close()
+            return None
+
+        # The mapping is released once the last message using it is gone
+        return memoryview(data)[HEADER.size:]
+
+    def store(self, chunks, generation):
+        """ Store a message built from the share at generation, from an iterable
+        of chunks. Returns True if the message was stored. """
+
+        if generation != self.generation:
+            # The share changed before the message was built
+            return False
+
+        tmpfile = self.filename + ".tmp"
+
+        try:
+            with open(tmpfile, "wb") as handle:
+                handle.write(HEADER.pack(MAGIC, generation))
+
+                for chunk in chunks:
+                    handle.write(chunk)
+
+            if generation != self.generation:
+                # The share changed while the message was built
+                os.unlink(tmpfile)
+                return False
+
+            os.replace(tmpfile, self.filename)
+
+        except OSError as error:
+            log.adddebug("Failed to save shared file list %s: %s" % (self.filename, error))
+            return False
+
+        return True
+
+    def remove(self):
+
+        for path in (self.filename, self.filename + ".tmp"):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
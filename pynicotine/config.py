@@ -32,6 +32,7 @@ import configparser
 import os
 import pickle
 import shelve
+import shutil
 import sys
 import time
 
@@ -39,7 +40,19 @@ from ast import literal_eval
 from gettext import gettext as _
 from os.path import exists
 
+from pynicotine.browsecache import BrowseCache
 from pynicotine.logfacility import log
+from pynicotine.searchindex import SearchIndex
+from pynicotine.searchindex import SearchIndexError
+from pynicotine.searchindex import build_index
+from pynicotine.searchindex import remove_search_index
+from pynicotine.searchindex import write_search_index
+from pynicotine.sharedb import ShareDatabase
+
+# Share databases, in the order they are opened in
+SHARE_DATABASES = (
+    "sharedfiles", "bsharedfiles", "sharedfilesstreams", "bsharedfilesstreams", "sharedmtimes", "bsharedmtimes"
+)
 
 if sys.platform == "win32":
     # Use semidbm for faster shelves on Windows
@@ -82,6 +95,10 @@ class Config:
         self.frame = None
         self.filename = filename
         self.data_dir = data_dir
+        self.sharedb = None
+
+        # Time it took to store the normal and buddy shares last
+        self.sharewritetimes = {}
         self.parser = configparser.RawConfigParser()
 
         try:
@@ -130,6 +147,9 @@ class Config:
                 "afterfinish": "",
                 "afterfolder": "",
                 "lock": True,
+                "downloadbuffer": 1024,
+                "downloadflushinterval": 1,
+                "preallocate": True,
                 "reverseorder": False,
                 "prioritize": False,
                 "fifoqueue": False,
@@ -155,15 +175,22 @@ class Config:
                 "sharedfiles": {},
                 "sharedfilesstreams": {},
                 "uploadsinsubdirs": True,
-                "wordindex": {},
-                "fileindex": {},
+                "searchindex": None,
                 "sharedmtimes": {},
                 "bsharedfiles": {},
                 "bsharedfilesstreams": {},
-                "bwordindex": {},
-                "bfileindex": {},
+                "bsearchindex": None,
                 "bsharedmtimes": {},
                 "rescanonstartup": 0,
+                "rescanthreads": 1,
+                "sharewatcher": False,
+                "lazymetadata": False,
+                "rescanfilesrate": 0,
+                "rescanmbrate": 0,
+                "rescanidleonly": False,
+                "rescanlowpriority": False,
+                "shareexclusions": [],
+                "sharesbackend": "shelve",
                 "enablefilters": True,
                 "downloadregexp": "",
                 "downloadfilters": [
@@ -271,6 +298,7 @@ class Config:
                 "max_displayed_results": 1000,
                 "max_stored_results": 1500,
                 "min_search_chars": 3,
+                "wildcard_search": True,
                 "remove_special_chars": True
             },
 
@@ -649,10 +677,6 @@ class Config:
         bsharedfiles = None
         sharedfilesstreams = None
         bsharedfilesstreams = None
-        wordindex = None
-        bwordindex = None
-        fileindex = None
-        bfileindex = None
         sharedmtimes = None
         bsharedmtimes = None
 
@@ -661,61 +685,66 @@ class Config:
             os.path.join(self.data_dir, "buddyfiles.db"),
             os.path.join(self.data_dir, "streams.db"),
             os.path.join(self.data_dir, "buddystreams.db"),
-            os.path.join(self.data_dir, "wordindex.db"),
-            os.path.join(self.data_dir, "buddywordindex.db"),
-            os.path.join(self.data_dir, "fileindex.db"),
-            os.path.join(self.data_dir, "buddyfileindex.db"),
             os.path.join(self.data_dir, "mtimes.db"),
             os.path.join(self.data_dir, "buddymtimes.db")
         ]
 
         _opened_shelves = []
         _errors = []
-        for shelvefile in shelves:
-            try:
-                _opened_shelves.append(shelve.open(shelvefile, protocol=pickle.HIGHEST_PROTOCOL))
-            except Exception:
-                _errors.append(shelvefile)
+
+        if self.sections["transfers"]["sharesbackend"] == "sqlite":
+            _opened_shelves = self.openShareDatabase(_errors)
+        else:
+            for shelvefile in shelves:
                 try:
-                    os.unlink(shelvefile)
-                    _opened_shelves.append(shelve.open(shelvefile, flag='n', protocol=pickle.HIGHEST_PROTOCOL))
-                except Exception as ex:
-                    print(("Failed to unlink %s: %s" % (shelvefile, ex)))
+                    _opened_shelves.append(shelve.open(shelvefile, protocol=pickle.HIGHEST_PROTOCOL))
+                except Exception:
+                    _errors.append(shelvefile)
+                    try:
+                        os.unlink(shelvefile)
+                        _opened_shelves.append(shelve.open(shelvefile, flag='n', protocol=pickle.HIGHEST_PROTOCOL))
+                    except Exception as ex:
+                        print(("Failed to unlink %s: %s" % (shelvefile, ex)))
 
         sharedfiles = _opened_shelves.pop(0)
         bsharedfiles = _opened_shelves.pop(0)
         sharedfilesstreams = _opened_shelves.pop(0)
         bsharedfilesstreams = _opened_shelves.pop(0)
-        wordindex = _opened_shelves.pop(0)
-        bwordindex = _opened_shelves.pop(0)
-        fileindex = _opened_shelves.pop(0)
-        bfileindex = _opened_shelves.pop(0)
         sharedmtimes = _opened_shelves.pop(0)
         bsharedmtimes = _opened_shelves.pop(0)
 
+        searchindex = self.openSearchIndex("searchindex.idx", sharedfiles, _errors)
+        bsearchindex = self.openSearchIndex("buddysearchindex.idx", bsharedfiles, _errors)
+
+        # Word and file indexes were stored in shelves before 2.1.0
+        for shelvefile in ("wordindex.db", "buddywordindex.db", "fileindex.db", "buddyfileindex.db"):
+            for suffix in ("", ".db", ".dat", ".dir", ".bak"):
+                try:
+                    os.unlink(os.path.join(self.data_dir, shelvefile + suffix))
+                except OSError:
+                    pass
+
         if _errors:
             log.addwarning(_("Failed to process the following databases: %(names)s") % {'names': '\n'.join(_errors)})
 
             files = self.clearShares(
                 sharedfiles, bsharedfiles, sharedfilesstreams, bsharedfilesstreams,
-                wordindex, bwordindex, fileindex, bfileindex, sharedmtimes, bsharedmtimes
+                searchindex, bsearchindex, sharedmtimes, bsharedmtimes
             )
 
             if files is not None:
-                sharedfiles, bsharedfiles, sharedfilesstreams, bsharedfilesstreams, wordindex, bwordindex, fileindex, bfileindex, sharedmtimes, bsharedmtimes = files
+                sharedfiles, bsharedfiles, sharedfilesstreams, bsharedfilesstreams, searchindex, bsearchindex, sharedmtimes, bsharedmtimes = files
 
             log.addwarning(_("Shared files database seems to be corrupted, rescan your shares"))
 
         self.sections["transfers"]["sharedfiles"] = sharedfiles
         self.sections["transfers"]["sharedfilesstreams"] = sharedfilesstreams
-        self.sections["transfers"]["wordindex"] = wordindex
-        self.sections["transfers"]["fileindex"] = fileindex
+        self.sections["transfers"]["searchindex"] = searchindex
         self.sections["transfers"]["sharedmtimes"] = sharedmtimes
 
         self.sections["transfers"]["bsharedfiles"] = bsharedfiles
         self.sections["transfers"]["bsharedfilesstreams"] = bsharedfilesstreams
-        self.sections["transfers"]["bwordindex"] = bwordindex
-        self.sections["transfers"]["bfileindex"] = bfileindex
+        self.sections["transfers"]["bsearchindex"] = bsearchindex
         self.sections["transfers"]["bsharedmtimes"] = bsharedmtimes
 
         # Setting the port range in numerical order
@@ -730,11 +759,79 @@ class Config:
         if section in self.parser.sections():
             self.parser.remove_section(section)
 
+    def openShareDatabase(self, errors):
+        """ Open the share databases stored in SQLite, in the same order as the shelves """
+
+        path = os.path.join(self.data_dir, "shares.sqlite")
+
+        try:
+            self.sharedb = ShareDatabase(path)
+        except Exception:
+            errors.append(path)
+
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.unlink(path + suffix)
+                except OSError:
+                    pass
+
+            self.sharedb = ShareDatabase(path)
+
+        return [self.sharedb.open_store(name) for name in SHARE_DATABASES]
+
+    def openSearchIndex(self, filename, sharedfiles, errors):
+        """ Open the search index of a share. Indexes from before 2.1.0 were
+        stored in the wordindex and fileindex shelves, in that case the index
+        is regenerated from the shared files database. """
+
+        path = os.path.join(self.data_dir, filename)
+
+        try:
+            try:
+                if os.path.exists(path) or not len(sharedfiles):
+                    return SearchIndex(path)
+
+            except SearchIndexError:
+                # Written by another version, or damaged
+                pass
+
+            write_search_index(path, *build_index(sharedfiles), trigrams=self.sections["searches"]["wildcard_search"])
+            return SearchIndex(path)
+
+        except Exception:
+            errors.append(path)
+            remove_search_index(path)
+            return SearchIndex()
+
     def clearShares(
         self, sharedfiles, bsharedfiles, sharedfilesstreams, bsharedfilesstreams,
-        wordindex, bwordindex, fileindex, bfileindex, sharedmtimes, bsharedmtimes
+        searchindex, bsearchindex, sharedmtimes, bsharedmtimes
     ):
 
+        # Stored shared file lists are stale now
+        for name in ("streams", "buddystreams"):
+            BrowseCache(self.data_dir, name).remove()
+
+        if self.sharedb is not None:
+            try:
+                self.sharedb.replace({name: {} for name in SHARE_DATABASES})
+
+                for index in (searchindex, bsearchindex):
+                    if index is not None:
+                        index.close()
+
+                remove_search_index(os.path.join(self.data_dir, "searchindex.idx"))
+                remove_search_index(os.path.join(self.data_dir, "buddysearchindex.idx"))
+
+            except Exception as error:
+                log.addwarning(_("Error while writing database files: %s") % error)
+                return None
+
+            return (
+                sharedfiles, bsharedfiles, sharedfilesstreams, bsharedfilesstreams,
+                SearchIndex(), SearchIndex(), sharedmtimes, bsharedmtimes
+            )
+
         try:
             if sharedfiles:
                 sharedfiles.close()
@@ -768,37 +865,15 @@ class Config:
                 pass
             bsharedfilesstreams = shelve.open(os.path.join(self.data_dir, "buddystreams.db"), flag='n', protocol=pickle.HIGHEST_PROTOCOL)
 
-            if wordindex:
-                wordindex.close()
-            try:
-                os.unlink(os.path.join(self.data_dir, 'wordindex.db'))
-            except Exception:
-                pass
-            wordindex = shelve.open(os.path.join(self.data_dir, "wordindex.db"), flag='n', protocol=pickle.HIGHEST_PROTOCOL)
-
-            if bwordindex:
-                bwordindex.close()
-            try:
-                os.unlink(os.path.join(self.data_dir, 'buddywordindex.db'))
-            except Exception:
-                pass
-            bwordindex = shelve.open(os.path.join(self.data_dir, "buddywordindex.db"), flag='n', protocol=pickle.HIGHEST_PROTOCOL)
+            for index in (searchindex, bsearchindex):
+                if index is not None:
+                    index.close()
 
-            if fileindex:
-                fileindex.close()
-            try:
-                os.unlink(os.path.join(self.data_dir, 'fileindex.db'))
-            except Exception:
-                pass
-            fileindex = shelve.open(os.path.join(self.data_dir, "fileindex.db"), flag='n', protocol=pickle.HIGHEST_PROTOCOL)
+            remove_search_index(os.path.join(self.data_dir, "searchindex.idx"))
+            remove_search_index(os.path.join(self.data_dir, "buddysearchindex.idx"))
 
-            if bfileindex:
-                bfileindex.close()
-            try:
-                os.unlink(os.path.join(self.data_dir, 'buddyfileindex.db'))
-            except Exception:
-                pass
-            bfileindex = shelve.open(os.path.join(self.data_dir, "buddyfileindex.db"), flag='n', protocol=pickle.HIGHEST_PROTOCOL)
+            searchindex = SearchIndex()
+            bsearchindex = SearchIndex()
 
             if sharedmtimes:
                 sharedmtimes.close()
@@ -818,7 +893,7 @@ class Config:
         except Exception as error:
             log.addwarning(_("Error while writing database files: %s") % error)
             return None
-        return sharedfiles, bsharedfiles, sharedfilesstreams, bsharedfilesstreams, wordindex, bwordindex, fileindex, bfileindex, sharedmtimes, bsharedmtimes
+        return sharedfiles, bsharedfiles, sharedfilesstreams, bsharedfilesstreams, searchindex, bsearchindex, sharedmtimes, bsharedmtimes
 
     def writeDownloadQueue(self):
 
@@ -855,9 +930,9 @@ class Config:
     def writeConfiguration(self):
 
         external_sections = [
-            "sharedfiles", "sharedfilesstreams", "wordindex", "fileindex",
+            "sharedfiles", "sharedfilesstreams", "searchindex",
             "sharedmtimes", "bsharedfiles", "bsharedfilesstreams",
-            "bwordindex", "bfileindex", "bsharedmtimes", "downloads"
+            "bsearchindex", "bsharedmtimes", "downloads"
         ]
 
         for i in self.sections:
@@ -946,49 +1021,124 @@ class Config:
         return (0, filename)
 
     def setBuddyShares(self, files, streams, wordindex, fileindex, mtimes):
+        self.swapShares(self.writeShares("buddy", files, streams, wordindex, fileindex, mtimes))
 
-        storable_objects = [
-            (files, "bsharedfiles", "buddyfiles.db"),
-            (streams, "bsharedfilesstreams", "buddystreams.db"),
-            (mtimes, "bsharedmtimes", "buddymtimes.db"),
-            (wordindex, "bwordindex", "buddywordindex.db"),
-            (fileindex, "bfileindex", "buddyfileindex.db")
-        ]
+    def setShares(self, files, streams, wordindex, fileindex, mtimes):
+        self.swapShares(self.writeShares("normal", files, streams, wordindex, fileindex, mtimes))
+
+    def writeShares(self, sharestype, files, streams, wordindex, fileindex, mtimes, progress=None):
+        """ Write the databases of the normal or buddy shares next to the ones in use,
+        to be switched to with swapShares() in the main thread. This is slow for large
+        shares, and meant to run in a separate thread. progress is called with the
+        fraction of entries written so far. Returns None if writing failed. """
+
+        if sharestype == "buddy":
+            storable_objects = [
+                (files, "bsharedfiles", "buddyfiles.db"),
+                (streams, "bsharedfilesstreams", "buddystreams.db"),
+                (mtimes, "bsharedmtimes", "buddymtimes.db")
+            ]
+            searchindex = ("bsearchindex", "buddysearchindex.idx")
+        else:
+            storable_objects = [
+                (files, "sharedfiles", "files.db"),
+                (streams, "sharedfilesstreams", "streams.db"),
+                (mtimes, "sharedmtimes", "mtimes.db")
+            ]
+            searchindex = ("searchindex", "searchindex.idx")
 
-        self.storeObjects(storable_objects)
+        starttime = time.time()
+        total = max(len(files) + len(streams) + len(mtimes), 1)
+        written = 0
+        pending = []
 
-    def setShares(self, files, streams, wordindex, fileindex, mtimes):
+        try:
+            if self.sharedb is not None:
+                # All databases are switched to their new contents at once, readers
+                # see the old contents until then
+                self.sharedb.replace({destination: source for source, destination, filename in storable_objects})
+            else:
+                for source, destination, filename in storable_objects:
+                    path = os.path.join(self.data_dir, filename)
+                    newshelf = shelve.open(path + ".new", flag='n', protocol=pickle.HIGHEST_PROTOCOL)
 
-        storable_objects = [
-            (files, "sharedfiles", "files.db"),
-            (streams, "sharedfilesstreams", "streams.db"),
-            (mtimes, "sharedmtimes", "mtimes.db"),
-            (wordindex, "wordindex", "wordindex.db"),
-            (fileindex, "fileindex", "fileindex.db")
-        ]
+                    try:
+                        for key in source:
+                            newshelf[key] = source[key]
+                            written += 1
 
-        self.storeObjects(storable_objects)
+                            if progress is not None and written % 1000 == 0:
+                                progress(written / total)
+                    finally:
+                        newshelf.close()
 
-    def storeObjects(self, storable_objects):
+                    pending.append((destination, path + ".new", path))
+
+            destination, filename = searchindex
+            path = os.path.join(self.data_dir, filename)
+            write_search_index(path + ".new", wordindex, fileindex, self.sections["searches"]["wildcard_search"])
+            pending.append((destination, path + ".new", path))
+
+        except Exception as e:
+            log.addwarning(_("Can't save %s shares: %s") % (sharestype, e))
+            return None
+
+        if progress is not None:
+            progress(1.0)
+
+        self.sharewritetimes[sharestype] = time.time() - starttime
+        log.add(_("Stored %(type)s shares in %(seconds).1f seconds") % {
+            'type': sharestype,
+            'seconds': self.sharewritetimes[sharestype]
+        })
+
+        return pending
+
+    def swapShares(self, pending):
+        """ Switch to the databases written by writeShares(), which only takes a moment """
+
+        if pending is None:
+            return
+
+        transfers = self.sections["transfers"]
+
+        for destination, newpath, path in pending:
+            transfers[destination].close()
+
+            if destination.endswith("searchindex"):
+                try:
+                    os.replace(newpath, path)
+                    transfers[destination] = SearchIndex(path)
+                except Exception as e:
+                    log.addwarning(_("Can't save %s: %s") % (os.path.basename(path), e))
+                    transfers[destination] = SearchIndex()
+
+                continue
 
-        for (source, destination, filename) in storable_objects:
             try:
-                self.sections["transfers"][destination].close()
-                self.sections["transfers"][destination] = shelve.open(os.path.join(self.data_dir, filename), flag='n', protocol=pickle.HIGHEST_PROTOCOL)
+                self.replaceShelve(newpath, path)
+            except OSError as e:
+                log.addwarning(_("Can't save %s: %s") % (os.path.basename(path), e))
 
-                if "fileindex" in destination:
-                    index = 0
+            transfers[destination] = shelve.open(path, protocol=pickle.HIGHEST_PROTOCOL)
 
-                    for value in source:
-                        # The file index db is a list
-                        self.sections["transfers"][destination][str(index)] = value
-                        index += 1
-                else:
-                    for key in source:
-                        self.sections["transfers"][destination][key] = source[key]
-            except Exception as e:
-                log.addwarning(_("Can't save %s: %s") % (filename, e))
-                return
+    def replaceShelve(self, source, destination):
+        """ Rename a shelve, including every file the dbm backend created for it """
+
+        directory, sourcename = os.path.split(source)
+        destinationname = os.path.basename(destination)
+
+        for name in os.listdir(directory):
+            if not name.startswith(sourcename):
+                continue
+
+            target = os.path.join(directory, destinationname + name[len(sourcename):])
+
+            if os.path.isdir(target):
+                # semidbm stores shelves as folders
+                shutil.rmtree(target)
+
+            os.replace(os.path.join(directory, name), target)
 
     def writeAliases(self):
 
@@ -0,0 +1,122 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module buffers the data of a download before it's written to the
+incomplete file, so that it's written in a few large writes instead of
+one per received chunk, and reserves disk space for the rest of the file
+when the download starts.
+
+Incomplete files are opened in append mode, and their size is the offset
+a download resumes from. The data is always written in order, so a file
+only ever holds a complete prefix of the download, and the space reserved
+beyond its end doesn't change its size.
+"""
+
+import ctypes
+import ctypes.util
+import sys
+import time
+
+FALLOC_FL_KEEP_SIZE = 1
+
+
+def preallocate(file, size):
+    """ Reserve disk space for a file to grow to size bytes, without changing the size of
+    the file, so that the file isn't fragmented while it's written. Only supported on
+    Linux, on file systems that support fallocate(). Returns True on success. """
+
+    if not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return False
+
+    if hasattr(libc, "fallocate64"):
+        fallocate = libc.fallocate64
+
+    elif hasattr(libc, "fallocate") and ctypes.sizeof(ctypes.c_long) == 8:
+        # 64-bit C libraries without the 64-bit offset variant, such as musl
+        fallocate = libc.fallocate
+
+    else:
+        return False
+
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+    try:
+        offset = file.seek(0, 2)
+    except (OSError, ValueError):
+        return False
+
+    if size <= offset:
+        return False
+
+    return fallocate(file.fileno(), FALLOC_FL_KEEP_SIZE, offset, size - offset) == 0
+
+
+class DownloadSink:
+    """ Collects the data of a download, and writes it to the file once buffersize bytes
+    are collected, or interval seconds after the oldest unwritten data arrived. A buffersize
+    of 0 writes the data right away. flush() must be called when the download finishes,
+    fails or is closed. """
+
+    def __init__(self, file, buffersize=1024 * 1024, interval=1):
+
+        self.file = file
+        self.buffersize = buffersize
+        self.interval = interval
+
+        self.buffer = bytearray()
+        self.flushtime = None
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def write(self, data):
+
+        if not self.buffer and len(data) >= self.buffersize:
+            # Nothing to coalesce with, skip the copy
+            self.file.write(data)
+            self.file.flush()
+            return
+
+        if not self.buffer:
+            self.flushtime = time.time() + self.interval
+
+        self.buffer.extend(data)
+
+        if len(self.buffer) >= self.buffersize or time.time() >= self.flushtime:
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered data to the file. The data is dropped if writing fails,
+        the file still ends at the last data written in order. """
+
+        if not self.buffer:
+            return
+
+        try:
+            self.file.write(self.buffer)
+            self.file.flush()
+
+        finally:
+            self.buffer.clear()
+            self.flushtime = None
@@ -1424,14 +1424,7 @@ class ChatRoom:
             self.NowPlayingThread()
 
         elif cmd == "/rescan":
-
-            # Rescan public shares if needed
-            if not self.frame.np.config.sections["transfers"]["friendsonly"] and self.np.config.sections["transfers"]["shared"]:
-                self.frame.OnRescan()
-
-            # Rescan buddy shares if needed
-            if self.frame.np.config.sections["transfers"]["enablebuddyshares"]:
-                self.frame.OnBuddyRescan()
+            self.frame.OnRescanAll(requireshared=True)
 
         elif cmd in ["/tick", "/t"]:
             self.frame.np.queue.put(slskmessages.RoomTickerSet(self.room, args))
@@ -215,13 +215,8 @@ class FastConfigureAssistant(object):
         self.store()
         self.window.hide()
 
-        # Rescan public shares if needed
-        if not self.config.sections["transfers"]["friendsonly"]:
-            self.frame.OnRescan()
-
-        # Rescan buddy shares if needed
-        if self.config.sections["transfers"]["enablebuddyshares"]:
-            self.frame.OnBuddyRescan()
+        # Rescan public and buddy shares if needed
+        self.frame.OnRescanAll()
 
         if not self.frame.np.serverconn:
             self.frame.OnConnect(-1)
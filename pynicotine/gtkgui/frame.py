@@ -218,14 +218,7 @@ class NicotineFrame:
         """ Scanning """
 
         if config["transfers"]["rescanonstartup"]:
-
-            # Rescan public shares if needed
-            if not self.np.config.sections["transfers"]["friendsonly"] and self.np.config.sections["transfers"]["shared"]:
-                self.OnRescan()
-
-            # Rescan buddy shares if needed
-            if self.np.config.sections["transfers"]["enablebuddyshares"]:
-                self.OnBuddyRescan()
+            self.OnRescanAll(requireshared=True)
 
         # Deactivate public shares related menu entries if we don't use them
         if self.np.config.sections["transfers"]["friendsonly"] or not self.np.config.sections["transfers"]["shared"]:
@@ -995,6 +988,7 @@ class NicotineFrame:
             shared.append((_('Downloaded'), self.np.config.sections["transfers"]["downloaddir"]))
 
         msg = slskmessages.RescanShares(shared, None)
+        self.np.shares.trackFolderChanges("normal")
         _thread.start_new_thread(self.np.shares.RescanShares, (msg, rebuild))
 
     def OnBuddyRescan(self, widget=None, rebuild=False):
@@ -1015,8 +1009,57 @@ class NicotineFrame:
             shared.append((_('Downloaded'), self.np.config.sections["transfers"]["downloaddir"]))
 
         msg = slskmessages.RescanBuddyShares(shared, None)
+        self.np.shares.trackFolderChanges("buddy")
         _thread.start_new_thread(self.np.shares.RescanBuddyShares, (msg, rebuild))
 
+    def OnRescanAll(self, widget=None, rebuild=False, requireshared=False):
+        """ Rescan the public and buddy shares that are in use. If both are, their
+        folders are scanned in a single pass. If requireshared is True, public shares
+        are skipped while no public folders are shared. """
+
+        transfers = self.np.config.sections["transfers"]
+
+        # Public shares aren't used if we only share with buddies
+        public = not transfers["friendsonly"]
+
+        if requireshared and not transfers["shared"]:
+            public = False
+        buddy = transfers["enablebuddyshares"]
+
+        if not buddy or self.rescanning or self.brescanning:
+            if public:
+                self.OnRescan(rebuild=rebuild)
+
+            if buddy:
+                self.OnBuddyRescan(rebuild=rebuild)
+
+            return
+
+        if not public:
+            self.OnBuddyRescan(rebuild=rebuild)
+            return
+
+        self.rescanning = self.brescanning = True
+
+        self.rescan_public.set_sensitive(False)
+        self.browse_public_shares.set_sensitive(False)
+        self.rescan_buddy.set_sensitive(False)
+        self.browse_buddy_shares.set_sensitive(False)
+
+        self.logMessage(_("Rescanning started"))
+        self.logMessage(_("Rescanning Buddy Shares started"))
+
+        shared = transfers["shared"][:]
+        buddyshared = transfers["buddyshared"][:] + transfers["shared"][:]
+
+        if transfers["sharedownloaddir"]:
+            shared.append((_('Downloaded'), transfers["downloaddir"]))
+            buddyshared.append((_('Downloaded'), transfers["downloaddir"]))
+
+        msg = slskmessages.RescanAllShares(shared, buddyshared, None)
+        self.np.shares.trackFolderChanges("normal", "buddy")
+        _thread.start_new_thread(self.np.shares.RescanAllShares, (msg, rebuild))
+
     def OnBrowsePublicShares(self, widget):
         """ Browse your own public shares """
 
@@ -1956,15 +1999,38 @@ class NicotineFrame:
 
     """ Scanning """
 
-    def RescanFinished(self, files, streams, wordindex, fileindex, mtimes, type):
+    def RescanFinished(self, files, streams, wordindex, fileindex, mtimes, type, changed=True):
+        """ Called from the rescan thread. The new share databases are written in
+        that thread, and only switched to in the main loop. If changed is True, the
+        stored shared file list is made stale once the new streams are in place.
+        Returns False if the databases couldn't be written. """
+
         if type == "buddy":
-            GLib.idle_add(self._BuddyRescanFinished, files, streams, wordindex, fileindex, mtimes)
+            progress = self.BuddySharesProgress
+        else:
+            progress = self.SharesProgress
+
+        GLib.idle_add(progress.set_text, _("Saving shares"))
+        pending = self.np.config.writeShares(
+            type, files, streams, wordindex, fileindex, mtimes,
+            progress=lambda fraction: GLib.idle_add(progress.set_fraction, fraction)
+        )
+
+        if type == "buddy":
+            GLib.idle_add(self._BuddyRescanFinished, pending, changed)
         elif type == "normal":
-            GLib.idle_add(self._RescanFinished, files, streams, wordindex, fileindex, mtimes)
+            GLib.idle_add(self._RescanFinished, pending, changed)
+
+        return pending is not None
+
+    def _BuddyRescanFinished(self, pending, changed):
 
-    def _BuddyRescanFinished(self, files, streams, wordindex, fileindex, mtimes):
+        self.np.config.swapShares(pending)
 
-        self.np.config.setBuddyShares(files, streams, wordindex, fileindex, mtimes)
+        if pending is not None and changed:
+            self.np.shares.browsecaches["buddy"].bump()
+
+        self.np.shares.reapplyFolderChanges("buddy")
 
         if self.np.config.sections["transfers"]["enablebuddyshares"]:
             self.rescan_buddy.set_sensitive(True)
@@ -1979,10 +2045,16 @@ class NicotineFrame:
         self.BuddySharesProgress.hide()
 
         self.np.shares.CompressShares("buddy")
+        self.np.shares.startShareWatcher()
+
+    def _RescanFinished(self, pending, changed):
 
-    def _RescanFinished(self, files, streams, wordindex, fileindex, mtimes):
+        self.np.config.swapShares(pending)
 
-        self.np.config.setShares(files, streams, wordindex, fileindex, mtimes)
+        if pending is not None and changed:
+            self.np.shares.browsecaches["normal"].bump()
+
+        self.np.shares.reapplyFolderChanges("normal")
 
         if self.np.config.sections["transfers"]["shared"]:
             self.rescan_public.set_sensitive(True)
@@ -1994,6 +2066,7 @@ class NicotineFrame:
         self.SharesProgress.hide()
 
         self.np.shares.CompressShares("normal")
+        self.np.shares.startShareWatcher()
 
         if self.np.transfers is not None:
             self.np.shares.sendNumSharedFoldersFiles()
@@ -2957,14 +3030,7 @@ class NicotineFrame:
         if msg == "ok" and self.needrescan:
 
             self.needrescan = False
-
-            # Rescan public shares if needed
-            if not self.np.config.sections["transfers"]["friendsonly"]:
-                self.OnRescan()
-
-            # Rescan buddy shares if needed
-            if self.np.config.sections["transfers"]["enablebuddyshares"]:
-                self.OnBuddyRescan()
+            self.OnRescanAll()
 
         ConfigUnset = self.np.config.needConfig()
 
@@ -3057,13 +3123,15 @@ class NicotineFrame:
 
         # Closing up all shelves db
         for db in [
-            "sharedfiles", "sharedfilesstreams", "wordindex",
-            "fileindex", "sharedmtimes",
-            "bsharedfiles", "bsharedfilesstreams", "bwordindex",
-            "bfileindex", "bsharedmtimes"
+            "sharedfiles", "sharedfilesstreams", "searchindex",
+            "sharedmtimes",
+            "bsharedfiles", "bsharedfilesstreams", "bsearchindex",
+            "bsharedmtimes"
         ]:
             self.np.config.sections["transfers"][db].close()
 
+        self.np.shares.close()
+
     def SaveColumns(self):
         for i in [self.userbrowse, self.userlist, self.chatrooms.roomsctrl, self.downloads, self.uploads, self.Searches]:
             i.saveColumns()
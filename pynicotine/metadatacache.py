@@ -0,0 +1,128 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module contains a persistent cache of audio metadata, keyed on the
+identity of a file on disk. A file is only parsed again once it is
+replaced or modified, no matter which share or folder it is found in.
+"""
+
+import os
+import pickle
+import shelve
+import threading
+
+from pynicotine.logfacility import log
+
+
+class MetadataCache:
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.shelf = None
+        self.lock = threading.Lock()
+
+        # Keys used since the first of the running scans started
+        self.touched = set()
+        self.activescans = 0
+
+    @staticmethod
+    def get_key(filestat):
+        """ Returns the cache key of a file, from the result of os.stat() """
+
+        return "%i:%i:%i:%i" % (filestat.st_dev, filestat.st_ino, filestat.st_size, filestat.st_mtime_ns)
+
+    def open(self):
+
+        with self.lock:
+            if self.shelf is not None:
+                return
+
+            try:
+                self.shelf = shelve.open(self.filename, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as error:
+                log.addwarning("Failed to open metadata cache %s, recreating it: %s" % (self.filename, error))
+
+                try:
+                    os.unlink(self.filename)
+                    self.shelf = shelve.open(self.filename, flag='n', protocol=pickle.HIGHEST_PROTOCOL)
+                except Exception as error:
+                    log.addwarning("Failed to recreate metadata cache %s: %s" % (self.filename, error))
+
+    def close(self):
+
+        with self.lock:
+            if self.shelf is not None:
+                self.shelf.close()
+                self.shelf = None
+
+    def get(self, key):
+        """ Returns the cached ((bitrate, vbr), length) tuple of a file, or None """
+
+        with self.lock:
+            if self.shelf is None:
+                return None
+
+            if self.activescans:
+                self.touched.add(key)
+
+            return self.shelf.get(key)
+
+    def set(self, key, metadata):
+
+        with self.lock:
+            if self.shelf is None:
+                return
+
+            if self.activescans:
+                self.touched.add(key)
+
+            self.shelf[key] = metadata
+
+    def sync(self):
+
+        with self.lock:
+            if self.shelf is not None:
+                self.shelf.sync()
+
+    def begin_scan(self):
+
+        self.open()
+
+        with self.lock:
+            self.activescans += 1
+
+    def end_scan(self, prune=False):
+        """ Finish a scan. If prune is True, every shared file was looked up
+        during the scan, and entries that weren't are dropped. """
+
+        with self.lock:
+            self.activescans -= 1
+
+            if self.shelf is None:
+                return
+
+            if prune:
+                for key in [key for key in self.shelf if key not in self.touched]:
+                    del self.shelf[key]
+
+            if not self.activescans:
+                self.touched.clear()
+
+            self.shelf.sync()
@@ -0,0 +1,40 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module reads the audio metadata of shared files with taglib.
+
+taglib holds the GIL while it parses a file, so rescans with more than one
+rescan worker read metadata in a pool of processes instead of threads. The
+module only imports taglib, to keep the worker processes small.
+"""
+
+import taglib
+
+
+def read_metadata(pathname):
+    """ Returns the bitrate info and length in seconds of an audio file, or
+    (None, None) if the file can't be parsed. """
+
+    try:
+        audio = taglib.File(pathname)
+    except IOError:
+        return (None, None)
+
+    bitrateinfo = (int(audio.bitrate), int(False))  # Second argument used to be VBR (variable bitrate)
+    return (bitrateinfo, int(audio.length))
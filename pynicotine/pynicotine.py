@@ -33,7 +33,6 @@ import configparser
 import datetime
 import logging
 import os
-import queue
 import shutil
 import threading
 import time
@@ -132,7 +131,7 @@ class NetworkEventProcessor:
         self.PrivateMessageQueue = {}
         self.users = {}
         self.user_addr_requested = set()
-        self.queue = queue.Queue(0)
+        self.queue = slskproto.NetworkQueue()
         self.shares = Shares(self)
 
         script_dir = os.path.dirname(__file__)
@@ -270,6 +269,7 @@ class NetworkEventProcessor:
             transfers.TransferTimeout: self.TransferTimeout,
             slskmessages.RescanShares: self.shares.RescanShares,
             slskmessages.RescanBuddyShares: self.shares.RescanBuddyShares,
+            slskmessages.RescanAllShares: self.shares.RescanAllShares,
             str: self.Notify,
             slskmessages.PopupMessage: self.PopupMessage,
             slskmessages.SetCurrentConnectionCount: self.SetCurrentConnectionCount,
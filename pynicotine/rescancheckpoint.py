@@ -0,0 +1,164 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module saves the folders read by a running rescan to disk now and
+then, so that a rescan that was interrupted by quitting or a crash can
+continue where it left off instead of reading every folder again.
+
+The checkpoint file is a header followed by pickled batches of
+(folder, mtime, files) records, and is only appended to while a rescan
+runs. A batch cut short by a crash is dropped when the file is loaded.
+The file is removed once the rescan results are stored.
+"""
+
+import os
+import pickle
+import time
+
+from pynicotine.logfacility import log
+
+MAGIC = b"NRCP"
+VERSION = 1
+
+
+class RescanCheckpoint:
+
+    def __init__(self, filename, interval=30):
+
+        self.filename = filename
+        self.interval = interval
+
+        # Folders read by an earlier rescan, in format { folder: (mtime, files), ... }
+        self.folders = {}
+
+        # Number of folders taken from the checkpoint by get()
+        self.restored = 0
+
+        self.unsaved = []
+        self.lastsave = time.time()
+        self.handle = None
+
+    def load(self):
+        """ Load the folders saved by an interrupted rescan. Returns the number of folders. """
+
+        self.folders = {}
+
+        try:
+            handle = open(self.filename, "r+b")
+        except OSError:
+            return 0
+
+        with handle:
+            try:
+                header = pickle.load(handle)
+            except Exception:
+                header = None
+
+            if header != (MAGIC, VERSION):
+                log.adddebug("Ignoring invalid rescan checkpoint %s" % self.filename)
+                handle.truncate(0)
+                return 0
+
+            offset = handle.tell()
+
+            while True:
+                try:
+                    batch = pickle.load(handle)
+                except EOFError:
+                    break
+                except Exception:
+                    # Batch cut short while writing, drop it and everything after it
+                    handle.seek(offset)
+                    handle.truncate()
+                    break
+
+                for folder, mtime, files in batch:
+                    self.folders[folder] = (mtime, files)
+
+                offset = handle.tell()
+
+        return len(self.folders)
+
+    def get(self, folder, mtime):
+        """ Returns the files of a folder read by an interrupted rescan, or None
+        if the folder wasn't read or has changed since """
+
+        try:
+            oldmtime, files = self.folders[folder]
+        except KeyError:
+            return None
+
+        if oldmtime != mtime:
+            return None
+
+        self.restored += 1
+        return files
+
+    def add(self, folder, mtime, files):
+        self.unsaved.append((folder, mtime, files))
+
+    def save(self, force=False):
+        """ Append the folders added since the last save to the checkpoint file, if at
+        least interval seconds have passed. Returns True if anything was saved. """
+
+        if not self.unsaved:
+            return False
+
+        if not force and time.time() - self.lastsave < self.interval:
+            return False
+
+        self.lastsave = time.time()
+
+        try:
+            if self.handle is None:
+                self.handle = open(self.filename, "ab")
+
+                if not self.handle.tell():
+                    pickle.dump((MAGIC, VERSION), self.handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+            pickle.dump(self.unsaved, self.handle, protocol=pickle.HIGHEST_PROTOCOL)
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+
+        except OSError as error:
+            log.adddebug("Failed to save rescan checkpoint %s: %s" % (self.filename, error))
+            return False
+
+        finally:
+            self.unsaved = []
+
+        return True
+
+    def close(self):
+
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def remove(self):
+        """ Called once the results of the rescan are stored """
+
+        self.close()
+        self.folders = {}
+        self.unsaved = []
+
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
@@ -0,0 +1,137 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module limits the disk reads of rescans, so that uploads reading
+from the same disks keep their throughput while shares are rescanned.
+"""
+
+import ctypes
+import ctypes.util
+import platform
+import sys
+import threading
+import time
+
+# ioprio_set() system call numbers
+SYS_IOPRIO_SET = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "armv6l": 314,
+    "riscv64": 30,
+    "ppc64le": 273,
+    "s390x": 282
+}
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+# Seconds between checks whether uploads are still running in idle only mode
+IDLE_INTERVAL = 1
+
+# Longest delay before a single file is read, in seconds
+MAX_DELAY = 5
+
+
+def set_low_io_priority():
+    """ Move the calling thread to the idle I/O scheduling class, where it only
+    reads from disk when no other process does. Threads started by it afterwards
+    inherit the priority. Only supported on Linux, returns True on success. """
+
+    if not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        number = SYS_IOPRIO_SET[platform.machine()]
+    except KeyError:
+        return False
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return False
+
+    # A thread id of 0 is the calling thread
+    return libc.syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) == 0
+
+
+class RescanThrottle:
+    """ Called by the rescan threads before the metadata of a file is read. Keeps the
+    number of files and bytes read per second below the configured budgets, and in
+    idle only mode, waits while busy returns True. """
+
+    def __init__(self, busy=None):
+
+        self.busy = busy
+        self.lock = threading.Lock()
+
+        self.filesrate = 0
+        self.bytesrate = 0
+        self.idleonly = False
+
+        self.reset()
+
+    def reset(self):
+
+        with self.lock:
+            self.starttime = time.monotonic()
+            self.files = 0
+            self.bytes = 0
+
+    def set_limits(self, filesrate=0, bytesrate=0, idleonly=False):
+        """ filesrate is in files per second, bytesrate in bytes per second.
+        0 means no limit. """
+
+        self.filesrate = filesrate
+        self.bytesrate = bytesrate
+        self.idleonly = idleonly and self.busy is not None
+        self.reset()
+
+    def wait(self, size):
+        """ Called before a file of size bytes is read """
+
+        if self.idleonly and self.busy():
+            while self.busy():
+                time.sleep(IDLE_INTERVAL)
+
+            # Don't catch up on the time spent waiting in a burst
+            self.reset()
+
+        if not self.filesrate and not self.bytesrate:
+            return
+
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+
+            duration = 0
+
+            if self.filesrate:
+                duration = self.files / self.filesrate
+
+            if self.bytesrate:
+                duration = max(duration, self.bytes / self.bytesrate)
+
+            delay = duration - (time.monotonic() - self.starttime)
+
+        if delay > 0:
+            time.sleep(min(delay, MAX_DELAY))
@@ -0,0 +1,1152 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module contains the on-disk search index of our shares.
+
+The index is a single file, opened with mmap, and consists of:
+
+- a header with the location of every section
+- a term table, sorted by the UTF-8 encoding of each word
+- a blob holding the UTF-8 encoded words
+- the posting lists, packed as little-endian uint32 file numbers
+- a fixed-width record table with one entry per shared file
+- a blob holding the UTF-8 encoded virtual paths of the files
+- a blob holding the entry of each file in a search result message, encoded
+  the way it is sent over the network, so that search responses are joined
+  together from stored entries instead of packing every file again
+- a hash table of the virtual paths, with the file number of each path in
+  the slot given by its CRC-32, to find files by their exact path
+- optionally, a trigram table sorted by trigram, and the sorted lists of
+  words (as term numbers) each trigram of the UTF-8 encoded words appears in
+
+Word lookups are a binary search in the term table, and return a view of
+the posting list without copying or unpickling anything. Search terms with
+* wildcards are resolved to words through the trigram table.
+
+Files added or removed after the index was written, e.g. by the share
+watcher or for finished downloads, are kept in memory on top of the index
+file. Posting lists aren't filtered for removed files, those are skipped
+when matches are returned. Each change is also appended to a journal next
+to the index file, and replayed when the index is opened again. Once
+enough changes have piled up, the index and its changes are merged into a
+new index file (compaction), which can run in another thread while the
+index is in use.
+"""
+
+import mmap
+import os
+import re
+import string
+import struct
+import sys
+import zlib
+
+from array import array
+from bisect import bisect_left
+from itertools import chain
+from itertools import islice
+
+MAGIC = b"NSIX"
+VERSION = 4
+
+# magic, version, flags, number of words, number of files, number of trigrams,
+# number of path table slots, offset of the term table, term blob, posting lists,
+# record table, path blob, search result entry blob, path table, trigram table
+# and trigram posting lists
+HEADER = struct.Struct("<4sIIIIIIQQQQQQQQQ")
+
+HEADER_HAS_TRIGRAMS = 1
+
+# offset in term blob, index of first posting, length of word, number of postings
+TERM = struct.Struct("<QQII")
+
+# offset in path blob, file size, length of path, flags, bitrate, vbr, length,
+# offset in search result entry blob, length of search result entry
+RECORD = struct.Struct("<QQIIIIIQI")
+
+RECORD_HAS_METADATA = 1
+
+# trigram, index of first posting, number of postings
+TRIGRAM = struct.Struct("<III")
+
+# The path table has a power of two number of slots, at least twice the number
+# of files, holding the number of a file plus one, or 0 for empty slots
+
+# Limits on the work done for wildcard search terms, so that a flood of
+# broad wildcard searches can't stall us
+MAX_PATTERNS = 4
+MAX_PATTERN_CANDIDATES = 5000
+MAX_PATTERN_WORDS = 200
+MAX_PATTERN_POSTINGS = 50000
+
+JOURNAL_MAGIC = b"NSIJ"
+
+# magic, size and mtime of the index file the journal belongs to
+JOURNAL_HEADER = struct.Struct("<4sQQ")
+
+# operation, length of payload
+JOURNAL_ENTRY = struct.Struct("<BI")
+
+# file size, flags, bitrate, vbr, length, followed by the path
+JOURNAL_FILE = struct.Struct("<QIIII")
+
+JOURNAL_ADD = 1
+JOURNAL_REMOVE = 2
+JOURNAL_UPDATE = 3
+
+# Changes after which an index is due for compaction, at least
+COMPACT_MIN_CHANGES = 1000
+
+ENCODING_ERRORS = "surrogatepass"
+
+TRANSLATE_PUNCTUATION = str.maketrans(dict.fromkeys(string.punctuation, ' '))
+TRANSLATE_PUNCTUATION_WILDCARDS = str.maketrans(dict.fromkeys(string.punctuation.replace('*', ''), ' '))
+
+
+class SearchIndexError(Exception):
+    pass
+
+
+def get_index_words(virtualdir, filename):
+    """ Returns the set of words a file can be found with """
+
+    return set((virtualdir + " " + filename).lower().translate(TRANSLATE_PUNCTUATION).split())
+
+
+def get_path_words(path):
+    """ Returns the set of words a file can be found with, from its virtual path """
+
+    return set(path.lower().translate(TRANSLATE_PUNCTUATION).split())
+
+
+def parse_search_term(searchterm, wildcards=False):
+    """ Splits a search term into the words to look for, and the words to
+    exclude (starting with -). If wildcards is True, words can contain *,
+    which matches any number of characters. """
+
+    table = TRANSLATE_PUNCTUATION_WILDCARDS if wildcards else TRANSLATE_PUNCTUATION
+    words = []
+    excluded = []
+
+    for term in searchterm.lower().split():
+        if term.startswith('-'):
+            destination = excluded
+            term = term[1:]
+        else:
+            destination = words
+
+        destination.extend(word for word in term.translate(table).split() if word.strip('*'))
+
+    return words, excluded
+
+
+def get_trigrams(word):
+    """ Returns the set of trigrams in a UTF-8 encoded word, as integers """
+
+    return {int.from_bytes(word[i:i + 3], "big") for i in range(len(word) - 2)}
+
+
+def encode_result_entry(fileinfo):
+    """ Returns the entry of a file in format (path, size, (bitrate, vbr), length)
+    in a FileSearchResult message """
+
+    path = fileinfo[0].replace(os.sep, "\\").encode("utf-8", "replace")
+    entry = bytearray(b"\x01")
+    entry += struct.pack("<i", len(path))
+    entry += path
+    entry += struct.pack("<Q", fileinfo[1])
+
+    if fileinfo[2] is None:
+        # No metadata
+        entry += struct.pack("<ii", 0, 0)
+    else:
+        # File extension, number of attributes, then bitrate, length and vbr
+        entry += struct.pack("<i", 3) + b"mp3"
+        entry += struct.pack("<iiIiIii", 3, 0, fileinfo[2][0], 1, fileinfo[3], 2, fileinfo[2][1])
+
+    return bytes(entry)
+
+
+class FileTable:
+    """ Compact in-memory table of files, used while building a search index.
+    Instead of one tuple and path string per file, files are stored in
+    columns: the number of their folder in a table of folders, their name in
+    a shared blob, and their size and metadata in arrays. Iterating yields
+    files in format (path, size, (bitrate, vbr), length). """
+
+    def __init__(self, files=()):
+
+        self.directories = []
+        self._directorynumbers = {}
+
+        self.dirs = array('I')
+        self.names = bytearray()
+        self.nameoffsets = array('Q', [0])
+        self.sizes = array('Q')
+        self.flags = array('B')
+        self.bitrates = array('I')
+        self.vbrs = array('I')
+        self.lengths = array('I')
+
+        for fileinfo in files:
+            virtualdir, _separator, name = fileinfo[0].rpartition('\\')
+            self.append(virtualdir, (name,) + tuple(fileinfo[1:]))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __iter__(self):
+
+        for index in range(len(self.sizes)):
+            yield self.get_file(index)
+
+    def append(self, virtualdir, fileinfo):
+        """ Add a file in format (name, size, (bitrate, vbr), length) in folder
+        virtualdir. Returns the number of the file. """
+
+        number = self._directorynumbers.get(virtualdir)
+
+        if number is None:
+            number = self._directorynumbers[virtualdir] = len(self.directories)
+            self.directories.append(virtualdir)
+
+        self.dirs.append(number)
+        self.names += fileinfo[0].encode("utf-8", ENCODING_ERRORS)
+        self.nameoffsets.append(len(self.names))
+        self.sizes.append(fileinfo[1])
+
+        if fileinfo[2] is not None:
+            self.flags.append(RECORD_HAS_METADATA)
+            self.bitrates.append(fileinfo[2][0])
+            self.vbrs.append(fileinfo[2][1])
+            self.lengths.append(fileinfo[3])
+        else:
+            self.flags.append(0)
+            self.bitrates.append(0)
+            self.vbrs.append(0)
+            self.lengths.append(0)
+
+        return len(self.sizes) - 1
+
+    def get_path(self, index):
+
+        name = self.names[self.nameoffsets[index]:self.nameoffsets[index + 1]].decode("utf-8", ENCODING_ERRORS)
+        return self.directories[self.dirs[index]] + '\\' + name
+
+    def get_file(self, index):
+
+        if self.flags[index] & RECORD_HAS_METADATA:
+            return (self.get_path(index), self.sizes[index], (self.bitrates[index], self.vbrs[index]), self.lengths[index])
+
+        return (self.get_path(index), self.sizes[index], None, None)
+
+
+def build_index(sharedfiles):
+    """ Builds an in-memory word and file index from a dict in format
+    { virtualdir: [fileinfo, ...], ... }, e.g. to regenerate a missing index
+    from the shared files database. """
+
+    wordindex = {}
+    fileindex = FileTable()
+
+    for virtualdir in sharedfiles:
+        for fileinfo in sharedfiles[virtualdir]:
+            index = fileindex.append(virtualdir, fileinfo)
+
+            for word in get_index_words(virtualdir, fileinfo[0]):
+                try:
+                    wordindex[word].append(index)
+                except KeyError:
+                    wordindex[word] = array('I', [index])
+
+    return wordindex, fileindex
+
+
+def get_path_slots(paths, numslots):
+    """ Returns the path table with numslots slots for a list of UTF-8 encoded
+    virtual paths, as an array. Collisions are resolved with linear probing. """
+
+    slots = array('I', [0]) * numslots
+    mask = numslots - 1
+
+    for index, path in enumerate(paths):
+        slot = zlib.crc32(path) & mask
+
+        while slots[slot]:
+            slot = (slot + 1) & mask
+
+        slots[slot] = index + 1
+
+    return slots
+
+
+def _pad(handle, alignment=8):
+
+    position = handle.tell()
+    padding = -position % alignment
+
+    if padding:
+        handle.write(bytes(padding))
+
+    return position + padding
+
+
+def write_search_index(filename, wordindex, fileindex, trigrams=True):
+    """ Writes a word index { word: [num, num, ...], ... } and a file index
+    [ (path, size, (bitrate, vbr), length), ... ] to filename. If trigrams is
+    True, a trigram index of the words is included for wildcard searches.
+    The file is written under a temporary name and renamed once complete,
+    so a crash never leaves a half-written index behind. """
+
+    tmpfile = filename + ".tmp"
+    terms = sorted((word.encode("utf-8", ENCODING_ERRORS), postings) for word, postings in wordindex.items())
+
+    with open(tmpfile, "wb") as handle:
+        handle.write(bytes(HEADER.size))
+
+        # Term table
+        terms_offset = _pad(handle)
+        term_offset = 0
+        postings_start = 0
+
+        for word, postings in terms:
+            handle.write(TERM.pack(term_offset, postings_start, len(word), len(postings)))
+            term_offset += len(word)
+            postings_start += len(postings)
+
+        # Term blob
+        termblob_offset = handle.tell()
+
+        for word, postings in terms:
+            handle.write(word)
+
+        # Posting lists
+        postings_offset = _pad(handle)
+
+        for word, postings in terms:
+            postings = array('I', sorted(postings))
+
+            if sys.byteorder != "little":
+                postings.byteswap()
+
+            handle.write(postings.tobytes())
+
+        # Record table
+        records_offset = _pad(handle)
+        path_offset = 0
+        entry_offset = 0
+        paths = []
+        entries = []
+
+        for fileinfo in fileindex:
+            path = fileinfo[0].encode("utf-8", ENCODING_ERRORS)
+            paths.append(path)
+
+            entry = encode_result_entry(fileinfo)
+            entries.append(entry)
+
+            if fileinfo[2] is not None:
+                flags = RECORD_HAS_METADATA
+                bitrate, vbr = fileinfo[2]
+                length = fileinfo[3]
+            else:
+                flags = bitrate = vbr = length = 0
+
+            handle.write(RECORD.pack(
+                path_offset, fileinfo[1], len(path), flags, bitrate, vbr, length, entry_offset, len(entry)
+            ))
+            path_offset += len(path)
+            entry_offset += len(entry)
+
+        # Path blob
+        pathblob_offset = handle.tell()
+
+        for path in paths:
+            handle.write(path)
+
+        # Search result entry blob
+        entryblob_offset = handle.tell()
+
+        for entry in entries:
+            handle.write(entry)
+
+        # Path table
+        pathtable_offset = _pad(handle)
+        numslots = 1 << (2 * len(paths) - 1).bit_length() if paths else 0
+        slots = get_path_slots(paths, numslots)
+
+        if sys.byteorder != "little":
+            slots.byteswap()
+
+        handle.write(slots.tobytes())
+
+        # Trigram table
+        flags = 0
+        trigramindex = {}
+
+        if trigrams:
+            flags |= HEADER_HAS_TRIGRAMS
+
+            for number, (word, postings) in enumerate(terms):
+                for trigram in get_trigrams(word):
+                    try:
+                        trigramindex[trigram].append(number)
+                    except KeyError:
+                        trigramindex[trigram] = [number]
+
+        trigrams_offset = _pad(handle)
+        trigrampostings_start = 0
+
+        for trigram, numbers in sorted(trigramindex.items()):
+            handle.write(TRIGRAM.pack(trigram, trigrampostings_start, len(numbers)))
+            trigrampostings_start += len(numbers)
+
+        # Trigram posting lists
+        trigrampostings_offset = handle.tell()
+
+        for trigram, numbers in sorted(trigramindex.items()):
+            numbers = array('I', numbers)
+
+            if sys.byteorder != "little":
+                numbers.byteswap()
+
+            handle.write(numbers.tobytes())
+
+        handle.seek(0)
+        handle.write(HEADER.pack(
+            MAGIC, VERSION, flags, len(terms), len(fileindex), len(trigramindex), numslots,
+            terms_offset, termblob_offset, postings_offset, records_offset, pathblob_offset,
+            entryblob_offset, pathtable_offset, trigrams_offset, trigrampostings_offset
+        ))
+
+    # Changes journaled for the previous index are part of the new one
+    _unlink(filename + ".journal")
+    os.replace(tmpfile, filename)
+
+
+def _gallop(sequence, item, low):
+    """ Returns the position of the first element of the sorted sequence that
+    is not smaller than item, looking from position low onwards in
+    exponentially growing steps """
+
+    end = len(sequence)
+    bound = 1
+
+    while low + bound < end and sequence[low + bound] < item:
+        bound *= 2
+
+    return bisect_left(sequence, item, low + bound // 2, min(low + bound + 1, end))
+
+
+class ConcatenatedPostings:
+    """ Read-only view of two sorted posting lists, where every file number in
+    the first list is smaller than the ones in the second, as one sorted list.
+    Used to look up the files added to an index without copying its postings. """
+
+    __slots__ = ("first", "second")
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def __len__(self):
+        return len(self.first) + len(self.second)
+
+    def __iter__(self):
+        return chain(self.first, self.second)
+
+    def __getitem__(self, index):
+
+        if index < 0:
+            index += len(self)
+
+        if index < len(self.first):
+            return self.first[index]
+
+        return self.second[index - len(self.first)]
+
+
+def iter_matches(postings, excluded=(), removed=()):
+    """ Yields the file numbers found in all of the sorted posting lists in
+    postings, and in none of excluded or removed. The shortest posting list is
+    walked, and the others are searched with galloping search from where the
+    previous match left off, so the cost depends mostly on the rarest word.
+    removed is only checked for the matches, posting lists may contain removed
+    files. """
+
+    if not postings:
+        return
+
+    postings = sorted(postings, key=len)
+    others = postings[1:]
+    positions = [0] * len(others)
+    excludedpositions = [0] * len(excluded)
+
+    for item in postings[0]:
+        for i, sequence in enumerate(others):
+            pos = positions[i] = _gallop(sequence, item, positions[i])
+
+            if pos == len(sequence):
+                # No more files can match every word
+                return
+
+            if sequence[pos] != item:
+                break
+        else:
+            for i, sequence in enumerate(excluded):
+                pos = excludedpositions[i] = _gallop(sequence, item, excludedpositions[i])
+
+                if pos < len(sequence) and sequence[pos] == item:
+                    break
+            else:
+                if item not in removed:
+                    yield item
+
+
+def _unlink(path):
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_search_index(filename):
+
+    for path in (filename, filename + ".tmp", filename + ".journal"):
+        _unlink(path)
+
+
+class SearchIndex:
+    """ View of a search index file. An index without a file behaves as an
+    empty index. """
+
+    def __init__(self, filename=None):
+
+        self.filename = filename
+        self.flags = 0
+        self.num_words = 0
+        self.num_files = 0
+        self.num_trigrams = 0
+        self.num_slots = 0
+
+        self._handle = None
+        self._mmap = None
+        self._postings = None
+        self._pathslots = None
+        self._trigrampostings = None
+
+        # Changes since the index file was written. Added files are numbered
+        # after the files in the index file.
+        self._added_files = []
+        self._added_entries = []
+        self._added_words = {}
+        self._added_paths = {}
+        self._removed = set()
+
+        # New size and metadata of files, in format { number: (fileinfo, entry), ... }
+        self._updated = {}
+
+        self._journal = None
+        self._journal_identity = (0, 0)
+        self._replaying = False
+
+        if filename is None:
+            return
+
+        if os.path.exists(filename):
+            self._open()
+
+        self._replay_journal()
+
+    def _open(self):
+
+        self._handle = open(self.filename, "rb")
+        filestat = os.fstat(self._handle.fileno())
+        self._journal_identity = (filestat.st_size, filestat.st_mtime_ns)
+
+        if filestat.st_size == 0:
+            # mmap refuses to map empty files
+            return
+
+        self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            (magic, version, self.flags, self.num_words, self.num_files, self.num_trigrams, self.num_slots,
+             self._terms_offset, self._termblob_offset, postings_offset,
+             self._records_offset, self._pathblob_offset, self._entryblob_offset,
+             pathtable_offset, self._trigrams_offset, trigrampostings_offset) = HEADER.unpack_from(self._mmap)
+        except struct.error:
+            self.close()
+            raise SearchIndexError("Truncated search index %s" % self.filename)
+
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise SearchIndexError("Unsupported search index %s" % self.filename)
+
+        self._postings = self._get_array(postings_offset, self._records_offset)
+        self._pathslots = self._get_array(pathtable_offset, pathtable_offset + self.num_slots * 4)
+        self._trigrampostings = self._get_array(trigrampostings_offset, len(self._mmap))
+
+    def _get_array(self, start, end):
+
+        if sys.byteorder == "little":
+            return memoryview(self._mmap)[start:end].cast('I')
+
+        numbers = array('I', self._mmap[start:end])
+        numbers.byteswap()
+        return numbers
+
+    def _replay_journal(self):
+
+        path = self.filename + ".journal"
+
+        try:
+            with open(path, "rb") as handle:
+                data = handle.read()
+        except FileNotFoundError:
+            return
+
+        try:
+            magic, size, mtime = JOURNAL_HEADER.unpack_from(data)
+        except struct.error:
+            magic = None
+
+        if magic != JOURNAL_MAGIC or (size, mtime) != self._journal_identity:
+            # Journal of an older index file
+            _unlink(path)
+            return
+
+        pos = JOURNAL_HEADER.size
+        self._replaying = True
+
+        try:
+            while pos + JOURNAL_ENTRY.size <= len(data):
+                operation, length = JOURNAL_ENTRY.unpack_from(data, pos)
+                payload = data[pos + JOURNAL_ENTRY.size:pos + JOURNAL_ENTRY.size + length]
+
+                if len(payload) < length:
+                    break
+
+                if operation in (JOURNAL_ADD, JOURNAL_UPDATE):
+                    size, flags, bitrate, vbr, length = JOURNAL_FILE.unpack_from(payload)
+                    filepath = payload[JOURNAL_FILE.size:].decode("utf-8", ENCODING_ERRORS)
+
+                    if flags & RECORD_HAS_METADATA:
+                        fileinfo = (filepath, size, (bitrate, vbr), length)
+                    else:
+                        fileinfo = (filepath, size, None, None)
+
+                    if operation == JOURNAL_ADD:
+                        self.add_file(fileinfo)
+                    else:
+                        self.update_file(fileinfo)
+
+                elif operation == JOURNAL_REMOVE:
+                    self.remove_file(payload.decode("utf-8", ENCODING_ERRORS))
+
+                pos += JOURNAL_ENTRY.size + len(payload)
+        finally:
+            self._replaying = False
+
+        if pos < len(data):
+            # Drop an entry that was cut short by a crash, later entries are appended after it
+            os.truncate(path, pos)
+
+    def _write_journal(self, operation, payload):
+
+        if self.filename is None or self._replaying:
+            return
+
+        if self._journal is None:
+            self._journal = open(self.filename + ".journal", "ab")
+
+            if self._journal.tell() == 0:
+                self._journal.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, *self._journal_identity))
+
+        self._journal.write(JOURNAL_ENTRY.pack(operation, len(payload)) + payload)
+        self._journal.flush()
+
+    def __len__(self):
+        return self.num_files + len(self._added_files) - len(self._removed)
+
+    def __contains__(self, word):
+        return self.lookup(word) is not None
+
+    def lookup(self, word):
+        """ Returns the sorted file numbers matching word, or None if the word
+        isn't in the index. Nothing is copied, so the numbers include files
+        removed since the index was written; see is_removed(). """
+
+        postings = self._lookup_file(word)
+        added = self._added_words.get(word)
+
+        if not added:
+            return postings
+
+        if postings is None:
+            return added
+
+        return ConcatenatedPostings(postings, added)
+
+    def is_removed(self, index):
+        return index in self._removed
+
+    def query(self, words, excluded=(), maxresults=None):
+        """ Returns the numbers of at most maxresults files matching all of words,
+        and none of excluded. Words containing * are wildcard patterns. """
+
+        if sum('*' in word for word in words + list(excluded)) > MAX_PATTERNS:
+            return []
+
+        postings = []
+
+        for word in words:
+            if '*' in word:
+                matches = self.lookup_pattern(word)
+            else:
+                matches = self.lookup(word)
+
+            if not matches:
+                return []
+
+            postings.append(matches)
+
+        excludedpostings = []
+
+        for word in excluded:
+            if '*' in word:
+                matches = self.lookup_pattern(word)
+            else:
+                matches = self.lookup(word)
+
+            if matches:
+                excludedpostings.append(matches)
+
+        return list(islice(iter_matches(postings, excludedpostings, self._removed), maxresults))
+
+    def expand_pattern(self, pattern):
+        """ Returns the words in the index matching pattern, where * matches any
+        number of characters. Candidate words are found through the trigrams of
+        the pattern, so patterns without a run of three bytes match nothing.
+        At most MAX_PATTERN_WORDS words are returned. """
+
+        keys = set()
+
+        for fragment in pattern.split('*'):
+            keys |= get_trigrams(fragment.encode("utf-8", ENCODING_ERRORS))
+
+        if not keys:
+            return []
+
+        regex = re.compile('.*'.join(map(re.escape, pattern.split('*'))), re.DOTALL)
+        candidates = []
+
+        if self.flags & HEADER_HAS_TRIGRAMS:
+            trigrampostings = []
+
+            for key in keys:
+                numbers = self._lookup_trigram(key)
+
+                if numbers is None:
+                    trigrampostings = []
+                    break
+
+                trigrampostings.append(numbers)
+
+            for number in iter_matches(trigrampostings):
+                candidates.append(self._get_term(number)[0].decode("utf-8", ENCODING_ERRORS))
+
+                if len(candidates) >= MAX_PATTERN_CANDIDATES:
+                    break
+
+        # Words only found in files added since the index was written
+        for word in self._added_words:
+            if len(candidates) >= MAX_PATTERN_CANDIDATES:
+                break
+
+            if self._lookup_file(word) is None:
+                candidates.append(word)
+
+        return [word for word in candidates if regex.fullmatch(word)][:MAX_PATTERN_WORDS]
+
+    def lookup_pattern(self, pattern):
+        """ Returns the sorted file numbers matching a wildcard pattern, at most
+        MAX_PATTERN_POSTINGS of them """
+
+        results = set()
+
+        for word in self.expand_pattern(pattern):
+            remaining = MAX_PATTERN_POSTINGS - len(results)
+
+            if remaining <= 0:
+                break
+
+            # Posting lists of common words can be long, only take what's left of the budget
+            results.update(islice(self.lookup(word) or (), remaining))
+
+        return sorted(results)
+
+    def _lookup_trigram(self, key):
+
+        low = 0
+        high = self.num_trigrams
+
+        while low < high:
+            middle = (low + high) // 2
+            trigram, start, count = TRIGRAM.unpack_from(self._mmap, self._trigrams_offset + middle * TRIGRAM.size)
+
+            if trigram < key:
+                low = middle + 1
+            elif trigram > key:
+                high = middle
+            else:
+                return self._trigrampostings[start:start + count]
+
+        return None
+
+    def _get_term(self, number):
+
+        term_offset, postings_start, term_length, count = TERM.unpack_from(
+            self._mmap, self._terms_offset + number * TERM.size
+        )
+        start = self._termblob_offset + term_offset
+
+        return self._mmap[start:start + term_length], postings_start, count
+
+    def _lookup_file(self, word):
+
+        if not self.num_words:
+            return None
+
+        key = word.encode("utf-8", ENCODING_ERRORS)
+        low = 0
+        high = self.num_words
+
+        while low < high:
+            middle = (low + high) // 2
+            term, postings_start, count = self._get_term(middle)
+
+            if term < key:
+                low = middle + 1
+            elif term > key:
+                high = middle
+            else:
+                return self._postings[postings_start:postings_start + count]
+
+        return None
+
+    def _get_path_bytes(self, index):
+
+        path_offset, _size, path_length = RECORD.unpack_from(self._mmap, self._records_offset + index * RECORD.size)[:3]
+        start = self._pathblob_offset + path_offset
+
+        return self._mmap[start:start + path_length]
+
+    def _lookup_path(self, key):
+
+        if not self.num_slots:
+            return None
+
+        mask = self.num_slots - 1
+        slot = zlib.crc32(key) & mask
+
+        while self._pathslots[slot]:
+            index = self._pathslots[slot] - 1
+
+            if index not in self._removed and self._get_path_bytes(index) == key:
+                return index
+
+            slot = (slot + 1) & mask
+
+        return None
+
+    def get_path(self, index):
+        """ Returns the virtual path of the file with number index """
+
+        if index >= self.num_files:
+            return self.get_file(index)[0]
+
+        if index < 0:
+            raise IndexError("File %s not in search index" % index)
+
+        return self._get_path_bytes(index).decode("utf-8", ENCODING_ERRORS)
+
+    def get_file(self, index):
+        """ Returns the file with number index, in format
+        (path, size, (bitrate, vbr), length) """
+
+        if index in self._updated:
+            return self._updated[index][0]
+
+        if index >= self.num_files:
+            try:
+                return self._added_files[index - self.num_files]
+            except IndexError:
+                raise IndexError("File %s not in search index" % index)
+
+        if index < 0:
+            raise IndexError("File %s not in search index" % index)
+
+        path_offset, size, path_length, flags, bitrate, vbr, length, _entry_offset, _entry_length = RECORD.unpack_from(
+            self._mmap, self._records_offset + index * RECORD.size
+        )
+        start = self._pathblob_offset + path_offset
+        path = self._mmap[start:start + path_length].decode("utf-8", ENCODING_ERRORS)
+
+        if flags & RECORD_HAS_METADATA:
+            return (path, size, (bitrate, vbr), length)
+
+        return (path, size, None, None)
+
+    def get_result_entry(self, index):
+        """ Returns the encoded entry of the file with number index in a
+        FileSearchResult message """
+
+        if index in self._updated:
+            return self._updated[index][1]
+
+        if index >= self.num_files:
+            try:
+                return self._added_entries[index - self.num_files]
+            except IndexError:
+                raise IndexError("File %s not in search index" % index)
+
+        if index < 0:
+            raise IndexError("File %s not in search index" % index)
+
+        *_fileinfo, entry_offset, entry_length = RECORD.unpack_from(
+            self._mmap, self._records_offset + index * RECORD.size
+        )
+        start = self._entryblob_offset + entry_offset
+
+        return self._mmap[start:start + entry_length]
+
+    def add_file(self, fileinfo):
+        """ Add a file in format (path, size, (bitrate, vbr), length) to the
+        index. Only the posting lists of the words in its path are appended
+        to. Returns the number of the file. """
+
+        index = self.num_files + len(self._added_files)
+        self._added_entries.append(encode_result_entry(fileinfo))
+        self._added_files.append(fileinfo)
+        self._added_paths[fileinfo[0]] = index
+
+        for word in get_path_words(fileinfo[0]):
+            try:
+                self._added_words[word].append(index)
+            except KeyError:
+                self._added_words[word] = [index]
+
+        self._write_journal(JOURNAL_ADD, self._pack_file(fileinfo))
+        return index
+
+    def update_file(self, fileinfo):
+        """ Replace the size and metadata of a file in the index, found by the path
+        in fileinfo. The words of the path stay the same, so no posting list is
+        touched. Returns False if the file isn't in the index. """
+
+        index = self.find_file(fileinfo[0])
+
+        if index is None:
+            return False
+
+        self._update(index, fileinfo)
+        return True
+
+    def _update(self, index, fileinfo):
+
+        self._updated[index] = (fileinfo, encode_result_entry(fileinfo))
+        self._write_journal(JOURNAL_UPDATE, self._pack_file(fileinfo))
+
+    def _pack_file(self, fileinfo):
+
+        if fileinfo[2] is not None:
+            flags = RECORD_HAS_METADATA
+            bitrate, vbr = fileinfo[2]
+            length = fileinfo[3]
+        else:
+            flags = bitrate = vbr = length = 0
+
+        return JOURNAL_FILE.pack(fileinfo[1], flags, bitrate, vbr, length) + fileinfo[0].encode("utf-8", ENCODING_ERRORS)
+
+    def find_file(self, path):
+        """ Returns the number of the file with virtual path path, or None if
+        the file isn't in the index. Only looks at the files in one slot of the
+        path table, or the files added since the index was written. """
+
+        index = self._added_paths.get(path)
+
+        if index is not None and index not in self._removed:
+            return index
+
+        return self._lookup_path(path.encode("utf-8", ENCODING_ERRORS))
+
+    def remove_file(self, path):
+        """ Remove the file with virtual path path from the index. Returns
+        False if the file isn't in the index. """
+
+        index = self.find_file(path)
+
+        if index is None:
+            return False
+
+        self._remove(index)
+        return True
+
+    def _remove(self, index):
+
+        self._removed.add(index)
+        self._write_journal(JOURNAL_REMOVE, self.get_path(index).encode("utf-8", ENCODING_ERRORS))
+
+    def needs_compaction(self):
+        changes = len(self._added_files) + len(self._removed) + len(self._updated)
+        return changes >= max(COMPACT_MIN_CHANGES, self.num_files // 8)
+
+    def snapshot(self):
+        """ Returns the changes made so far, to pass to write_compacted() """
+
+        return len(self._added_files), frozenset(self._removed), dict(self._updated)
+
+    def write_compacted(self, filename, snapshot, trigrams=True):
+        """ Writes the index, including the changes up to snapshot, to filename.
+        Can be called from another thread while the index is in use, as long
+        as it isn't closed. """
+
+        numadded, removed, _updated = snapshot
+        total = self.num_files + numadded
+
+        # New number of each file, or -1 for removed files
+        renumbered = array('l', [-1]) * total
+        fileindex = FileTable()
+
+        for index in range(total):
+            if index in removed:
+                continue
+
+            fileinfo = self.get_file(index)
+            virtualdir, _separator, name = fileinfo[0].rpartition('\\')
+            renumbered[index] = fileindex.append(virtualdir, (name,) + fileinfo[1:])
+
+        wordindex = {}
+
+        for number in range(self.num_words):
+            term, postings_start, count = self._get_term(number)
+            postings = [renumbered[i] for i in self._postings[postings_start:postings_start + count] if renumbered[i] >= 0]
+
+            if postings:
+                wordindex[term.decode("utf-8", ENCODING_ERRORS)] = postings
+
+        for word, added in list(self._added_words.items()):
+            # Posting lists are only ever appended to, skip files added after the snapshot
+            added = added[:bisect_left(added, total)]
+            postings = [renumbered[i] for i in added if renumbered[i] >= 0]
+
+            if not postings:
+                continue
+
+            try:
+                wordindex[word].extend(postings)
+            except KeyError:
+                wordindex[word] = postings
+
+        write_search_index(filename, wordindex, fileindex, trigrams)
+
+    def replace_compacted(self, filename, snapshot):
+        """ Replaces the index file with one written by write_compacted(), and
+        carries over the changes made after the snapshot was taken. This index
+        is closed, and the new one is returned. """
+
+        numadded, removed, updated = snapshot
+        total = self.num_files + numadded
+        snapshotremoved = sorted(removed)
+
+        def renumber(index):
+            # Number of a file in the compacted index, see write_compacted()
+            return index - bisect_left(snapshotremoved, index)
+
+        # Changes are carried over by file number, since a path may have been
+        # removed and added again after the snapshot
+        removednumbers = [renumber(index) for index in sorted(self._removed - removed) if index < total]
+        added = [
+            self.get_file(index) for index in range(total, self.num_files + len(self._added_files))
+            if index not in self._removed
+        ]
+
+        # Files updated after the snapshot, the compacted index may have their previous metadata
+        updatedfiles = [
+            (renumber(index), fileinfo) for index, (fileinfo, _entry) in sorted(self._updated.items())
+            if index < total and index not in self._removed and updated.get(index, (None,))[0] is not fileinfo
+        ]
+        indexfile = self.filename
+
+        self.close()
+
+        _unlink(indexfile + ".journal")
+        os.replace(filename, indexfile)
+
+        index = SearchIndex(indexfile)
+
+        # Added files come last, so that replaying the journal finds the
+        # removed and updated files by path in the compacted index
+        for number in removednumbers:
+            index._remove(number)
+
+        for number, fileinfo in updatedfiles:
+            index._update(number, fileinfo)
+
+        for fileinfo in added:
+            index.add_file(fileinfo)
+
+        return index
+
+    def close(self):
+
+        for numbers in (self._postings, self._pathslots, self._trigrampostings):
+            if isinstance(numbers, memoryview):
+                numbers.release()
+
+        self._postings = self._pathslots = self._trigrampostings = None
+
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # A posting list is still referenced somewhere, the mapping
+                # is released once it is garbage collected
+                pass
+
+            self._mmap = None
+
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+        self.flags = self.num_words = self.num_files = self.num_trigrams = self.num_slots = 0
+
+        self._added_files = []
+        self._added_entries = []
+        self._added_words = {}
+        self._added_paths = {}
+        self._removed = set()
+        self._updated = {}
@@ -0,0 +1,362 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module contains an SQLite storage backend for the share databases
+(files, streams and mtimes of the public and buddy shares), as an
+alternative to one shelve per database.
+
+All databases live in a single SQLite file in WAL mode. Every database has
+a current generation, and its entries are stored per generation. When the
+shares are stored after a rescan, the new contents are written as a new
+generation in a separate connection, and the current generation of every
+database is switched in the same transaction. Until then, readers keep
+seeing the previous contents, and a crash leaves them untouched.
+
+Single entries changed in the main loop are queued and written by a writer
+thread with its own connection, so that they never wait for a rescan that
+is storing the shares. Until they are written, reads find them in the queue.
+"""
+
+import pickle
+import sqlite3
+import threading
+
+from collections.abc import MutableMapping
+
+from pynicotine.logfacility import log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    name TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    store TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (store, generation, key)
+) WITHOUT ROWID;
+"""
+
+PURGE = """
+DELETE FROM entries
+WHERE generation != COALESCE((SELECT generation FROM generations WHERE name = entries.store), 0)
+"""
+
+MISSING = object()
+
+
+class ShareDatabase:
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.openstores = 0
+
+        # Writes waiting for the writer thread, in format
+        # { (name, generation, key): pickled value, or None to delete it, ... }
+        self.pending = {}
+        self.writer = None
+        self.stopping = False
+
+        self.connection = self._connect()
+        self.connection.executescript(SCHEMA)
+        self.generations = dict(self.connection.execute("SELECT name, generation FROM generations"))
+
+        # Drop generations left behind by an interrupted switch
+        self.connection.execute(PURGE)
+
+    def _connect(self):
+
+        connection = sqlite3.connect(self.filename, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        return connection
+
+    def open_store(self, name):
+
+        with self.lock:
+            self.openstores += 1
+
+        return ShareStore(self, name)
+
+    def release(self):
+
+        with self.lock:
+            self.openstores -= 1
+
+            if self.openstores > 0 or self.connection is None:
+                return
+
+            self.stopping = True
+            self.changed.notify_all()
+            writer = self.writer
+
+        # Write the remaining queued writes before closing
+        if writer is not None:
+            writer.join()
+
+        with self.lock:
+            self.connection.close()
+            self.connection = None
+
+    def queue_write(self, name, key, value):
+        """ Queue a write of a pickled value, or None to delete the key, for the writer
+        thread. Called with the lock held. """
+
+        if self.stopping:
+            return
+
+        self.pending[(name, self.generations.get(name, 0), key)] = value
+
+        if self.writer is None:
+            self.writer = threading.Thread(target=self._write_pending, name="ShareDatabaseWriter", daemon=True)
+            self.writer.start()
+
+        self.changed.notify_all()
+
+    def flush(self):
+        """ Wait until all queued writes are written """
+
+        with self.changed:
+            while self.pending and self.writer is not None:
+                self.changed.wait()
+
+    def _write_pending(self):
+
+        connection = self._connect()
+
+        try:
+            while True:
+                with self.changed:
+                    while not self.pending and not self.stopping:
+                        self.changed.wait()
+
+                    if not self.pending:
+                        return
+
+                    writes = dict(self.pending)
+
+                try:
+                    connection.execute("BEGIN IMMEDIATE")
+
+                    # Skip writes of generations replaced in the meantime, they would be left
+                    # behind. A switch after this point waits for the commit before purging.
+                    with self.lock:
+                        current = [
+                            (key, value) for key, value in writes.items()
+                            if self.generations.get(key[0], 0) == key[1]
+                        ]
+
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                        (key + (value,) for key, value in current if value is not None)
+                    )
+                    connection.executemany(
+                        "DELETE FROM entries WHERE store = ? AND generation = ? AND key = ?",
+                        (key for key, value in current if value is None)
+                    )
+                    connection.execute("COMMIT")
+
+                except sqlite3.OperationalError as error:
+                    # The database is locked by a long write, whose contents replace ours anyway
+                    if connection.in_transaction:
+                        connection.execute("ROLLBACK")
+
+                    log.adddebug("Failed to update share database %s: %s" % (self.filename, error))
+
+                with self.changed:
+                    # Keep entries that were changed again while writing
+                    for key, value in writes.items():
+                        if self.pending.get(key, MISSING) is value:
+                            del self.pending[key]
+
+                    self.changed.notify_all()
+
+        finally:
+            connection.close()
+
+            with self.changed:
+                self.writer = None
+                self.changed.notify_all()
+
+    def replace(self, sources):
+        """ Replace the contents of the databases in sources, a dict in format
+        { name: mapping, ... }. Every database is written as a new generation,
+        and all of them are switched to at once. Can be called from another
+        thread; until this returns, readers see the previous contents. """
+
+        connection = self._connect()
+        generations = {}
+
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+
+            for name, source in sources.items():
+                generation = connection.execute(
+                    "SELECT MAX(generation) FROM entries WHERE store = ?", (name,)
+                ).fetchone()[0]
+                generation = max(generation or 0, self.generations.get(name, 0)) + 1
+
+                connection.executemany(
+                    "INSERT INTO entries VALUES (?, ?, ?, ?)",
+                    ((name, generation, key, pickle.dumps(source[key], protocol=pickle.HIGHEST_PROTOCOL)) for key in source)
+                )
+                connection.execute("INSERT OR REPLACE INTO generations VALUES (?, ?)", (name, generation))
+                generations[name] = generation
+
+            connection.execute("COMMIT")
+
+            with self.lock:
+                self.generations.update(generations)
+
+                # Queued writes of the previous generations would only leave orphaned entries behind
+                for key in [key for key in self.pending if key[0] in generations]:
+                    del self.pending[key]
+
+                self.changed.notify_all()
+
+            # Every read looks up the current generation with the lock held, so nothing reads
+            # the previous generations after the switch above, and the writer thread skips them
+            connection.execute(PURGE)
+
+        except Exception:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+
+            raise
+
+        finally:
+            connection.close()
+
+
+class ShareStore(MutableMapping):
+    """ A share database, used like a shelve """
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.closed = False
+
+    def _query(self, query, parameters):
+        """ Called with the lock of the database held """
+
+        database = self.database
+
+        return database.connection.execute(
+            query, (self.name, database.generations.get(self.name, 0)) + parameters
+        ).fetchall()
+
+    def _execute(self, query, parameters):
+
+        with self.database.lock:
+            return self._query(query, parameters)
+
+    def _pending(self):
+        """ Returns the queued writes of the current generation, in format
+        { key: pickled value, or None if deleted, ... }. Called with the lock held. """
+
+        database = self.database
+        generation = database.generations.get(self.name, 0)
+
+        return {
+            key: value for (name, entrygeneration, key), value in database.pending.items()
+            if name == self.name and entrygeneration == generation
+        }
+
+    def _get(self, key):
+        """ Returns the pickled value of key, or MISSING. Called with the lock held. """
+
+        database = self.database
+        value = database.pending.get((self.name, database.generations.get(self.name, 0), key), MISSING)
+
+        if value is not MISSING:
+            return MISSING if value is None else value
+
+        rows = self._query("SELECT value FROM entries WHERE store = ? AND generation = ? AND key = ?", (key,))
+
+        if not rows:
+            return MISSING
+
+        return rows[0][0]
+
+    def __getitem__(self, key):
+
+        with self.database.lock:
+            value = self._get(key)
+
+        if value is MISSING:
+            raise KeyError(key)
+
+        return pickle.loads(value)
+
+    def __setitem__(self, key, value):
+
+        value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self.database.lock:
+            self.database.queue_write(self.name, key, value)
+
+    def __delitem__(self, key):
+
+        with self.database.lock:
+            if self._get(key) is MISSING:
+                raise KeyError(key)
+
+            self.database.queue_write(self.name, key, None)
+
+    def __contains__(self, key):
+
+        with self.database.lock:
+            return self._get(key) is not MISSING
+
+    def __iter__(self):
+
+        # Fetch all keys at once, the database may change while iterating
+        with self.database.lock:
+            keys = [row[0] for row in self._query("SELECT key FROM entries WHERE store = ? AND generation = ?", ())]
+            pending = self._pending()
+
+        if pending:
+            stored = set(keys)
+            keys = [key for key in keys if pending.get(key, MISSING) is not None]
+            keys.extend(key for key, value in pending.items() if value is not None and key not in stored)
+
+        yield from keys
+
+    def __len__(self):
+
+        with self.database.lock:
+            if not self._pending():
+                return self._query("SELECT COUNT(*) FROM entries WHERE store = ? AND generation = ?", ())[0][0]
+
+        return sum(1 for key in self)
+
+    def sync(self):
+        pass
+
+    def close(self):
+
+        if not self.closed:
+            self.closed = True
+            self.database.release()
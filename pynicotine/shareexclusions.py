@@ -0,0 +1,100 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module matches the names of shared folders and files against the
+share exclusion rules, in the same format as the download filters:
+a list of [pattern, escaped] pairs. Escaped patterns are globs (*, ?
+and [...]), other patterns are regular expressions. Patterns match the
+whole name of a folder or file, case insensitively.
+
+All rules are compiled into a single regular expression, and the rule
+that matched is only looked up to count how many entries it skipped.
+Rules referring to their own groups, e.g. with \1, are left out of it,
+since their group numbers change once combined, and checked one by one.
+"""
+
+import fnmatch
+import re
+
+# Backreferences and conditionals refer to groups by number or name. Escaped
+# backslashes also match, which only leaves such rules out of the combined
+# expression.
+GROUP_REFERENCE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+class ShareExclusions:
+
+    def __init__(self, rules=()):
+
+        self.rules = []
+        self.errors = {}
+
+        for pattern, escaped in rules:
+            if escaped:
+                regex = fnmatch.translate(pattern)
+            else:
+                regex = pattern
+
+            try:
+                self.rules.append((pattern, re.compile(regex, re.I)))
+            except re.error as error:
+                self.errors[pattern] = error
+
+        self.matcher = None
+
+        # Rules that aren't part of the combined expression
+        self.separate = [(pattern, rule) for pattern, rule in self.rules if GROUP_REFERENCE.search(rule.pattern)]
+        combined = [rule.pattern for pattern, rule in self.rules if not GROUP_REFERENCE.search(rule.pattern)]
+
+        if combined:
+            try:
+                self.matcher = re.compile("|".join("(?:%s)" % regex for regex in combined), re.I)
+            except re.error:
+                # Rules with inline global flags can't be combined, check them one by one
+                self.separate = self.rules
+
+        self.counts = {}
+
+    def match(self, name):
+        """ Returns True if a folder or file name is excluded """
+
+        if not self.rules:
+            return False
+
+        if self.matcher is not None and self.matcher.fullmatch(name) is None:
+            # Only the rules left out of the combined expression can still match
+            rules = self.separate
+        else:
+            rules = self.rules
+
+        for pattern, rule in rules:
+            if rule.fullmatch(name) is not None:
+                self.counts[pattern] = self.counts.get(pattern, 0) + 1
+                return True
+
+        return False
+
+    def reset_counts(self):
+        self.counts = {}
+
+    def get_counts(self):
+        """ Returns (pattern, number of skipped entries) pairs of the rules that
+        skipped anything since the counts were reset, in the order of the rules """
+
+        return [(pattern, self.counts[pattern]) for pattern, rule in self.rules if pattern in self.counts]
@@ -20,23 +20,66 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import multiprocessing
 import os
-import re
 import stat
-import string
 import sys
-import taglib
+import threading
+import time
 import _thread
 
+from array import array
+from collections import ChainMap
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from gettext import gettext as _
 
 from gi.repository import GLib
 
 from pynicotine import slskmessages
+from pynicotine.browsecache import BrowseCache
 from pynicotine.logfacility import log
+from pynicotine.metadatacache import MetadataCache
+from pynicotine.metadatareader import read_metadata
+from pynicotine.rescancheckpoint import RescanCheckpoint
+from pynicotine.rescanthrottle import RescanThrottle
+from pynicotine.rescanthrottle import set_low_io_priority
+from pynicotine.searchindex import FileTable
+from pynicotine.searchindex import get_index_words
+from pynicotine.searchindex import parse_search_term
+from pynicotine.shareexclusions import ShareExclusions
+from pynicotine.sharewatcher import ShareWatcher
+from pynicotine.sharewatcher import get_file_changes
+from pynicotine.sharewatcher import is_supported as sharewatcher_supported
 from pynicotine.utils import GetUserDirectories
 
 
+class ProgressBars:
+    """ Shows the progress of a rescan of both public and buddy shares in the
+    progress bars of both, which are only updated in the main loop """
+
+    def __init__(self, *bars):
+        self.bars = bars
+
+    def set_fraction(self, fraction):
+        for bar in self.bars:
+            bar.set_fraction(fraction)
+
+    def set_text(self, text):
+        for bar in self.bars:
+            bar.set_text(text)
+
+    def set_show_text(self, show_text):
+        for bar in self.bars:
+            bar.set_show_text(show_text)
+
+    def show(self):
+        for bar in self.bars:
+            bar.show()
+
+
 class Shares:
 
     def __init__(self, np):
@@ -44,11 +87,77 @@ class Shares:
         self.config = self.np.config
         self.queue = self.np.queue
         self.LogMessage = self.np.logMessage
+        self.metadatacache = MetadataCache(os.path.join(self.config.data_dir, "metadata.db"))
+        self.browsecaches = {
+            "normal": BrowseCache(self.config.data_dir, "streams"),
+            "buddy": BrowseCache(self.config.data_dir, "buddystreams")
+        }
         self.CompressedSharesBuddy = self.CompressedSharesNormal = None
         self.CompressShares("normal")
         self.CompressShares("buddy")
         self.newbuddyshares = self.newnormalshares = False
-        self.translatepunctuation = str.maketrans(dict.fromkeys(string.punctuation, ' '))
+        self.watcher = None
+        self.compacting = set()
+
+        # Folders changed while a rescan is running, in format { sharestype: set(folder, ...), ... }.
+        # Their changes only reach the previous shares, and are read again once the rescan is done.
+        self.rescanchanges = {}
+
+        # Worker processes reading metadata for rescans, started on first use
+        self.metadatapool = None
+        self.metadatapoollock = threading.Lock()
+
+        # Bumped when a rescan starts, stops reading metadata in the background for older rescans
+        self.metadatascans = {"normal": 0, "buddy": 0}
+        self.throttle = RescanThrottle(busy=self.uploadsActive)
+        self.exclusions = None
+        self.loadShareExclusions()
+        self.startShareWatcher()
+
+    def close(self):
+        self.stopShareWatcher()
+        self.cancelMetadataScans("normal", "buddy")
+        self.stopMetadataPool()
+        self.metadatacache.close()
+
+    def getMetadataPool(self, numworkers):
+        """ Returns the pool of worker processes that read metadata, with numworkers
+        workers. The pool is kept for later rescans. Workers are spawned instead of
+        forked, since forking copies the locks held by the threads of the process. """
+
+        with self.metadatapoollock:
+            pool, workers = self.metadatapool or (None, 0)
+
+            if pool is not None and workers == numworkers:
+                return pool
+
+            if pool is not None:
+                pool.shutdown(wait=False)
+
+            pool = ProcessPoolExecutor(max_workers=numworkers, mp_context=multiprocessing.get_context("spawn"))
+            self.metadatapool = (pool, numworkers)
+
+            return pool
+
+    def resetMetadataPool(self, pool):
+        """ Drop a pool whose worker processes died, the next rescan starts a new one """
+
+        with self.metadatapoollock:
+            if self.metadatapool is not None and self.metadatapool[0] is pool:
+                self.metadatapool = None
+
+    def stopMetadataPool(self):
+
+        with self.metadatapoollock:
+            if self.metadatapool is not None:
+                self.metadatapool[0].shutdown(wait=False, cancel_futures=True)
+                self.metadatapool = None
+
+    def normalizeVirtualPath(self, path):
+        """ Returns a virtual path the way folders are stored in the shares database,
+        without empty components, trailing backslashes or forward slashes """
+
+        return '\\'.join(part for part in path.replace('/', '\\').split('\\') if part)
 
     def real2virtual(self, path):
         path = os.path.normpath(path)
@@ -88,6 +197,14 @@ class Shares:
 
         return mapping
 
+    def _isInDirectories(self, folder, directories):
+
+        for directory in directories:
+            if folder == directory or folder.startswith(directory.rstrip(os.sep) + os.sep):
+                return True
+
+        return False
+
     def logMessage(self, message, debugLevel=0):
         if self.LogMessage is not None:
             GLib.idle_add(self.LogMessage, message, debugLevel)
@@ -102,17 +219,17 @@ class Shares:
 
         if conf["transfers"]["enablebuddyshares"] and conf["transfers"]["friendsonly"]:
             shared_db = "bsharedfiles"
-            index_db = "bfileindex"
+            index_db = "bsearchindex"
         else:
             shared_db = "sharedfiles"
-            index_db = "fileindex"
+            index_db = "searchindex"
 
         try:
             sharedfolders = len(conf["transfers"][shared_db])
-            sharedfiles = len(conf["transfers"][index_db])
         except TypeError:
             sharedfolders = len(list(conf["transfers"][shared_db]))
-            sharedfiles = len(list(conf["transfers"][index_db]))
+
+        sharedfiles = len(conf["transfers"][index_db])
 
         self.queue.put(slskmessages.SharedFoldersFiles(sharedfolders, sharedfiles))
 
@@ -141,8 +258,13 @@ class Shares:
             files = self.config.sections["transfers"]["bsharedfiles"]
             filesstreams = self.config.sections["transfers"]["bsharedfilesstreams"]
 
+        scans = self.cancelMetadataScans(type)
+        checkpoint = self.getRescanCheckpoint(type)
+        self.setRescanLimits()
+        exclusions = self.loadShareExclusions()
+
         try:
-            files, streams, wordindex, fileindex, mtimes = self.rescandirs(
+            files, streams, wordindex, fileindex, mtimes, pending = self.rescandirs(
                 msg.shared,
                 mtimes,
                 files,
@@ -150,13 +272,68 @@ class Shares:
                 msg.yieldfunction,
                 self.np.frame.SharesProgress,
                 name=name,
-                rebuild=rebuild
+                rebuild=rebuild,
+                checkpoint=checkpoint,
+                exclusions=exclusions
+            )
+
+            written = self.np.frame.RescanFinished(
+                files, streams, wordindex, fileindex, mtimes,
+                type, changed=self.streamsChanged(streams, filesstreams)
+            )
+
+            # The checkpoint is only dropped once the new shares are written and switched to
+            if written:
+                GLib.idle_add(checkpoint.remove)
+
+        except Exception as ex:
+            config_dir, data_dir = GetUserDirectories()
+            log.addwarning(
+                _("Failed to rebuild share, serious error occurred. If this problem persists delete %s/*.db and try again. If that doesn't help please file a bug report with the stack trace included (see terminal output after this message). Technical details: %s") % (data_dir, ex)
+            )
+            raise
+
+        finally:
+            checkpoint.close()
+
+        if pending:
+            self.readPendingMetadata(pending, scans)
+
+    def RescanAllShares(self, msg, rebuild=False):
+
+        transfers = self.config.sections["transfers"]
+        scans = self.cancelMetadataScans("normal", "buddy")
+        checkpoint = self.getRescanCheckpoint("all")
+        self.setRescanLimits()
+        exclusions = self.loadShareExclusions()
+
+        try:
+            (files, streams, wordindex, fileindex, mtimes,
+             bfiles, bstreams, bwordindex, bfileindex, bmtimes, pending) = self.rescanAllDirs(
+                msg.shared,
+                msg.buddyshared,
+                ChainMap(transfers["bsharedmtimes"], transfers["sharedmtimes"]),
+                ChainMap(transfers["bsharedfiles"], transfers["sharedfiles"]),
+                ChainMap(transfers["bsharedfilesstreams"], transfers["sharedfilesstreams"]),
+                msg.yieldfunction,
+                ProgressBars(self.np.frame.SharesProgress, self.np.frame.BuddySharesProgress),
+                rebuild=rebuild,
+                checkpoint=checkpoint,
+                exclusions=exclusions
             )
 
-            self.np.frame.RescanFinished(
+            written = self.np.frame.RescanFinished(
                 files, streams, wordindex, fileindex, mtimes,
-                type
+                "normal", changed=self.streamsChanged(streams, transfers["sharedfilesstreams"])
+            )
+            bwritten = self.np.frame.RescanFinished(
+                bfiles, bstreams, bwordindex, bfileindex, bmtimes,
+                "buddy", changed=self.streamsChanged(bstreams, transfers["bsharedfilesstreams"])
             )
+
+            if written and bwritten:
+                GLib.idle_add(checkpoint.remove)
+
         except Exception as ex:
             config_dir, data_dir = GetUserDirectories()
             log.addwarning(
@@ -164,6 +341,70 @@ class Shares:
             )
             raise
 
+        finally:
+            checkpoint.close()
+
+        if pending:
+            self.readPendingMetadata(pending, scans)
+
+    def setRescanLimits(self):
+        """ Called from the rescan thread when a rescan starts """
+
+        transfers = self.config.sections["transfers"]
+
+        self.throttle.set_limits(
+            filesrate=transfers["rescanfilesrate"],
+            bytesrate=transfers["rescanmbrate"] * 1024 * 1024,
+            idleonly=transfers["rescanidleonly"]
+        )
+
+        # Metadata reading threads started by the rescan thread inherit its priority
+        if transfers["rescanlowpriority"] and not set_low_io_priority():
+            log.adddebug("Failed to lower the I/O priority of the rescan thread")
+
+    def loadShareExclusions(self):
+        """ Compile the share exclusion rules. Called when a rescan starts, returns the rules
+        for the rescan, which counts the entries they skip. Folders read for the share
+        watcher are checked against a copy of their own. """
+
+        rules = self.config.sections["transfers"]["shareexclusions"]
+        exclusions = ShareExclusions(rules)
+
+        for pattern, error in exclusions.errors.items():
+            log.addwarning(_("Invalid share exclusion rule %(rule)s: %(error)s") % {'rule': pattern, 'error': error})
+
+        self.exclusions = ShareExclusions(rules)
+        return exclusions
+
+    def reportShareExclusions(self, exclusions):
+
+        for pattern, count in exclusions.get_counts():
+            self.logMessage(_("Share exclusion rule %(rule)s skipped %(num)i folders and files") % {
+                'rule': pattern,
+                'num': count
+            })
+
+    def uploadsActive(self):
+        """ Called from the rescan threads in idle only mode """
+
+        if self.np.transfers is None:
+            return False
+
+        return any(upload.status == "Transferring" for upload in self.np.transfers.uploads[:])
+
+    def getRescanCheckpoint(self, scantype):
+        """ Returns the checkpoint of a rescan of the public ("normal"), buddy ("buddy")
+        or both ("all") shares, with the folders read by an interrupted rescan loaded """
+
+        names = {"normal": "shares", "buddy": "buddyshares", "all": "allshares"}
+        checkpoint = RescanCheckpoint(os.path.join(self.config.data_dir, names[scantype] + ".checkpoint"))
+        num_folders = checkpoint.load()
+
+        if num_folders:
+            self.logMessage(_("Resuming interrupted rescan, %(num)i folders were already read") % {'num': num_folders})
+
+        return checkpoint
+
     def CompressShares(self, sharestype):
 
         if sharestype == "normal":
@@ -178,13 +419,41 @@ class Shares:
             return
 
         m = slskmessages.SharedFileList(None, streams)
-        _thread.start_new_thread(m.makeNetworkMessage, (0, True))
+        browsecache = self.browsecaches[sharestype]
+
+        # Reuse the message stored for the current generation of the share
+        m.built = browsecache.load()
+
+        if m.built is None:
+            _thread.start_new_thread(self._CompressShares, (m, browsecache, browsecache.generation))
 
         if sharestype == "normal":
             self.CompressedSharesNormal = m
         elif sharestype == "buddy":
             self.CompressedSharesBuddy = m
 
+    def _CompressShares(self, m, browsecache, generation):
+
+        # Compress the shares straight to disk, and map the result instead of keeping it in memory
+        if browsecache.store(m.iterCompressedChunks(), generation):
+            m.built = browsecache.load()
+
+        if m.built is None:
+            m.makeNetworkMessage(0, True)
+
+    def streamsChanged(self, newstreams, oldstreams):
+        """ Check if a rescan changed any folder streams, in which case the stored
+        shared file list message is outdated """
+
+        if len(newstreams) != len(oldstreams):
+            return True
+
+        for virtualdir, stream in newstreams.items():
+            if oldstreams.get(virtualdir) != stream:
+                return True
+
+        return False
+
     def GetSharedFileList(self, msg):
 
         self.logMessage("%s %s" % (msg.__class__, vars(msg)), 4)
@@ -273,65 +542,34 @@ class Shares:
             self.queue.put(slskmessages.MessageUser(username, "[Automatic Message] " + reason))
             return
 
+        transfers = self.config.sections["transfers"]
+
         if checkuser == 1:
-            shares = self.config.sections["transfers"]["sharedfiles"]
+            sharedstreams = (transfers["sharedfilesstreams"],)
         elif checkuser == 2:
-            shares = self.config.sections["transfers"]["bsharedfiles"]
+            sharedstreams = (transfers["bsharedfilesstreams"], transfers["sharedfilesstreams"])
         else:
             self.queue.put(slskmessages.TransferResponse(msg.conn.conn, 0, reason=reason, req=0))
-            shares = {}
-
-        if checkuser:
-            if msg.dir in shares:
-                self.queue.put(slskmessages.FolderContentsResponse(msg.conn.conn, msg.dir, shares[msg.dir]))
-            elif msg.dir.rstrip('\\') in shares:
-                self.queue.put(slskmessages.FolderContentsResponse(msg.conn.conn, msg.dir, shares[msg.dir.rstrip('\\')]))
-            else:
-                if checkuser == 2:
-                    shares = self.config.sections["transfers"]["sharedfiles"]
-                    if msg.dir in shares:
-                        self.queue.put(slskmessages.FolderContentsResponse(msg.conn.conn, msg.dir, shares[msg.dir]))
-                    elif msg.dir.rstrip("\\") in shares:
-                        self.queue.put(slskmessages.FolderContentsResponse(msg.conn.conn, msg.dir, shares[msg.dir.rstrip("\\")]))
-
-        self.logMessage("%s %s" % (msg.__class__, vars(msg)), 4)
-
-    def create_search_result_list(self, searchterm, wordindex, maxresults=50):
-
-        try:
-            """ Stage 1: Check if each word in the search term is included in our word index.
-            If this is the case, we select the word that has the most file matches in our
-            word index. If not, exit, since we don't have relevant results. """
-
-            largest = 0
+            sharedstreams = ()
 
-            for i in re.finditer(r'\S+', searchterm):
-                i = i.group(0)
-
-                if i not in wordindex:
-                    return
+        # Folder streams are stored under normalized virtual paths, and already hold
+        # the packed file list the response needs
+        virtualdir = self.normalizeVirtualPath(msg.dir)
 
-                list_size = len(wordindex[i])
+        for streams in sharedstreams:
+            stream = streams.get(virtualdir)
 
-                if list_size > largest:
-                    largest = list_size
-                    largest_key = i
-
-            """ Stage 2: Start with the word that has the most file matches, which we selected
-            in the previous step, and gradually remove matches that other words in the search
-            term don't have. Return the remaining matches, if any. """
-
-            results = wordindex[largest_key]
-            searchterm.replace(largest_key, '')
+            if stream is not None:
+                self.queue.put(slskmessages.FolderContentsResponse(msg.conn.conn, msg.dir, stream=stream))
+                break
 
-            for i in re.finditer(r'\S+', searchterm):
-                results = set(results).intersection(wordindex[i.group(0)])
+        self.logMessage("%s %s" % (msg.__class__, vars(msg)), 4)
 
-            return results
+    def create_search_result_list(self, words, excluded, searchindex, maxresults=50):
+        """ Returns the numbers of the first maxresults files in searchindex that match
+        every word in words, and none of the words in excluded """
 
-        except ValueError:
-            # DB is closed, perhaps when rescanning share or closing Nicotine+
-            return
+        return searchindex.query(words, excluded, maxresults)
 
     def processSearchRequest(self, searchterm, user, searchid, direct=0):
 
@@ -355,9 +593,10 @@ class Shares:
         if maxresults == 0:
             return
 
-        # Don't count excluded words as matches (words starting with -)
+        # Words starting with - exclude files containing them
         # Strip punctuation
-        searchterm = re.sub(r'(\s)-\w+', r'\1', searchterm).lower().translate(self.translatepunctuation).strip()
+        words, excluded = parse_search_term(searchterm, self.config.sections["searches"]["wildcard_search"])
+        searchterm = ' '.join(words)
 
         if len(searchterm) < self.config.sections["searches"]["min_search_chars"]:
             # Don't send search response if search term contains too few characters
@@ -369,19 +608,19 @@ class Shares:
             return
 
         if checkuser == 2:
-            wordindex = self.config.sections["transfers"]["bwordindex"]
+            searchindex = self.config.sections["transfers"]["bsearchindex"]
         else:
-            wordindex = self.config.sections["transfers"]["wordindex"]
+            searchindex = self.config.sections["transfers"]["searchindex"]
 
         # Find common file matches for each word in search term
-        resultlist = self.create_search_result_list(searchterm, wordindex, maxresults)
+        resultlist = self.create_search_result_list(words, excluded, searchindex, maxresults)
 
         if not resultlist:
             return
 
         if self.np.transfers is not None:
 
-            numresults = min(len(resultlist), maxresults)
+            numresults = len(resultlist)
             queuesizes = self.np.transfers.getUploadQueueSizes()
             slotsavail = self.np.transfers.allowNewUploads()
 
@@ -390,17 +629,12 @@ class Shares:
             else:
                 geoip = 0
 
-            if checkuser == 2:
-                fileindex = self.config.sections["transfers"]["bfileindex"]
-            else:
-                fileindex = self.config.sections["transfers"]["fileindex"]
-
             fifoqueue = self.config.sections["transfers"]["fifoqueue"]
 
             message = slskmessages.FileSearchResult(
                 None,
                 self.config.sections["server"]["login"],
-                geoip, searchid, resultlist, fileindex, slotsavail,
+                geoip, searchid, resultlist, searchindex, slotsavail,
                 self.np.speed, queuesizes, fifoqueue, numresults
             )
 
@@ -422,16 +656,18 @@ class Shares:
                     }, 2)
 
     # Rescan directories in shared databases
-    def rescandirs(self, shared, oldmtimes, oldfiles, sharedfilesstreams, yieldfunction, progress=None, name="", rebuild=False):
+    def rescandirs(self, shared, oldmtimes, oldfiles, sharedfilesstreams, yieldfunction, progress=None, name="", rebuild=False, checkpoint=None, exclusions=None):
         """
         Check for modified or new files via OS's last mtime on a directory,
-        or, if rebuild is True, all directories
+        or, if rebuild is True, all directories. Returns the new shares, and the
+        folders whose metadata is left to be read by readPendingMetadata.
         """
 
         GLib.idle_add(progress.set_fraction, 0.0)
+        GLib.idle_add(progress.set_text, None)
+        GLib.idle_add(progress.set_show_text, True)
         GLib.idle_add(progress.show)
 
-        # returns dict in format:  { Directory : mtime, ... }
         shared_directories = [x[1] for x in shared]
 
         try:
@@ -441,11 +677,31 @@ class Shares:
 
         self.logMessage(_("%(num)s folders found before rescan, rebuilding...") % {"num": num_folders})
 
-        newmtimes = self.getDirsMtimes(shared_directories, yieldfunction)
+        # Folders are read while the shared directories are walked
+        # newmtimes is filled in format:  { Directory : mtime, ... }
+        newmtimes = {}
+        if exclusions is None:
+            exclusions = self.loadShareExclusions()
+
+        folders = self.iterSharedFolders(shared_directories, yieldfunction, exclusions)
 
         # Get list of files
         # returns dict in format { Directory : { File : metadata, ... }, ... }
-        newsharedfiles = self.getFilesList(newmtimes, oldmtimes, oldfiles, yieldfunction, progress, rebuild)
+        # A rebuild of every shared directory looks up all shared files in the metadata cache,
+        # other entries belong to files that are gone and can be dropped
+        prunecache = rebuild and set(shared_directories) >= set(x[1] for x in self._virtualmapping())
+        pending = self.getPendingFolders()
+        self.metadatacache.begin_scan()
+
+        try:
+            newsharedfiles = self.getFilesList(folders, newmtimes, oldmtimes, oldfiles, yieldfunction, progress, rebuild,
+                                               missingmetadata=pending, checkpoint=checkpoint)
+        finally:
+            # Files of folders restored from the checkpoint weren't looked up in the cache
+            restored = checkpoint is not None and checkpoint.restored
+            self.metadatacache.end_scan(prune=prunecache and pending is None and not restored)
+
+        self.reportShareExclusions(exclusions)
 
         # Pack shares data
         # returns dict in format { Directory : hex string of files+metadata, ... }
@@ -454,141 +710,463 @@ class Shares:
         # Update Search Index
         # newwordindex is a dict in format {word: [num, num, ..], ... } with num matching
         # keys in newfileindex
-        # newfileindex is a dict in format { num: (path, size, (bitrate, vbr), length), ... }
+        # newfileindex is a FileTable of files in format (path, size, (bitrate, vbr), length)
         newwordindex, newfileindex = self.getFilesIndex(newmtimes, newsharedfiles, yieldfunction, progress)
 
+        self.markPendingFolders(newmtimes, pending)
+
         self.logMessage(_("%(num)s folders found after rescan") % {"num": len(newmtimes)})
 
-        return newsharedfiles, newsharedfilesstreams, newwordindex, newfileindex, newmtimes
+        return newsharedfiles, newsharedfilesstreams, newwordindex, newfileindex, newmtimes, pending
 
-    # Get Modification Times
-    def getDirsMtimes(self, dirs, yieldcall=None):
+    def rescanAllDirs(self, shared, buddyshared, oldmtimes, oldfiles, sharedfilesstreams, yieldfunction, progress=None, rebuild=False, checkpoint=None, exclusions=None):
+        """
+        Rescan public and buddy shares at once. Every folder is only walked and read
+        once, and the public share is built from the results for folders in it.
+        Buddy shares include all public folders. The two search indexes are still
+        separate, see getCombinedFilesIndex().
+        """
 
-        list = {}
+        GLib.idle_add(progress.set_fraction, 0.0)
+        GLib.idle_add(progress.set_text, None)
+        GLib.idle_add(progress.set_show_text, True)
+        GLib.idle_add(progress.show)
 
-        for folder in dirs:
+        public_directories = [x[1] for x in shared]
+        shared_directories = public_directories[:]
 
-            try:
-                if self.hiddenCheck(folder):
-                    continue
+        for directory in (x[1] for x in buddyshared):
+            if directory not in shared_directories:
+                shared_directories.append(directory)
 
-                mtime = os.path.getmtime(folder)
-                list[folder] = mtime
+        self.logMessage(_("Rescanning public and buddy shares in a single pass"))
 
-                for entry in os.scandir(folder):
-                    if entry.is_dir():
+        newmtimes = {}
+        if exclusions is None:
+            exclusions = self.loadShareExclusions()
 
-                        path = entry.path
+        folders = self.iterSharedFolders(shared_directories, yieldfunction, exclusions)
 
-                        try:
-                            mtime = entry.stat().st_mtime
-                        except OSError as errtuple:
-                            message = _("Error while scanning %(path)s: %(error)s") % {
-                                'path': path,
-                                'error': errtuple
-                            }
-
-                            print(str(message))
-                            self.logMessage(message)
-                            continue
+        prunecache = rebuild and set(shared_directories) >= set(x[1] for x in self._virtualmapping())
+        pending = self.getPendingFolders()
+        self.metadatacache.begin_scan()
 
-                        list[path] = mtime
-                        dircontents = self.getDirsMtimes([path])
-                        for k in dircontents:
-                            list[k] = dircontents[k]
+        try:
+            newsharedfiles = self.getFilesList(folders, newmtimes, oldmtimes, oldfiles, yieldfunction, progress, rebuild,
+                                               missingmetadata=pending, checkpoint=checkpoint)
+        finally:
+            # Files of folders restored from the checkpoint weren't looked up in the cache
+            restored = checkpoint is not None and checkpoint.restored
+            self.metadatacache.end_scan(prune=prunecache and pending is None and not restored)
+
+        self.reportShareExclusions(exclusions)
+
+        newsharedfilesstreams = self.getFilesStreams(newmtimes, oldmtimes, sharedfilesstreams, newsharedfiles, rebuild, yieldfunction)
+        self.markPendingFolders(newmtimes, pending)
+
+        # Folders below a public shared directory also belong to the public share
+        publicmtimes = {}
+
+        for folder in newmtimes:
+            if self._isInDirectories(folder, public_directories):
+                publicmtimes[folder] = newmtimes[folder]
+
+        publicfiles = {}
+        publicstreams = {}
+
+        for folder in publicmtimes:
+            virtualdir = self.real2virtual(folder)
+
+            if virtualdir in newsharedfiles:
+                publicfiles[virtualdir] = newsharedfiles[virtualdir]
+                publicstreams[virtualdir] = newsharedfilesstreams[virtualdir]
+
+        wordindex, fileindex, bwordindex, bfileindex = self.getCombinedFilesIndex(
+            newmtimes, publicmtimes, newsharedfiles, yieldfunction, progress
+        )
+
+        self.logMessage(_("%(num)s folders found after rescan") % {"num": len(newmtimes)})
+
+        return (publicfiles, publicstreams, wordindex, fileindex, publicmtimes,
+                newsharedfiles, newsharedfilesstreams, bwordindex, bfileindex, newmtimes, pending)
+
+    def getPendingFolders(self):
+        """ Returns an empty set to collect folders with files that have no cached
+        metadata in, if the metadata of new files is read after the rescan """
+
+        if self.config.sections["transfers"]["lazymetadata"]:
+            return set()
+
+        return None
+
+    def markPendingFolders(self, mtimes, pending):
+        """ Store folders whose metadata is still missing without their mtime, so
+        the next rescan reads them again if it isn't filled in before quitting """
+
+        if not pending:
+            return
+
+        for folder in pending:
+            if folder in mtimes:
+                mtimes[folder] = 0
+
+        self.logMessage(_("Shared files in %(num)i folders are available, their metadata is read in the background") % {
+            'num': len(pending)
+        })
+
+    def iterSharedFolders(self, dirs, yieldcall=None, exclusions=None):
+        """ Walk the shared directories, and yield a (folder, mtime, files) tuple for every
+        folder as soon as it is read, with files being the DirEntry of every file in it,
+        or None if the folder couldn't be read.
+        Hidden and excluded folders are skipped along with everything below them, so
+        folders further down only need their own name checked. Folders that are their own ancestor through
+        a symlink are skipped, by the (device, inode) of the folders above them. """
+
+        for root in dirs:
+
+            try:
+                if self.excludedFolderCheck(root, exclusions):
+                    continue
+
+                rootstat = os.stat(root)
 
-                    if yieldcall is not None:
-                        yieldcall()
             except OSError as errtuple:
-                message = _("Error while scanning folder %(path)s: %(error)s") % {'path': folder, 'error': errtuple}
+                message = _("Error while scanning folder %(path)s: %(error)s") % {'path': root, 'error': errtuple}
                 print(str(message))
                 self.logMessage(message)
                 continue
 
-        return list
+            # Folders left to read, with the (device, inode) pairs of their ancestors
+            stack = [(root, rootstat.st_mtime, self.getFolderId(rootstat), frozenset())]
+
+            while stack:
+                folder, mtime, folderid, ancestors = stack.pop()
+
+                if folderid is not None:
+                    ancestors = ancestors | {folderid}
+
+                files = []
+                subfolders = []
+
+                try:
+                    for entry in os.scandir(folder):
+
+                        if yieldcall is not None:
+                            yieldcall()
+
+                        if self.hiddenEntryCheck(entry, exclusions):
+                            continue
+
+                        if entry.is_dir():
+                            try:
+                                entrystat = entry.stat()
+                            except OSError as errtuple:
+                                message = _("Error while scanning %(path)s: %(error)s") % {
+                                    'path': entry.path,
+                                    'error': errtuple
+                                }
+
+                                print(str(message))
+                                self.logMessage(message)
+                                continue
+
+                            entryid = self.getFolderId(entrystat)
+
+                            if entryid in ancestors:
+                                log.adddebug(_("Skipping folder %(path)s, it links to a folder above it") % {
+                                    'path': entry.path
+                                })
+                                continue
+
+                            subfolders.append((entry.path, entrystat.st_mtime, entryid, ancestors))
+
+                        elif entry.is_file():
+                            files.append(entry)
+
+                except OSError as errtuple:
+                    message = _("Error while scanning folder %(path)s: %(error)s") % {'path': folder, 'error': errtuple}
+                    print(str(message))
+                    self.logMessage(message)
+                    files = None
+
+                # Subfolders are read in the order they were listed, right after their parent
+                subfolders.reverse()
+                stack.extend(subfolders)
+
+                yield folder, mtime, files
+
+    def getFolderId(self, folderstat):
+        """ Returns the (device, inode) pair identifying a folder, or None where
+        the platform doesn't report inodes """
+
+        if not folderstat.st_ino:
+            # DirEntry.stat() on Windows
+            return None
+
+        return (folderstat.st_dev, folderstat.st_ino)
 
     # Check for new files
-    def getFilesList(self, mtimes, oldmtimes, oldlist, yieldcall=None, progress=None, rebuild=False):
-        """ Get a list of files with their filelength, bitrate and track length in seconds """
+    def getFilesList(self, folders, mtimes, oldmtimes, oldlist, yieldcall=None, progress=None, rebuild=False,
+                     missingmetadata=None, checkpoint=None):
+        """ Get a list of files with their filelength, bitrate and track length in seconds.
+        Folders are read from the folders iterable returned by iterSharedFolders while the
+        walk goes on, and their mtimes are stored in mtimes. When more than one rescan worker
+        is configured, the metadata of their files is parsed by a pool of worker processes,
+        since taglib holds the GIL while it parses a file.
+        If missingmetadata is a set, only cached metadata is used, and folders with files
+        that still need their metadata read are added to it.
+        Folders read by an interrupted rescan are taken from checkpoint, and folders read
+        now are added to it. """
 
         list = {}
         count = 0
         lastpercent = 0.0
 
-        for folder in mtimes:
+        # The number of folders isn't known until the walk is done, assume it didn't change much
+        try:
+            num_folders = len(oldmtimes)
+        except TypeError:
+            num_folders = 0
+
+        numthreads = self.config.sections["transfers"]["rescanthreads"]
+        executor = None
+
+        if numthreads > 1 and missingmetadata is None:
+            executor = self.getMetadataPool(numthreads)
+
+        # Folders waiting for their metadata, in the order they were enumerated
+        pending = deque()
+        numpending = 0
+        maxpending = numthreads * 64
+
+        starttime = lastreport = time.time()
+        numfiles = 0
+
+        for folder, mtime, entries in folders:
+
+            mtimes[folder] = mtime
+            futures = []
+            complete = False
 
             try:
                 count += 1
 
                 if progress:
                     # Truncate the percentage to two decimal places to avoid sending data to the GUI thread too often
-                    percent = float("%.2f" % (float(count) / len(mtimes) * 0.75))
+                    percent = float("%.2f" % (float(count) / max(num_folders, count) * 0.75))
 
                     if percent > lastpercent and percent <= 1.0:
                         GLib.idle_add(progress.set_fraction, percent)
                         lastpercent = percent
 
                 if not rebuild and folder in oldmtimes:
-                    if mtimes[folder] == oldmtimes[folder]:
-                        if os.path.exists(folder):
-                            try:
-                                virtualdir = self.real2virtual(folder)
-                                list[virtualdir] = oldlist[virtualdir]
-                                continue
-                            except KeyError:
-                                log.adddebug(_("Inconsistent cache for '%(vdir)s', rebuilding '%(dir)s'") % {
-                                    'vdir': virtualdir,
-                                    'dir': folder
-                                })
-                        else:
-                            log.adddebug(_("Dropping missing folder %(dir)s") % {'dir': folder})
+                    if mtime == oldmtimes[folder]:
+                        try:
+                            virtualdir = self.real2virtual(folder)
+                            list[virtualdir] = oldlist[virtualdir]
                             continue
+                        except KeyError:
+                            log.adddebug(_("Inconsistent cache for '%(vdir)s', rebuilding '%(dir)s'") % {
+                                'vdir': virtualdir,
+                                'dir': folder
+                            })
 
                 virtualdir = self.real2virtual(folder)
+
+                if checkpoint is not None:
+                    files = checkpoint.get(folder, mtimes[folder])
+
+                    if files is not None:
+                        list[virtualdir] = files
+                        continue
+
                 list[virtualdir] = []
+                missing = [] if missingmetadata is not None else None
 
-                for entry in os.scandir(folder):
+                if entries is None:
+                    continue
 
-                    if entry.is_file():
-                        filename = entry.name
+                if executor is not None:
+                    # Replaces a pool whose worker processes died
+                    executor = self.getMetadataPool(numthreads)
 
-                        if self.hiddenCheck(folder, filename):
-                            continue
+                for entry in entries:
+                    filename = entry.name
+
+                    if executor is not None:
+                        futures.append(self.submitFileInfo(executor, filename, entry.path, self.throttle))
+                        continue
+
+                    # Get the metadata of the file
+                    data = self.getFileInfo(filename, entry.path, missing, self.throttle)
+                    numfiles += 1
 
-                        # Get the metadata of the file
-                        data = self.getFileInfo(filename, entry.path)
-                        if data is not None:
-                            list[virtualdir].append(data)
+                    if data is not None:
+                        list[virtualdir].append(data)
 
                     if yieldcall is not None:
                         yieldcall()
+
+                if missing:
+                    missingmetadata.add(folder)
+                else:
+                    complete = True
+
             except OSError as errtuple:
                 message = _("Error while scanning folder %(path)s: %(error)s") % {'path': folder, 'error': errtuple}
                 print(str(message))
                 self.logMessage(message)
-                continue
+
+            if futures:
+                pending.append((virtualdir, futures, folder if complete else None))
+                numpending += len(futures)
+
+            elif complete and checkpoint is not None:
+                checkpoint.add(folder, mtimes[folder], list[virtualdir])
+
+            # Collect the metadata of the oldest folders, to keep the amount of queued files bounded
+            while numpending > maxpending:
+                collected = self.collectFileInfo(list, *pending.popleft(), mtimes=mtimes, checkpoint=checkpoint)
+                numpending -= collected
+                numfiles += collected
+
+            if checkpoint is not None and checkpoint.save():
+                # Keep the metadata of folders read in part, too
+                self.metadatacache.sync()
+
+            if progress and time.time() - lastreport >= 1:
+                lastreport = time.time()
+                self.reportScanSpeed(progress, numfiles, lastreport - starttime)
+
+        while pending:
+            numfiles += self.collectFileInfo(list, *pending.popleft(), mtimes=mtimes, checkpoint=checkpoint)
+
+        elapsed = time.time() - starttime
+
+        if numfiles:
+            self.logMessage(_("Read metadata of %(num)i files in %(time).1f seconds (%(speed)i files/s)") % {
+                'num': numfiles,
+                'time': elapsed,
+                'speed': numfiles / max(elapsed, 0.001)
+            })
 
         return list
 
+    def collectFileInfo(self, list, virtualdir, futures, folder=None, mtimes=None, checkpoint=None):
+        """ Add the metadata read by the rescan workers to a folder, in the order the files
+        were enumerated. If folder is set, it was read in full and is added to checkpoint.
+        Returns the number of files processed. """
+
+        for future in futures:
+            data = future.result()
+
+            if data is None:
+                continue
+
+            name, size, cachekey, metadata = data
+
+            if isinstance(metadata, Future):
+                try:
+                    metadata = metadata.result()
+
+                except BrokenProcessPool:
+                    # A worker process died, e.g. on a broken file. Don't cache the missing
+                    # metadata, so that the next rescan reads the file again.
+                    list[virtualdir].append((name, size, None, None))
+                    continue
+
+                except Exception as errtuple:
+                    message = _("Error while scanning file %(path)s: %(error)s") % {
+                        'path': os.path.join(self.virtual2real(virtualdir), name),
+                        'error': errtuple
+                    }
+                    self.logMessage(message)
+                    continue
+
+                self.metadatacache.set(cachekey, metadata)
+
+            list[virtualdir].append((name, size) + metadata)
+
+        if folder is not None and checkpoint is not None:
+            checkpoint.add(folder, mtimes[folder], list[virtualdir])
+
+        return len(futures)
+
+    def reportScanSpeed(self, progress, numfiles, elapsed):
+
+        if elapsed <= 0:
+            return
+
+        GLib.idle_add(progress.set_text, _("%(speed)i files/s") % {'speed': numfiles / elapsed})
+
+    def submitFileInfo(self, executor, name, pathname, throttle=None):
+        """ Like getFileInfo, but the metadata of files that aren't cached is parsed in the
+        worker processes of executor. Returns a future of a (name, size, cachekey, metadata)
+        tuple, where metadata is a future itself while the file is parsed. """
+
+        future = Future()
+
+        try:
+            filestat = os.stat(pathname)
+            size = filestat.st_size
+            cachekey = self.metadatacache.get_key(filestat)
+            metadata = self.metadatacache.get(cachekey)
+
+            if metadata is None and size > 0:
+                if throttle is not None:
+                    throttle.wait(size)
+
+                try:
+                    metadata = executor.submit(read_metadata, pathname)
+
+                except BrokenProcessPool:
+                    # The following folders are read by a new pool
+                    self.resetMetadataPool(executor)
+                    metadata = (None, None)
+
+            elif metadata is None:
+                metadata = (None, None)
+                self.metadatacache.set(cachekey, metadata)
+
+            future.set_result((name, size, cachekey, metadata))
+
+        except Exception as errtuple:
+            message = _("Error while scanning file %(path)s: %(error)s") % {'path': pathname, 'error': errtuple}
+            self.logMessage(message)
+            future.set_result(None)
+
+        return future
+
     # Get metadata via taglib
-    def getFileInfo(self, name, pathname):
+    def getFileInfo(self, name, pathname, missing=None, throttle=None):
+        """ If missing is a list, files without cached metadata are returned without
+        it, and their names are appended to the list. Rescans pass a RescanThrottle
+        to limit their disk reads. """
 
         try:
-            audio = None
-            size = os.stat(pathname).st_size
+            filestat = os.stat(pathname)
+            size = filestat.st_size
+
+            # Only parse files that are new or changed since they were last seen
+            cachekey = self.metadatacache.get_key(filestat)
+            metadata = self.metadatacache.get(cachekey)
+
+            if metadata is not None:
+                return (name, size) + metadata
+
+            if missing is not None:
+                missing.append(name)
+                return (name, size, None, None)
 
             if size > 0:
-                try:
-                    audio = taglib.File(pathname)
-                except IOError:
-                    pass
+                if throttle is not None:
+                    throttle.wait(size)
 
-            if audio is not None:
-                bitrateinfo = (int(audio.bitrate), int(False))  # Second argument used to be VBR (variable bitrate)
-                fileinfo = (name, size, bitrateinfo, int(audio.length))
+                fileinfo = (name, size) + read_metadata(pathname)
             else:
                 fileinfo = (name, size, None, None)
 
+            self.metadatacache.set(cachekey, fileinfo[2:])
             return fileinfo
 
         except Exception as errtuple:
@@ -629,6 +1207,47 @@ class Shares:
         return streams
 
     # Stop sharing any dot/hidden directories/files
+    def hiddenEntryCheck(self, entry, exclusions=None):
+        """ Like excludedFolderCheck, for a DirEntry in a folder that is already known
+        not to be hidden or excluded """
+
+        if exclusions is None:
+            exclusions = self.exclusions
+
+        if entry.name.startswith(".") or exclusions.match(entry.name):
+            return True
+
+        # Check if file is marked as hidden on Windows, where DirEntry.stat() doesn't need a system call
+        if sys.platform == "win32":
+            return entry.stat().st_file_attributes & stat.FILE_ATTRIBUTE_HIDDEN
+
+        return False
+
+    def excludedFolderCheck(self, folder, exclusions=None):
+        """ Returns True if a folder is hidden, or the name of the folder or of any folder
+        above it in its shared directory is excluded by a share exclusion rule. The same
+        folders are skipped when rescanning, where each folder is checked once. """
+
+        if self.hiddenCheck(folder):
+            return True
+
+        if exclusions is None:
+            exclusions = self.exclusions
+
+        folder = os.path.normpath(folder)
+        root = None
+
+        # The innermost shared directory holding the folder
+        for directory in (os.path.normpath(x[1]) for x in self._virtualmapping()):
+            if self._isInDirectories(folder, [directory]) and (root is None or len(directory) > len(root)):
+                root = directory
+
+        if root is None or root == folder:
+            return exclusions.match(os.path.basename(folder))
+
+        names = [os.path.basename(root)] + os.path.relpath(folder, root).split(os.sep)
+        return any(exclusions.match(name) for name in names)
+
     def hiddenCheck(self, folder, filename=None):
 
         subfolders = folder.split(os.sep)
@@ -659,33 +1278,53 @@ class Shares:
         stream.extend(message.packObject(len(dir)))
 
         for fileinfo in dir:
-            stream.extend(bytes([1]))
-            stream.extend(message.packObject(fileinfo[0]))
-            stream.extend(message.packObject(fileinfo[1], unsignedlonglong=True))
+            stream.extend(self.getFileStream(fileinfo))
 
-            if fileinfo[2] is not None:
-                try:
-                    stream.extend(message.packObject('mp3'))
-                    stream.extend(message.packObject(3))
-
-                    stream.extend(message.packObject(0))
-                    stream.extend(message.packObject(fileinfo[2][0]))
-                    stream.extend(message.packObject(1))
-                    stream.extend(message.packObject(fileinfo[3]))
-                    stream.extend(message.packObject(2))
-                    stream.extend(message.packObject(fileinfo[2][1]))
-                except Exception:
-                    log.addwarning(_("Found meta data that couldn't be encoded, possible corrupt file: '%(file)s' has a bitrate of %(bitrate)s kbs, a length of %(length)s seconds and a VBR of %(vbr)s" % {
-                        'file': fileinfo[0],
-                        'bitrate': fileinfo[2][0],
-                        'length': fileinfo[3],
-                        'vbr': fileinfo[2][1]
-                    }))
-                    stream.extend(message.packObject(''))
-                    stream.extend(message.packObject(0))
-            else:
+        return stream
+
+    def getFileStream(self, fileinfo):
+
+        message = slskmessages.SlskMessage()
+        stream = bytearray()
+        stream.extend(bytes([1]))
+        stream.extend(message.packObject(fileinfo[0]))
+        stream.extend(message.packObject(fileinfo[1], unsignedlonglong=True))
+
+        if fileinfo[2] is not None:
+            try:
+                stream.extend(message.packObject('mp3'))
+                stream.extend(message.packObject(3))
+
+                stream.extend(message.packObject(0))
+                stream.extend(message.packObject(fileinfo[2][0]))
+                stream.extend(message.packObject(1))
+                stream.extend(message.packObject(fileinfo[3]))
+                stream.extend(message.packObject(2))
+                stream.extend(message.packObject(fileinfo[2][1]))
+            except Exception:
+                log.addwarning(_("Found meta data that couldn't be encoded, possible corrupt file: '%(file)s' has a bitrate of %(bitrate)s kbs, a length of %(length)s seconds and a VBR of %(vbr)s" % {
+                    'file': fileinfo[0],
+                    'bitrate': fileinfo[2][0],
+                    'length': fileinfo[3],
+                    'vbr': fileinfo[2][1]
+                }))
                 stream.extend(message.packObject(''))
                 stream.extend(message.packObject(0))
+        else:
+            stream.extend(message.packObject(''))
+            stream.extend(message.packObject(0))
+
+        return stream
+
+    def appendToDirStream(self, stream, numfiles, fileinfo):
+        """ Append a file to a directory stream, without packing the other files again """
+
+        if not stream:
+            stream = self.getDirStream([])
+
+        stream = bytearray(stream)
+        stream[:4] = slskmessages.SlskMessage().packObject(numfiles)
+        stream.extend(self.getFileStream(fileinfo))
 
         return stream
 
@@ -693,8 +1332,7 @@ class Shares:
     def getFilesIndex(self, mtimes, newsharedfiles, yieldcall=None, progress=None):
 
         wordindex = {}
-        fileindex = []
-        index = 0
+        fileindex = FileTable()
         count = len(mtimes)
         lastpercent = 0.0
 
@@ -712,54 +1350,328 @@ class Shares:
                     lastpercent = percent
 
             for j in newsharedfiles[virtualdir]:
-                file = j[0]
-                fileindex.append((virtualdir + '\\' + file,) + j[1:])
-
                 # Collect words from filenames for Search index
-                # Use set to prevent duplicates
-                for k in set((virtualdir + " " + file).lower().translate(self.translatepunctuation).split()):
-                    try:
-                        wordindex[k].append(index)
-                    except KeyError:
-                        wordindex[k] = [index]
-
-                index += 1
+                self.addToFilesIndex(wordindex, fileindex, get_index_words(virtualdir, j[0]), virtualdir, j)
 
             if yieldcall is not None:
                 yieldcall()
 
         return wordindex, fileindex
 
-    def addToShared(self, name):
-        """ Add a file to the normal shares database """
+    def getCombinedFilesIndex(self, mtimes, publicmtimes, newsharedfiles, yieldcall=None, progress=None):
+        """ Build the search indexes of the buddy share (all folders in mtimes) and the
+        public share (folders in publicmtimes) at once. The words of each file are only
+        collected once, but every public file still gets a record and postings in both
+        indexes, since each share is written to its own search index file. """
 
-        config = self.config.sections
-        if not config["transfers"]["sharedownloaddir"]:
+        wordindex = {}
+        fileindex = FileTable()
+        bwordindex = {}
+        bfileindex = FileTable()
+        count = len(mtimes)
+        lastpercent = 0.0
+
+        for folder in mtimes:
+
+            virtualdir = self.real2virtual(folder)
+            public = folder in publicmtimes
+            count += 1
+
+            if progress:
+                # Truncate the percentage to two decimal places to avoid sending data to the GUI thread too often
+                percent = float("%.2f" % (float(count) / len(mtimes) * 0.75))
+
+                if percent > lastpercent and percent <= 1.0:
+                    GLib.idle_add(progress.set_fraction, percent)
+                    lastpercent = percent
+
+            for j in newsharedfiles.get(virtualdir, ()):
+                words = get_index_words(virtualdir, j[0])
+
+                self.addToFilesIndex(bwordindex, bfileindex, words, virtualdir, j)
+
+                if public:
+                    self.addToFilesIndex(wordindex, fileindex, words, virtualdir, j)
+
+            if yieldcall is not None:
+                yieldcall()
+
+        return wordindex, fileindex, bwordindex, bfileindex
+
+    def addToFilesIndex(self, wordindex, fileindex, words, virtualdir, fileinfo):
+
+        index = fileindex.append(virtualdir, fileinfo)
+
+        for k in words:
+            try:
+                wordindex[k].append(index)
+            except KeyError:
+                wordindex[k] = array('I', [index])
+
+    def startShareWatcher(self):
+        """ Watch shared folders for changes, and apply them to the shares without
+        a rescan. Restarted after each rescan to pick up new shared folders. """
+
+        self.stopShareWatcher()
+
+        transfers = self.config.sections["transfers"]
+
+        if not transfers["sharewatcher"]:
             return
 
-        shared = config["transfers"]["sharedfiles"]
-        sharedstreams = config["transfers"]["sharedfilesstreams"]
-        wordindex = config["transfers"]["wordindex"]
-        fileindex = config["transfers"]["fileindex"]
+        if not sharewatcher_supported():
+            log.addwarning(_("Watching shared folders for changes is only supported on Linux"))
+            return
 
-        shareddirs = [path for _name, path in config["transfers"]["shared"]]
-        shareddirs.append(config["transfers"]["downloaddir"])
+        folders = [x[1] for x in self._virtualmapping()]
 
-        sharedmtimes = config["transfers"]["sharedmtimes"]
+        for mtimes in (transfers["sharedmtimes"], transfers["bsharedmtimes"]):
+            folders.extend(mtimes)
 
-        dir = str(os.path.expanduser(os.path.dirname(name)))
-        vdir = self.real2virtual(dir)
-        file = str(os.path.basename(name))
+        self.metadatacache.open()
+
+        try:
+            self.watcher = ShareWatcher(folders, self.updateSharedFolders, checkhidden=self.excludedFolderCheck)
+        except OSError as error:
+            log.addwarning(_("Failed to watch shared folders for changes: %s") % error)
+            return
+
+        self.watcher.start()
+
+    def stopShareWatcher(self):
+
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def updateSharedFolders(self, folders):
+        """ Called from the share watcher thread with the folders that changed. Reads
+        their contents, and applies them to the shares in the GUI thread. """
+
+        if folders is None:
+            self.logMessage(_("Some changes to shared folders were missed, rescan your shares to pick them up"))
+            return
+
+        changes = []
+
+        for folder in sorted(folders):
+            change = self.readSharedFolder(folder)
 
-        shared[vdir] = shared.get(vdir, [])
+            if change is not None:
+                changes.append(change)
 
-        if file not in [i[0] for i in shared[vdir]]:
-            fileinfo = self.getFileInfo(file, name)
-            shared[vdir] = shared[vdir] + [fileinfo]
-            sharedstreams[vdir] = self.getDirStream(shared[vdir])
-            words = self.getIndexWords(vdir, file, shareddirs)
-            self.addToIndex(wordindex, fileindex, words, vdir, fileinfo)
-            sharedmtimes[vdir] = os.path.getmtime(dir)
+        GLib.idle_add(self.applyFolderChanges, changes)
+
+    def readSharedFolder(self, folder, throttle=None):
+        """ Returns a (folder, mtime, files) change for applyFolderChanges, with
+        mtime and files set to None if the folder is gone or excluded, or None on errors """
+
+        files = []
+
+        try:
+            if self.excludedFolderCheck(folder):
+                # Shared before a folder above it was excluded
+                return (folder, None, None)
+
+            mtime = os.path.getmtime(folder)
+
+            for entry in os.scandir(folder):
+                if entry.is_file() and not self.hiddenEntryCheck(entry):
+                    data = self.getFileInfo(entry.name, entry.path, throttle=throttle)
+
+                    if data is not None:
+                        files.append(data)
+
+        except FileNotFoundError:
+            # Folder was removed or moved away
+            mtime = files = None
+
+        except OSError as errtuple:
+            message = _("Error while scanning folder %(path)s: %(error)s") % {'path': folder, 'error': errtuple}
+            self.logMessage(message)
+            return None
+
+        return (folder, mtime, files)
+
+    def cancelMetadataScans(self, *types):
+        """ Stop reading metadata in the background for earlier rescans of the
+        given share types. Returns the scans to pass to readPendingMetadata. """
+
+        scans = []
+
+        for sharestype in types:
+            self.metadatascans[sharestype] += 1
+            scans.append((sharestype, self.metadatascans[sharestype]))
+
+        return scans
+
+    def readPendingMetadata(self, folders, scans):
+        """ Second phase of a rescan with lazymetadata enabled, called from the rescan
+        thread once the shares are published. Reads the metadata of the files in folders,
+        and applies it in batches while it goes. Files that are already shared only have
+        their metadata replaced in the search index, see updateSharedFolder(). """
+
+        starttime = lastbatch = time.time()
+        changes = []
+        count = 0
+
+        self.metadatacache.begin_scan()
+
+        try:
+            for folder in sorted(folders):
+                if any(self.metadatascans[sharestype] != scan for sharestype, scan in scans):
+                    # Shares are rescanned again, folders left out are still pending there
+                    log.adddebug("Stopped reading metadata of %i folders, shares are rescanned" % (len(folders) - count))
+                    return
+
+                change = self.readSharedFolder(folder, self.throttle)
+                count += 1
+
+                if change is not None:
+                    changes.append(change)
+
+                if changes and (len(changes) >= 100 or time.time() - lastbatch >= 2):
+                    GLib.idle_add(self.applyFolderChanges, changes)
+                    changes = []
+                    lastbatch = time.time()
+
+            if changes:
+                GLib.idle_add(self.applyFolderChanges, changes)
+
+        finally:
+            self.metadatacache.end_scan()
+
+        self.logMessage(_("Read metadata of %(num)i folders in %(time).1f seconds") % {
+            'num': count,
+            'time': time.time() - starttime
+        })
+
+    def trackFolderChanges(self, *sharestypes):
+        """ Called in the GUI thread when a rescan of sharestypes starts """
+
+        for sharestype in sharestypes:
+            self.rescanchanges[sharestype] = set()
+
+    def reapplyFolderChanges(self, sharestype):
+        """ Called in the GUI thread once the shares written by a rescan are switched to.
+        Folders changed during the rescan are read again, and applied to the new shares. """
+
+        folders = self.rescanchanges.pop(sharestype, None)
+
+        if folders:
+            _thread.start_new_thread(self.updateSharedFolders, (folders,))
+
+    def applyFolderChanges(self, changes):
+
+        transfers = self.config.sections["transfers"]
+
+        for folders in self.rescanchanges.values():
+            folders.update(folder for folder, mtime, files in changes)
+
+        public = [x[1] for x in transfers["shared"]]
+        buddy = public + [x[1] for x in transfers["buddyshared"]]
+
+        if transfers["sharedownloaddir"]:
+            public.append(transfers["downloaddir"])
+            buddy.append(transfers["downloaddir"])
+
+        views = [("", public)]
+
+        if transfers["enablebuddyshares"]:
+            views.append(("b", buddy))
+
+        for prefix, directories in views:
+            updated = False
+
+            for folder, mtime, files in changes:
+                if self._isInDirectories(folder, directories) and self.updateSharedFolder(prefix, folder, mtime, files):
+                    updated = True
+
+            if not updated:
+                continue
+
+            # The compressed list of shared files is rebuilt at the next browse request
+            if prefix:
+                self.newbuddyshares = True
+            else:
+                self.newnormalshares = True
+
+            self.compactSearchIndex(prefix + "searchindex")
+
+        if self.np.transfers is not None:
+            self.sendNumSharedFoldersFiles()
+
+        return False
+
+    def updateSharedFolder(self, prefix, folder, mtime, files):
+        """ Replace the contents of a folder in the public (prefix "") or buddy (prefix "b")
+        share. If mtime is None, the folder and its subfolders are removed. Only the
+        files that changed are updated in the search index. Returns True if the
+        shared files changed. """
+
+        transfers = self.config.sections["transfers"]
+        sharedfiles = transfers[prefix + "sharedfiles"]
+        sharedstreams = transfers[prefix + "sharedfilesstreams"]
+        sharedmtimes = transfers[prefix + "sharedmtimes"]
+        searchindex = transfers[prefix + "searchindex"]
+
+        if mtime is None:
+            removedfolders = [x for x in sharedmtimes if self._isInDirectories(x, [folder])]
+
+            if not removedfolders:
+                return False
+
+            self.browsecaches["buddy" if prefix else "normal"].bump()
+
+            for oldfolder in removedfolders:
+                virtualdir = self.real2virtual(oldfolder)
+
+                for fileinfo in sharedfiles.get(virtualdir, ()):
+                    searchindex.remove_file(virtualdir + '\\' + fileinfo[0])
+
+                sharedfiles.pop(virtualdir, None)
+                sharedstreams.pop(virtualdir, None)
+                sharedmtimes.pop(oldfolder, None)
+
+            return True
+
+        virtualdir = self.real2virtual(folder)
+        sharedmtimes[folder] = mtime
+
+        if virtualdir in sharedfiles:
+            removed, added, changed = get_file_changes(sharedfiles[virtualdir], files)
+
+            if not removed and not added and not changed:
+                return False
+        else:
+            removed, added, changed = [], list(files), []
+
+        self.browsecaches["buddy" if prefix else "normal"].bump()
+
+        sharedfiles[virtualdir] = files
+        sharedstreams[virtualdir] = self.getDirStream(files)
+
+        for name in removed:
+            searchindex.remove_file(virtualdir + '\\' + name)
+
+        for fileinfo in changed:
+            # Same path, e.g. metadata read after a lazy rescan, only the attributes are replaced
+            if not searchindex.update_file((virtualdir + '\\' + fileinfo[0],) + tuple(fileinfo[1:])):
+                added.append(fileinfo)
+
+        for fileinfo in added:
+            searchindex.add_file((virtualdir + '\\' + fileinfo[0],) + tuple(fileinfo[1:]))
+
+        return True
+
+    def addToShared(self, name):
+        """ Add a file to the normal shares database """
+
+        config = self.config.sections
+        if not config["transfers"]["sharedownloaddir"]:
+            return
+
+        if self.addFileToShares("", name):
             self.newnormalshares = True
 
         if config["transfers"]["enablebuddyshares"]:
@@ -772,37 +1684,93 @@ class Shares:
         if not config["transfers"]["sharedownloaddir"]:
             return
 
-        bshared = config["transfers"]["bsharedfiles"]
-        bsharedstreams = config["transfers"]["bsharedfilesstreams"]
-        bwordindex = config["transfers"]["bwordindex"]
-        bfileindex = config["transfers"]["bfileindex"]
+        if self.addFileToShares("b", name):
+            self.newbuddyshares = True
 
-        bshareddirs = [path for _name, path in config["transfers"]["shared"]]
-        bshareddirs += [path for _name, path in config["transfers"]["buddyshared"]]
-        bshareddirs.append(config["transfers"]["downloaddir"])
+    def addFileToShares(self, prefix, name):
+        """ Add a file to the public (prefix "") or buddy (prefix "b") shares database.
+        Only the file list of its folder is stored again; the folder stream and the
+        search index are appended to. Returns True if the file was added. """
 
-        bsharedmtimes = config["transfers"]["bsharedmtimes"]
+        transfers = self.config.sections["transfers"]
+        shared = transfers[prefix + "sharedfiles"]
+        sharedstreams = transfers[prefix + "sharedfilesstreams"]
+        sharedmtimes = transfers[prefix + "sharedmtimes"]
+        searchindex = transfers[prefix + "searchindex"]
 
         dir = str(os.path.expanduser(os.path.dirname(name)))
         vdir = self.real2virtual(dir)
         file = str(os.path.basename(name))
 
-        bshared[vdir] = bshared.get(vdir, [])
+        files = shared.get(vdir, [])
 
-        if file not in [i[0] for i in bshared[vdir]]:
-            fileinfo = self.getFileInfo(file, name)
-            bshared[vdir] = bshared[vdir] + [fileinfo]
-            bsharedstreams[vdir] = self.getDirStream(bshared[vdir])
-            words = self.getIndexWords(vdir, file, bshareddirs)
-            self.addToIndex(bwordindex, bfileindex, words, vdir, fileinfo)
-            bsharedmtimes[vdir] = os.path.getmtime(dir)
-            self.newbuddyshares = True
+        if file in [i[0] for i in files]:
+            return False
 
-    def addToIndex(self, wordindex, fileindex, words, dir, fileinfo):
-        index = len(fileindex)
-        for i in words:
-            if i not in wordindex:
-                wordindex[i] = [index]
-            else:
-                wordindex[i] = wordindex[i] + [index]
-        fileindex.append((os.path.join(dir, fileinfo[0]),) + fileinfo[1:])
+        fileinfo = self.getFileInfo(file, name)
+
+        if fileinfo is None:
+            return False
+
+        self.browsecaches["buddy" if prefix else "normal"].bump()
+
+        files.append(fileinfo)
+        shared[vdir] = files
+        sharedstreams[vdir] = self.appendToDirStream(sharedstreams.get(vdir), len(files), fileinfo)
+        sharedmtimes[dir] = os.path.getmtime(dir)
+
+        searchindex.add_file((vdir + '\\' + file,) + fileinfo[1:])
+        self.compactSearchIndex(prefix + "searchindex")
+
+        return True
+
+    def compactSearchIndex(self, key):
+        """ Merge the changes made to a search index since it was written into a
+        new index file, once enough of them have piled up. The new file is
+        written in a separate thread. """
+
+        searchindex = self.config.sections["transfers"][key]
+
+        if key in self.compacting or searchindex.filename is None or not searchindex.needs_compaction():
+            return
+
+        self.compacting.add(key)
+        _thread.start_new_thread(self._compactSearchIndex, (key, searchindex, searchindex.snapshot()))
+
+    def _compactSearchIndex(self, key, searchindex, snapshot):
+
+        filename = searchindex.filename + ".compact"
+
+        try:
+            searchindex.write_compacted(filename, snapshot, self.config.sections["searches"]["wildcard_search"])
+
+        except Exception as error:
+            # The index was most likely replaced by a rescan while compacting
+            log.adddebug("Failed to compact search index %s: %s" % (searchindex.filename, error))
+
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+            GLib.idle_add(self.compacting.discard, key)
+            return
+
+        GLib.idle_add(self.CompactionFinished, key, searchindex, filename, snapshot)
+
+    def CompactionFinished(self, key, searchindex, filename, snapshot):
+
+        self.compacting.discard(key)
+        transfers = self.config.sections["transfers"]
+
+        if transfers[key] is not searchindex:
+            # Replaced by a rescan in the meantime
+            try:
+                os.unlink(filename)
+            except OSError as error:
+                log.adddebug("Failed to remove compacted search index %s: %s" % (filename, error))
+
+            return False
+
+        transfers[key] = searchindex.replace_compacted(filename, snapshot)
+        return False
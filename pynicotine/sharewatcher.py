@@ -0,0 +1,267 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module watches shared folders for changes with inotify (Linux only),
+so that shares can be updated without rescanning them.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from pynicotine.logfacility import log
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+
+EVENT = struct.Struct("iIII")
+
+
+def is_supported():
+    return sys.platform.startswith("linux") and ctypes.util.find_library("c") is not None
+
+
+def get_file_changes(oldfiles, newfiles):
+    """ Compares the file lists of a folder before and after it changed, in format
+    [(name, size, (bitrate, vbr), length), ...]. Returns the names of the files that
+    are gone, the files that are new, and the files whose size or metadata changed. """
+
+    oldinfo = {fileinfo[0]: tuple(fileinfo[1:]) for fileinfo in oldfiles}
+    newnames = set()
+    added = []
+    changed = []
+
+    for fileinfo in newfiles:
+        name = fileinfo[0]
+        newnames.add(name)
+
+        try:
+            info = oldinfo[name]
+        except KeyError:
+            added.append(fileinfo)
+            continue
+
+        if info != tuple(fileinfo[1:]):
+            changed.append(fileinfo)
+
+    removed = [name for name in oldinfo if name not in newnames]
+
+    return removed, added, changed
+
+
+class ShareWatcher(threading.Thread):
+    """ Watches folders and their subfolders. Once the folders have been
+    quiet for delay seconds, callback is called from the watcher thread
+    with the set of folders whose contents changed. Folders that were
+    removed are included as well. If events were lost, callback is called
+    with None. """
+
+    def __init__(self, folders, callback, delay=2, maxdelay=10, checkhidden=None):
+
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.setName("ShareWatcher")
+
+        self.folders = folders
+        self.callback = callback
+        self.delay = delay
+        self.maxdelay = maxdelay
+        self.checkhidden = checkhidden
+
+        self.running = True
+        self.watches = {}
+        self.paths = {}
+        self.limitreached = False
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def addWatch(self, folder):
+
+        if folder in self.paths or (self.checkhidden is not None and self.checkhidden(folder)):
+            return False
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+
+        if wd < 0:
+            error = ctypes.get_errno()
+
+            if error == errno.ENOSPC and not self.limitreached:
+                self.limitreached = True
+                log.addwarning(
+                    "Too many shared folders to watch for changes, increase fs.inotify.max_user_watches "
+                    "or rescan your shares manually"
+                )
+
+            elif error != errno.ENOSPC:
+                log.adddebug("Failed to watch folder %s: %s" % (folder, os.strerror(error)))
+
+            return False
+
+        self.watches[wd] = folder
+        self.paths[folder] = wd
+        return True
+
+    def addWatchTree(self, folder, changed):
+        """ Watch a new folder and its subfolders, and add them to changed """
+
+        stack = [folder]
+
+        while stack:
+            path = stack.pop()
+
+            if not self.addWatch(path):
+                continue
+
+            changed.add(path)
+
+            try:
+                for entry in os.scandir(path):
+                    if entry.is_dir():
+                        stack.append(entry.path)
+
+            except OSError:
+                pass
+
+    def removeWatchTree(self, folder):
+
+        prefix = folder + os.sep
+
+        for path in [path for path in self.paths if path == folder or path.startswith(prefix)]:
+            wd = self.paths.pop(path)
+            del self.watches[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def readEvents(self, changed):
+        """ Read pending events and add the affected folders to changed.
+        Returns False if events were lost. """
+
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return True
+
+        pos = 0
+
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+            name = data[pos + EVENT.size:pos + EVENT.size + length].rstrip(b'\0')
+            pos += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                return False
+
+            folder = self.watches.get(wd)
+
+            if folder is None:
+                continue
+
+            if mask & IN_IGNORED:
+                # Watch was removed by the kernel, the folder is gone
+                self.paths.pop(folder, None)
+                del self.watches[wd]
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.removeWatchTree(folder)
+                changed.add(folder)
+                continue
+
+            changed.add(folder)
+
+            if not (mask & IN_ISDIR) or not name:
+                continue
+
+            path = os.path.join(folder, os.fsdecode(name))
+
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.addWatchTree(path, changed)
+
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.removeWatchTree(path)
+                changed.add(path)
+
+        return True
+
+    def run(self):
+
+        for folder in self.folders:
+            self.addWatch(folder)
+
+        changed = set()
+        firstevent = lastevent = None
+
+        while self.running:
+            try:
+                readable, _, _ = select.select([self.fd], [], [], 0.5)
+            except (OSError, ValueError):
+                break
+
+            now = time.time()
+
+            if readable:
+                if not self.readEvents(changed):
+                    changed.clear()
+                    firstevent = lastevent = None
+                    self.callback(None)
+                    continue
+
+                if changed:
+                    lastevent = now
+
+                    if firstevent is None:
+                        firstevent = now
+
+            if changed and (now - lastevent >= self.delay or now - firstevent >= self.maxdelay):
+                folders = changed
+                changed = set()
+                firstevent = lastevent = None
+                self.callback(folders)
+
+        os.close(self.fd)
+
+    def stop(self):
+        self.running = False
@@ -171,6 +171,15 @@ class RescanBuddyShares(InternalMessage):
         self.yieldfunction = yieldfunction
 
 
+class RescanAllShares(InternalMessage):
+    """ Sent by the GUI thread to itself to indicate the need to rescan both public and
+    buddy shares in the background, in a single pass over their folders """
+    def __init__(self, shared, buddyshared, yieldfunction):
+        self.shared = shared
+        self.buddyshared = buddyshared
+        self.yieldfunction = yieldfunction
+
+
 class DistribConn(InternalMessage):
     def __init__(self):
         pass
@@ -1836,24 +1845,40 @@ class SharedFileList(PeerMessage):
         if not rebuild and self.built is not None:
             return self.built
 
-        msg = bytearray()
+        if not nozlib:
+            self.built = b"".join(self.iterCompressedChunks())
+        else:
+            self.built = b"".join(self.iterChunks())
+
+        return self.built
+
+    def iterChunks(self):
+        """ Yields the uncompressed message one directory at a time """
 
         try:
-            msg.extend(self.packObject(len(self.list)))
+            yield self.packObject(len(self.list))
         except TypeError:
-            msg.extend(self.packObject(len(list(self.list))))
+            yield self.packObject(len(list(self.list)))
 
         for key in self.list:
             try:
-                msg.extend(self.packObject(key.replace(os.sep, "\\")))
-                msg.extend(self.list[key])
+                yield self.packObject(key.replace(os.sep, "\\")) + self.list[key]
             except KeyError:
                 pass
-        if not nozlib:
-            self.built = zlib.compress(msg)
-        else:
-            self.built = msg
-        return self.built
+
+    def iterCompressedChunks(self):
+        """ Yields the compressed message in chunks, without holding all of it, or
+        the uncompressed shares, in memory at once """
+
+        compressor = zlib.compressobj()
+
+        for chunk in self.iterChunks():
+            chunk = compressor.compress(chunk)
+
+            if chunk:
+                yield chunk
+
+        yield compressor.flush()
 
 
 class FileSearchRequest(PeerMessage):
@@ -1882,13 +1907,12 @@ class FileSearchResult(PeerMessage):
     """ Peer code: 9 """
     """ The peer sends this when it has a file search match. The
     token/ticket is taken from original FileSearchRequest message. """
-    def __init__(self, conn, user=None, geoip=None, token=None, shares=None, fileindex=None, freeulslots=None, ulspeed=None, inqueue=None, fifoqueue=None, numresults=None):
+    def __init__(self, conn, user=None, geoip=None, token=None, shares=None, searchindex=None, freeulslots=None, ulspeed=None, inqueue=None, fifoqueue=None, numresults=None):
         self.conn = conn
         self.user = user
         self.geoip = geoip
         self.token = token
         self.list = shares
-        self.fileindex = fileindex
         self.freeulslots = freeulslots
         self.ulspeed = ulspeed
         self.inqueue = inqueue
@@ -1896,6 +1920,17 @@ class FileSearchResult(PeerMessage):
         self.numresults = numresults
         self.pos = 0
 
+        # Entries are stored ready to send in the search index. They're copied
+        # now, the index may be replaced and closed before the message is sent.
+        self.entries = []
+
+        if searchindex is not None:
+            for index in islice(shares, numresults):
+                try:
+                    self.entries.append(bytes(searchindex.get_result_entry(index)))
+                except Exception:
+                    continue
+
     def parseNetworkMessage(self, message):
         try:
             message = zlib.decompress(message)
@@ -1930,37 +1965,13 @@ class FileSearchResult(PeerMessage):
 
     def makeNetworkMessage(self):
         queuesize = self.inqueue[0]
+        entries = self.entries
 
         msg = bytearray()
         msg.extend(self.packObject(self.user))
         msg.extend(self.packObject(self.token, unsignedint=True))
-        msg.extend(self.packObject(self.numresults, unsignedint=True))
-
-        for index in islice(self.list, self.numresults):
-            try:
-                fileinfo = self.fileindex[str(index)]
-            except Exception:
-                continue
-
-            msg.extend(bytes([1]))
-            msg.extend(self.packObject(fileinfo[0].replace(os.sep, "\\")))
-            msg.extend(self.packObject(fileinfo[1], unsignedlonglong=True))
-
-            if fileinfo[2] is None:
-                # No metadata
-                msg.extend(self.packObject(''))
-                msg.extend(self.packObject(0))
-            else:
-                # FileExtension, NumAttributes,
-                msg.extend(self.packObject("mp3"))
-                msg.extend(self.packObject(3))
-
-                msg.extend(self.packObject(0))
-                msg.extend(self.packObject(fileinfo[2][0], unsignedint=True))
-                msg.extend(self.packObject(1))
-                msg.extend(self.packObject(fileinfo[3], unsignedint=True))
-                msg.extend(self.packObject(2))
-                msg.extend(self.packObject(fileinfo[2][1]))
+        msg.extend(self.packObject(len(entries), unsignedint=True))
+        msg.extend(b"".join(entries))
 
         msg.extend(bytes([self.freeulslots]))
         msg.extend(self.packObject(self.ulspeed, unsignedint=True))
@@ -2070,10 +2081,11 @@ class FolderContentsResponse(PeerMessage):
     """ Peer code: 37 """
     """ A peer responds with the contents of a particular folder
     (with all subfolders) when we've sent a FolderContentsRequest. """
-    def __init__(self, conn, directory=None, shares=None):
+    def __init__(self, conn, directory=None, shares=None, stream=None):
         self.conn = conn
         self.dir = directory
         self.list = shares
+        self.stream = stream
 
     def parseNetworkMessage(self, message):
         try:
@@ -2119,32 +2131,14 @@ class FolderContentsResponse(PeerMessage):
         self.list = shares
 
     def makeNetworkMessage(self):
+        # The stream holds the already packed files of the folder, as stored
+        # in the shares database
         msg = bytearray()
         msg.extend(self.packObject(1))
         msg.extend(self.packObject(self.dir))
         msg.extend(self.packObject(1))
         msg.extend(self.packObject(self.dir))
-        msg.extend(self.packObject(len(self.list), unsignedint=True))
-
-        for fileinfo in self.list:
-            msg.extend(bytes([1]))
-            msg.extend(self.packObject(fileinfo[0]))
-            msg.extend(self.packObject(fileinfo[1], unsignedlonglong=True))
-            msg.extend(self.packObject(0))
-
-            if fileinfo[2] is None:
-                msg.extend(self.packObject(''))
-                msg.extend(self.packObject(0))
-            else:
-                msg.extend(self.packObject("mp3"))
-                msg.extend(self.packObject(3))
-
-                msg.extend(self.packObject(0))
-                msg.extend(self.packObject(fileinfo[2][0], unsignedint=True))
-                msg.extend(self.packObject(1))
-                msg.extend(self.packObject(fileinfo[3], unsignedint=True))
-                msg.extend(self.packObject(2))
-                msg.extend(self.packObject(fileinfo[2][1]))
+        msg.extend(self.stream)
 
         return zlib.compress(msg)
 
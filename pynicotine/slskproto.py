@@ -22,6 +22,7 @@
 This module implements Soulseek networking protocol.
 """
 
+import os
 import selectors
 import socket
 import struct
@@ -30,8 +31,15 @@ import threading
 import time
 
 from errno import EINTR
+from errno import EINVAL
+from errno import ENOSYS
+from errno import ENOTSOCK
+from errno import EOPNOTSUPP
 from gettext import gettext as _
+from queue import Queue
 
+from pynicotine.downloadsink import DownloadSink
+from pynicotine.downloadsink import preallocate
 from pynicotine.logfacility import log
 from pynicotine.slskmessages import AcceptChildren
 from pynicotine.slskmessages import AckNotifyPrivileges
@@ -191,17 +199,111 @@ else:
     MAXFILELIMIT = min(max(int(hardlimit * 0.75), 50), 1024)
 
 
+class MessageBuffer:
+    """ Input or output buffer of a connection. Consumed data is skipped by
+    moving a read offset instead of copying the rest of the buffer, and the
+    consumed part is only removed once the buffer is empty, or once it's larger
+    than COMPACT_THRESHOLD and half the buffer. Positions passed to the methods
+    are relative to the read offset. """
+
+    COMPACT_THRESHOLD = 64 * 1024
+
+    __slots__ = ("data", "offset")
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.data) - self.offset
+
+    def __bool__(self):
+        return len(self.data) > self.offset
+
+    def __getitem__(self, index):
+        """ Returns a single byte, or a copy of a slice of the unread data """
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            return bytes(self.data[self.offset + start:self.offset + stop:step])
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError("MessageBuffer index out of range")
+
+        return self.data[self.offset + index]
+
+    def extend(self, data):
+        self.data.extend(data)
+
+    def unpack(self, fmt, pos=0):
+        """ Unpacks values at pos without copying them out of the buffer first """
+        return struct.unpack_from(fmt, self.data, self.offset + pos)
+
+    def consume(self, size):
+
+        self.offset = min(self.offset + size, len(self.data))
+
+        if self.offset == len(self.data):
+            self.data.clear()
+            self.offset = 0
+
+        elif self.offset > self.COMPACT_THRESHOLD and self.offset * 2 > len(self.data):
+            del self.data[:self.offset]
+            self.offset = 0
+
+    def clear(self):
+        self.data.clear()
+        self.offset = 0
+
+    def send(self, sock, limit=None):
+        """ Sends unread data to a socket, at most limit bytes, and consumes
+        what was sent. Returns the number of bytes sent. """
+
+        end = len(self.data)
+
+        if limit is not None:
+            end = min(end, self.offset + limit)
+
+        with memoryview(self.data) as view:
+            with view[self.offset:end] as chunk:
+                bytes_send = sock.send(chunk)
+
+        self.consume(bytes_send)
+        return bytes_send
+
+    def write(self, file, size):
+        """ Writes at most size bytes of unread data to a file, and consumes them.
+        Returns the number of bytes consumed. """
+
+        size = min(size, len(self))
+
+        if size <= 0:
+            return 0
+
+        try:
+            with memoryview(self.data) as view:
+                with view[self.offset:self.offset + size] as chunk:
+                    file.write(chunk)
+        finally:
+            self.consume(size)
+
+        return size
+
+
 class Connection:
     """
     Holds data about a connection. conn is a socket object,
-    addr is (ip, port) pair, ibuf and obuf are input and output msgBuffer,
+    addr is (ip, port) pair, ibuf and obuf are input and output MessageBuffers,
     init is a PeerInit object (see slskmessages docstrings).
     """
     def __init__(self, conn=None, addr=None):
         self.conn = conn
         self.addr = addr
-        self.ibuf = bytearray()
-        self.obuf = bytearray()
+        self.ibuf = MessageBuffer()
+        self.obuf = MessageBuffer()
         self.init = None
         self.lastreadlength = 100 * 1024
 
@@ -211,6 +313,7 @@ class PeerConnection(Connection):
         Connection.__init__(self, conn, addr)
         self.filereq = None
         self.filedown = None
+        self.filesink = None  # Buffers download data before it's written to filedown.file
         self.fileupl = None
         self.filereadbytes = 0
         self.bytestoread = 0
@@ -221,6 +324,8 @@ class PeerConnection(Connection):
         self.starttime = None  # Used for upload bandwidth management
         self.sentbytes2 = 0
         self.readbytes2 = 0
+        self.nextread = 0  # Used for download bandwidth management
+        self.sendfile = hasattr(os, "sendfile")  # Upload file data without copying it through obuf
 
 
 class PeerConnectionInProgress:
@@ -234,6 +339,22 @@ class PeerConnectionInProgress:
         self.lastactive = time.time()
 
 
+class NetworkQueue(Queue):
+    """ Holds messages from the UI thread to the networking thread, and wakes
+    the networking thread up whenever a message is put in it """
+
+    def __init__(self):
+        Queue.__init__(self, 0)
+        self.wakeup = None
+
+    def put(self, item, block=True, timeout=None):
+
+        Queue.put(self, item, block, timeout)
+
+        if self.wakeup is not None:
+            self.wakeup()
+
+
 class SlskProtoThread(threading.Thread):
     """ This is a networking thread that actually does all the communication.
     It sends data to the UI thread via a callback function and receives data
@@ -371,6 +492,15 @@ class SlskProtoThread(threading.Thread):
     CONNECTION_MAX_IDLE = 60
     CONNCOUNT_UI_INTERVAL = 0.5
 
+    # Throttled transfers are checked again after this many seconds
+    SHAPING_INTERVAL = 0.2
+
+    # Longest wait for socket events when messages from the UI thread don't wake us up
+    POLL_INTERVAL = 0.2
+
+    # Most file data sent in one os.sendfile call for uploads without a speed limit
+    SENDFILE_CHUNK = 1024 * 1024
+
     def __init__(self, ui_callback, queue, bindip, port, config, eventprocessor):
         """ ui_callback is a UI callback function to be called with messages
         list as a parameter. queue is Queue object that holds messages from UI
@@ -398,6 +528,20 @@ class SlskProtoThread(threading.Thread):
 
         self._conns = {}
         self._connsinprogress = {}
+
+        # Sockets stay registered for as long as they're open, and their events
+        # are only modified when they change
+        self._selector = selectors.DefaultSelector()
+
+        # Written to when a message is put in the queue, to end the wait for socket events
+        self._wakeup_read, self._wakeup_write = self._createWakeupPipe()
+
+        if isinstance(queue, NetworkQueue):
+            queue.wakeup = self._wakeup
+
+        # Messages in the queue are only processed again after this time
+        self._queueretry = 0
+        self._lastconncount = None
         self._uploadlimit = (self._calcLimitNone, 0)
         self._downloadlimit = (self._calcDownloadLimitByTotal, self._config.sections["transfers"]["downloadlimit"])
         self._ulimits = {}
@@ -447,6 +591,14 @@ class SlskProtoThread(threading.Thread):
     def _isDownload(self, conn):
         return conn.__class__ is PeerConnection and conn.filedown is not None
 
+    def _hasFileData(self, conn):
+        """ Returns True if an upload has file data left to send. Once everything is
+        sent, the connection no longer waits to be writable. """
+
+        fileupl = conn.fileupl
+
+        return fileupl is not None and fileupl.offset is not None and fileupl.offset + fileupl.sentbytes < fileupl.size
+
     def _calcUploadSpeed(self, i):
         curtime = time.time()
 
@@ -515,6 +667,93 @@ class SlskProtoThread(threading.Thread):
     def _calcLimitNone(self, conns, i):
         return None
 
+    def _createWakeupPipe(self):
+
+        if sys.platform == "win32":
+            # Only sockets can be selected on Windows
+            wakeup_read, wakeup_write = socket.socketpair()
+            wakeup_read.setblocking(False)
+            wakeup_write.setblocking(False)
+
+            return wakeup_read, wakeup_write
+
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_read, False)
+        os.set_blocking(wakeup_write, False)
+
+        return wakeup_read, wakeup_write
+
+    def _wakeup(self):
+        """ Called from other threads to end the wait for socket events """
+
+        if self._wakeup_write is None:
+            return
+
+        try:
+            if sys.platform == "win32":
+                self._wakeup_write.send(b"\0")
+            else:
+                os.write(self._wakeup_write, b"\0")
+
+        except OSError:
+            # The pipe is full and the networking thread wakes up anyway, or it was
+            # closed when the networking thread stopped
+            pass
+
+    def _closeWakeupPipe(self):
+
+        wakeup_read, wakeup_write = self._wakeup_read, self._wakeup_write
+        self._wakeup_read = self._wakeup_write = None
+
+        for fd in (wakeup_read, wakeup_write):
+            if sys.platform == "win32":
+                fd.close()
+            else:
+                os.close(fd)
+
+    def _drainWakeupPipe(self):
+
+        try:
+            while True:
+                if sys.platform == "win32":
+                    data = self._wakeup_read.recv(4096)
+                else:
+                    data = os.read(self._wakeup_read, 4096)
+
+                if not data:
+                    break
+
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _setSocketEvents(self, sock, events):
+        """ Register a socket in the selector, or change the events it's selected for.
+        Nothing is done if the events are the same as before. """
+
+        try:
+            key = self._selector.get_key(sock)
+
+        except KeyError:
+            self._selector.register(sock, events)
+            return
+
+        if key.fileobj is not sock:
+            # Left behind by a socket that was closed without unregistering it first,
+            # whose file descriptor was reused
+            self._unregisterSocket(key.fileobj)
+            self._selector.register(sock, events)
+            return
+
+        if key.events != events:
+            self._selector.modify(sock, events)
+
+    def _unregisterSocket(self, sock):
+
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
     def socketStillActive(self, conn):
         try:
             connection = self._conns[conn]
@@ -561,9 +800,9 @@ class SlskProtoThread(threading.Thread):
 
         # File Request messages are 4 bytes or greater in length
         if len(msgBuffer) >= 4:
-            reqnum = struct.unpack("<i", msgBuffer[:4])[0]
+            reqnum = msgBuffer.unpack("<i")[0]
             msg = FileRequest(conn.conn, reqnum)
-            msgBuffer = msgBuffer[4:]
+            msgBuffer.consume(4)
 
         return msg, msgBuffer
 
@@ -571,8 +810,8 @@ class SlskProtoThread(threading.Thread):
         offset = None
 
         if len(msgBuffer) >= 8:
-            offset = struct.unpack("<Q", msgBuffer[:8])[0]
-            msgBuffer = msgBuffer[8:]
+            offset = msgBuffer.unpack("<Q")[0]
+            msgBuffer.consume(8)
 
         return offset, msgBuffer
 
@@ -585,7 +824,7 @@ class SlskProtoThread(threading.Thread):
 
         # Server messages are 8 bytes or greater in length
         while len(msgBuffer) >= 8:
-            msgsize, msgtype = struct.unpack("<ii", msgBuffer[:8])
+            msgsize, msgtype = msgBuffer.unpack("<ii")
 
             if msgsize + 4 > len(msgBuffer):
                 break
@@ -598,7 +837,7 @@ class SlskProtoThread(threading.Thread):
             else:
                 msgs.append(_("Server message type %(type)i size %(size)i contents %(msgBuffer)s unknown") % {'type': msgtype, 'size': msgsize - 4, 'msgBuffer': msgBuffer[8:msgsize + 4].__repr__()})
 
-            msgBuffer = msgBuffer[msgsize + 4:]
+            msgBuffer.consume(msgsize + 4)
 
         return msgs, msgBuffer
 
@@ -619,17 +858,16 @@ class SlskProtoThread(threading.Thread):
 
         elif conn.filedown is not None:
             leftbytes = conn.bytestoread - conn.filereadbytes
-            addedbytes = msgBuffer[:leftbytes]
+            addedbyteslen = min(leftbytes, len(msgBuffer))
 
             if leftbytes > 0:
                 try:
-                    conn.filedown.file.write(addedbytes)
+                    msgBuffer.write(conn.filesink, leftbytes)
                 except IOError as strerror:
                     self._ui_callback([FileError(conn, conn.filedown.file, strerror)])
                 except ValueError:
                     pass
 
-            addedbyteslen = len(addedbytes)
             curtime = time.time()
 
             if (leftbytes - addedbyteslen) == 0 or \
@@ -638,11 +876,12 @@ class SlskProtoThread(threading.Thread):
                 """ We save resources by not sending data back to the UI every time
                 a part of a file is downloaded """
 
+                # The UI reads the progress from the file position
+                self._flushDownload(conn)
                 self._ui_callback([DownloadFile(conn.conn, addedbyteslen, conn.filedown.file)])
                 self.last_file_input_update = curtime
 
             conn.filereadbytes += addedbyteslen
-            msgBuffer = msgBuffer[leftbytes:]
 
         elif conn.fileupl is not None:
             if conn.fileupl.offset is None:
@@ -671,10 +910,9 @@ class SlskProtoThread(threading.Thread):
         msgs = []
 
         while (conn.init is None or conn.init.type not in ['F', 'D']) and len(msgBuffer) >= 8:
-            msgsize = struct.unpack("<i", msgBuffer[:4])[0]
+            msgsize, msgtype = msgBuffer.unpack("<ii")
 
             if len(msgBuffer) >= 8:
-                msgtype = struct.unpack("<i", msgBuffer[4:8])[0]
                 self._ui_callback([PeerTransfer(conn, msgsize, len(msgBuffer) - 4, self.peerclasses.get(msgtype, None))])
 
             if msgsize + 4 > len(msgBuffer):
@@ -711,6 +949,7 @@ class SlskProtoThread(threading.Thread):
                     ))
 
                     self._ui_callback([ConnClose(conn.conn, conn.addr)])
+                    self._unregisterSocket(conn.conn)
                     conn.conn.close()
                     conn.conn = None
                     break
@@ -720,7 +959,6 @@ class SlskProtoThread(threading.Thread):
 
             elif conn.init.type == 'P':
                 # Unpack Peer Messages
-                msgtype = struct.unpack("<i", msgBuffer[4:8])[0]
 
                 if msgtype in self.peerclasses:
                     try:
@@ -782,9 +1020,9 @@ class SlskProtoThread(threading.Thread):
                 msgs.append(_("Can't handle connection type %s") % (conn.init.type))
 
             if msgsize >= 0:
-                msgBuffer = msgBuffer[msgsize + 4:]
+                msgBuffer.consume(msgsize + 4)
             else:
-                msgBuffer = bytearray()
+                msgBuffer.clear()
 
         conn.ibuf = msgBuffer
         return msgs, conn
@@ -798,7 +1036,7 @@ class SlskProtoThread(threading.Thread):
         msgs = []
 
         while len(msgBuffer) >= 5:
-            msgsize = struct.unpack("<i", msgBuffer[:4])[0]
+            msgsize = msgBuffer.unpack("<i")[0]
 
             if msgsize + 4 > len(msgBuffer):
                 break
@@ -813,14 +1051,15 @@ class SlskProtoThread(threading.Thread):
             else:
                 msgs.append(_("Distrib message type %(type)i size %(size)i contents %(msgBuffer)s unknown") % {'type': msgtype, 'size': msgsize - 1, 'msgBuffer': msgBuffer[5:msgsize + 4].__repr__()})
                 self._ui_callback([ConnClose(conn.conn, conn.addr)])
+                self._unregisterSocket(conn.conn)
                 conn.conn.close()
                 conn.conn = None
                 break
 
             if msgsize >= 0:
-                msgBuffer = msgBuffer[msgsize + 4:]
+                msgBuffer.consume(msgsize + 4)
             else:
-                msgBuffer = bytearray()
+                msgBuffer.clear()
 
         conn.ibuf = msgBuffer
         return msgs, conn
@@ -876,6 +1115,11 @@ class SlskProtoThread(threading.Thread):
             )
 
     def close_connection(self, connection_list, connection):
+
+        if self._isDownload(connection_list[connection]):
+            self._flushDownload(connection_list[connection])
+
+        self._unregisterSocket(connection)
         connection.close()
         del connection_list[connection]
 
@@ -985,8 +1229,11 @@ class SlskProtoThread(threading.Thread):
                             server_socket.close()
 
                 elif msgObj.__class__ is ConnClose and msgObj.conn in conns:
-                    self._ui_callback([ConnClose(msgObj.conn, conns[msgObj.conn].addr)])
+                    addr = conns[msgObj.conn].addr
+
+                    # Closed before the UI is told, so pending download data is written first
                     self.close_connection(conns, msgObj.conn)
+                    self._ui_callback([ConnClose(msgObj.conn, addr)])
 
                 elif msgObj.__class__ is OutConn:
                     if msgObj.addr[1] == 0:
@@ -1016,6 +1263,14 @@ class SlskProtoThread(threading.Thread):
 
                 elif msgObj.__class__ is DownloadFile and msgObj.conn in conns:
                     conns[msgObj.conn].filedown = msgObj
+                    conns[msgObj.conn].filesink = DownloadSink(
+                        msgObj.file,
+                        buffersize=self._config.sections["transfers"]["downloadbuffer"] * 1024,
+                        interval=self._config.sections["transfers"]["downloadflushinterval"]
+                    )
+
+                    if msgObj.filesize is not None and self._config.sections["transfers"]["preallocate"]:
+                        preallocate(msgObj.file, msgObj.filesize)
 
                     conns[msgObj.conn].obuf.extend(struct.pack("<Q", msgObj.offset))
                     conns[msgObj.conn].obuf.extend(struct.pack("<i", 0))
@@ -1048,7 +1303,8 @@ class SlskProtoThread(threading.Thread):
                     self._downloadlimit = (self._calcDownloadLimitByTotal, msgObj.limit)
 
         if needsleep:
-            time.sleep(1)
+            # Wait for the server connection before sending the messages put back in the queue
+            self._queueretry = time.time() + 1
 
         return conns, connsinprogress, server_socket
 
@@ -1062,15 +1318,17 @@ class SlskProtoThread(threading.Thread):
         conn = conns[i]
 
         conn.lastactive = time.time()
-        i.setblocking(0)
 
-        if limit is None:
-            bytes_send = i.send(conn.obuf)
-        else:
-            bytes_send = i.send(conn.obuf[:limit])
+        if i is not server_socket and conn.sendfile and not conn.obuf and self._hasFileData(conn):
+            self.sendFileData(i, conn, limit)
+            return
 
-        i.setblocking(1)
-        conn.obuf = conn.obuf[bytes_send:]
+        i.setblocking(0)
+
+        try:
+            bytes_send = conn.obuf.send(i, limit)
+        finally:
+            i.setblocking(1)
 
         if i is not server_socket:
             if conn.fileupl is not None and conn.fileupl.offset is not None:
@@ -1109,6 +1367,58 @@ class SlskProtoThread(threading.Thread):
                     self._ui_callback([conn.fileupl])
                     self.last_file_output_update = curtime
 
+    def sendFileData(self, i, conn, limit):
+        """ Send upload data with os.sendfile, straight from the file to the socket.
+        At most limit bytes are sent, to keep to the upload speed limit. If the file
+        can't be sent this way, the connection falls back to reading it into obuf. """
+
+        fileupl = conn.fileupl
+        position = fileupl.offset + fileupl.sentbytes
+        count = min(fileupl.size - position, self.SENDFILE_CHUNK if limit is None else limit)
+
+        i.setblocking(0)
+
+        try:
+            bytes_send = os.sendfile(i.fileno(), fileupl.file.fileno(), position, count)
+
+        except (BlockingIOError, InterruptedError):
+            bytes_send = 0
+
+        except ValueError:
+            # The file was closed, the transfer is being aborted
+            return
+
+        except OSError as error:
+            if error.errno not in (EINVAL, ENOSYS, ENOTSOCK, EOPNOTSUPP):
+                raise
+
+            # Not supported for this file or socket, os.sendfile didn't move the file position
+            conn.sendfile = False
+
+            try:
+                fileupl.file.seek(position)
+            except (IOError, ValueError) as strerror:
+                self._ui_callback([FileError(conn, fileupl.file, strerror)])
+
+            return
+
+        finally:
+            i.setblocking(1)
+
+        if bytes_send <= 0:
+            return
+
+        fileupl.sentbytes += bytes_send
+        conn.sentbytes2 += bytes_send
+
+        curtime = time.time()
+
+        if fileupl.offset + fileupl.sentbytes == fileupl.size or \
+                (curtime - self.last_file_output_update) > 1:
+
+            self._ui_callback([fileupl])
+            self.last_file_output_update = curtime
+
     def readData(self, conns, i):
         # Check for a download limit
         if i in self._dlimits:
@@ -1134,10 +1444,11 @@ class SlskProtoThread(threading.Thread):
             conn.ibuf.extend(data)
             conn.lastreadlength = limit
             conn.readbytes2 += len(data)
+            conn.nextread = conn.lastactive + self.SHAPING_INTERVAL
 
         if not data:
-            self._ui_callback([ConnClose(i, conn.addr)])
             self.close_connection(conns, i)
+            self._ui_callback([ConnClose(i, conn.addr)])
 
     def run(self):
         """ Actual networking loop is here."""
@@ -1151,10 +1462,11 @@ class SlskProtoThread(threading.Thread):
         conns = self._conns
         connsinprogress = self._connsinprogress
         queue = self._queue
+        selector = self._selector
 
         while not self._want_abort:
 
-            if not queue.empty():
+            if not queue.empty() and time.time() >= self._queueretry:
                 conns, connsinprogress, server_socket = self.process_queue(queue, conns, connsinprogress, server_socket)
                 self._server_socket = server_socket
 
@@ -1163,32 +1475,62 @@ class SlskProtoThread(threading.Thread):
 
             try:
                 # Select Networking Input and Output sockets
-                selector = selectors.DefaultSelector()
+                curtime = time.time()
 
-                timeout = -1
+                # The earliest time something has to be done when no socket events come in
+                deadline = None
 
                 for i in conns:
                     conn = conns[i]
                     event_masks = selectors.EVENT_READ
 
-                    if len(conn.obuf) > 0 or (i is not server_socket and conn.fileupl is not None and conn.fileupl.offset is not None):
+                    if len(conn.obuf) > 0 or (i is not server_socket and self._hasFileData(conn)):
                         if self._isUpload(conn):
                             limit = self._uploadlimit[0](conns, conn)
 
                             if limit is None or limit > 0:
                                 self._ulimits[i] = limit
                                 event_masks |= selectors.EVENT_WRITE
+                            else:
+                                deadline = self._earliest(deadline, curtime + self.SHAPING_INTERVAL)
 
                         else:
                             event_masks |= selectors.EVENT_WRITE
 
-                    selector.register(i, event_masks)
+                    if i is not server_socket:
+                        if self._isDownload(conn) and conn.nextread > curtime:
+                            # Used up the download limit for now
+                            event_masks &= ~selectors.EVENT_READ
+                            deadline = self._earliest(deadline, conn.nextread)
 
+                        if self._isDownload(conn) and conn.filesink.flushtime is not None:
+                            deadline = self._earliest(deadline, conn.filesink.flushtime)
+
+                        deadline = self._earliest(deadline, conn.lastactive + self.CONNECTION_MAX_IDLE)
+
+                    self._setSocketEvents(i, event_masks)
+
+                # Registered once when connecting starts, unchanged until the connection is made
                 for i in connsinprogress:
-                    event_masks = selectors.EVENT_READ | selectors.EVENT_WRITE
-                    selector.register(i, event_masks)
+                    self._setSocketEvents(i, selectors.EVENT_READ | selectors.EVENT_WRITE)
+                    deadline = self._earliest(deadline, connsinprogress[i].lastactive + self.IN_PROGRESS_STALE_AFTER)
+
+                self._setSocketEvents(p, selectors.EVENT_READ)
+                self._setSocketEvents(self._wakeup_read, selectors.EVENT_READ)
 
-                selector.register(p, selectors.EVENT_READ)
+                if not queue.empty():
+                    deadline = self._earliest(deadline, self._queueretry)
+
+                if self._lastconncount != len(conns) + len(connsinprogress):
+                    deadline = self._earliest(deadline, self.last_conncount_ui_update + self.CONNCOUNT_UI_INTERVAL)
+
+                if deadline is None:
+                    timeout = None
+                else:
+                    timeout = max(deadline - curtime, 0)
+
+                if not isinstance(queue, NetworkQueue) and (timeout is None or timeout > self.POLL_INTERVAL):
+                    timeout = self.POLL_INTERVAL
 
                 key_events = selector.select(timeout)
                 input = set(key.fileobj for key, event in key_events if event & selectors.EVENT_READ)
@@ -1213,15 +1555,18 @@ class SlskProtoThread(threading.Thread):
                 time.sleep(0.2)
                 continue
 
+            if self._wakeup_read in input:
+                self._drainWakeupPipe()
+
             # Update UI connection count
             curtime = time.time()
+            numsockets = len(conns) + len(connsinprogress)
 
-            if (curtime - self.last_conncount_ui_update) > self.CONNCOUNT_UI_INTERVAL:
+            if numsockets != self._lastconncount and (curtime - self.last_conncount_ui_update) >= self.CONNCOUNT_UI_INTERVAL:
                 # Avoid sending too many updates to the UI at once, if there are a lot of connections
-                numsockets = len(conns) + len(connsinprogress)
-
                 self._ui_callback([SetCurrentConnectionCount(numsockets)])
                 self.last_conncount_ui_update = curtime
+                self._lastconncount = numsockets
 
             # Listen / Peer Port
             if p in input:
@@ -1276,6 +1621,7 @@ class SlskProtoThread(threading.Thread):
                             if self.ipBlocked(addr[0]):
                                 message = "Blocking peer connection in progress to IP: %(ip)s Port: %(port)s" % {"ip": addr[0], "port": addr[1]}
                                 log.add(message, 3)
+                                self._unregisterSocket(connection_in_progress)
                                 connection_in_progress.close()
                             else:
                                 conns[connection_in_progress] = PeerConnection(conn=connection_in_progress, addr=addr, init=msgObj.init)
@@ -1296,8 +1642,8 @@ class SlskProtoThread(threading.Thread):
                         self.writeData(server_socket, conns, connection)
 
                     except socket.error as err:
-                        self._ui_callback([ConnectError(conn_obj, err)])
                         self.close_connection(conns, connection)
+                        self._ui_callback([ConnectError(conn_obj, err)])
                         continue
 
                 if connection is not server_socket:
@@ -1307,10 +1653,15 @@ class SlskProtoThread(threading.Thread):
                         # Timeout Connections
 
                         if curtime - conn_obj.lastactive > self.CONNECTION_MAX_IDLE:
-                            self._ui_callback([ConnClose(connection, addr)])
                             self.close_connection(conns, connection)
+                            self._ui_callback([ConnClose(connection, addr)])
                             continue
 
+                    if self._isDownload(conn_obj) and conn_obj.filesink.flushtime is not None and \
+                            curtime >= conn_obj.filesink.flushtime:
+                        # No more data arrived, don't keep the buffered data waiting
+                        self._flushDownload(conn_obj)
+
                     if self.ipBlocked(addr[0]):
                         message = "Blocking peer connection to IP: %(ip)s Port: %(port)s" % {"ip": addr[0], "port": addr[1]}
                         log.add(message, 3)
@@ -1322,20 +1673,21 @@ class SlskProtoThread(threading.Thread):
                         limit = self._downloadlimit[0](conns, connection)
 
                         if limit is None or limit > 0:
-                            self._dlimits[connection] = int(limit * 0.2)  # limit is per second, we loop 5 times a second
+                            # limit is per second, one read is allowed every SHAPING_INTERVAL seconds
+                            self._dlimits[connection] = int(limit * self.SHAPING_INTERVAL)
 
                     try:
                         self.readData(conns, connection)
 
                     except socket.error as err:
-                        self._ui_callback([ConnectError(conn_obj, err)])
                         self.close_connection(conns, connection)
+                        self._ui_callback([ConnectError(conn_obj, err)])
                         continue
 
                 try:
                     if len(conn_obj.ibuf) > 0:
                         if connection is server_socket:
-                            msgs, conns[server_socket].ibuf = self.process_server_input(conns[server_socket].ibuf)
+                            msgs, conn_obj.ibuf = self.process_server_input(conn_obj.ibuf)
                             self._ui_callback(msgs)
 
                         else:
@@ -1356,15 +1708,43 @@ class SlskProtoThread(threading.Thread):
                 except KeyError:
                     pass
 
-            # Don't exhaust the CPU
-            time.sleep(0.2)
-
         # Close Server Port
         if server_socket is not None:
             server_socket.close()
 
+        selector.close()
+
+        if isinstance(queue, NetworkQueue):
+            queue.wakeup = None
+
+        self._closeWakeupPipe()
+
         # Networking thread aborted
 
+    def _flushDownload(self, conn):
+        """ Write the buffered data of a download to the file """
+
+        if conn.filesink is None:
+            return
+
+        try:
+            conn.filesink.flush()
+
+        except IOError as strerror:
+            self._ui_callback([FileError(conn, conn.filedown.file, strerror)])
+
+        except ValueError:
+            # The file was closed, the transfer is being aborted
+            pass
+
+    def _earliest(self, deadline, when):
+
+        if deadline is None or when < deadline:
+            return when
+
+        return deadline
+
     def abort(self):
         """ Call this to abort the thread """
         self._want_abort = True
+        self._wakeup()
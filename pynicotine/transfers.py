@@ -817,22 +817,15 @@ class Transfers:
         if not os.access(realfilename, os.R_OK):
             return False
 
-        (dir, sep, file) = virtualfilename.rpartition('\\')
+        # Look the exact path up in the path table of the search index, instead of loading its folder from the shares database
+        transfers = self.eventprocessor.config.sections["transfers"]
 
-        if self.eventprocessor.config.sections["transfers"]["enablebuddyshares"]:
+        if transfers["enablebuddyshares"]:
             if user in [i[0] for i in self.eventprocessor.config.sections["server"]["userlist"]]:
-                bshared = self.eventprocessor.config.sections["transfers"]["bsharedfiles"]
-                for i in bshared.get(str(dir), ''):
-                    if file == i[0]:
-                        return True
-
-        shared = self.eventprocessor.config.sections["transfers"]["sharedfiles"]
+                if transfers["bsearchindex"].find_file(virtualfilename) is not None:
+                    return True
 
-        for i in shared.get(str(dir), ''):
-            if file == i[0]:
-                return True
-
-        return False
+        return transfers["searchindex"].find_file(virtualfilename) is not None
 
     def getTransferringUsers(self):
         return [i.user for i in self.uploads if i.req is not None or i.conn is not None or i.status == "Getting status"]  # some file is being transfered
@@ -0,0 +1,60 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import zlib
+
+from pynicotine.browsecache import BrowseCache
+from pynicotine.slskmessages import SharedFileList
+from pynicotine.slskmessages import SlskMessage
+
+
+def test_store_and_load(tmp_path):
+    cache = BrowseCache(str(tmp_path), "streams")
+    assert cache.load() is None
+
+    cache.store([b"compressed ", b"shares"], cache.generation)
+    assert BrowseCache(str(tmp_path), "streams").load() == b"compressed shares"
+
+
+def test_stale_generation(tmp_path):
+    cache = BrowseCache(str(tmp_path), "streams")
+    generation = cache.generation
+    cache.store([b"old shares"], generation)
+
+    cache.bump()
+
+    # Messages built before the share changed are neither loaded nor stored
+    cache.store([b"old shares"], generation)
+    assert BrowseCache(str(tmp_path), "streams").load() is None
+
+    cache.store([b"new shares"], cache.generation)
+    assert BrowseCache(str(tmp_path), "streams").load() == b"new shares"
+
+
+def test_compressed_shared_file_list():
+    streams = {
+        'Music\\Gwen Stefani': SlskMessage().packObject(0),
+        'Music\\Auto': SlskMessage().packObject(0)
+    }
+    message = SharedFileList(None, streams)
+    compressed = b"".join(message.iterCompressedChunks())
+
+    assert zlib.decompress(compressed) == b"".join(message.iterChunks())
+
+    message.parseNetworkMessage(compressed)
+    assert message.list == [('Music\\Gwen Stefani', []), ('Music\\Auto', [])]
@@ -0,0 +1,131 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+from unittest.mock import Mock, MagicMock
+
+import pytest
+
+from pynicotine.downloadsink import DownloadSink
+from pynicotine.downloadsink import preallocate
+from pynicotine.slskmessages import DownloadFile
+from pynicotine.slskproto import MessageBuffer
+from pynicotine.slskproto import PeerConnection
+from pynicotine.slskproto import SlskProtoThread
+
+DATA = os.urandom(300000)
+
+
+def test_coalesce(tmp_path):
+    filename = tmp_path / "INCOMPLETEfile.bin"
+
+    with open(str(filename), 'ab+') as file:
+        sink = DownloadSink(file, buffersize=100000, interval=60)
+
+        for i in range(0, 150000, 1000):
+            sink.write(DATA[i:i + 1000])
+
+        # One write once the buffer was full, the rest is still buffered
+        assert file.tell() == 100000
+        assert len(sink) == 50000
+
+        sink.flush()
+
+        assert file.tell() == 150000
+        assert sink.flushtime is None
+
+        # Large chunks are written right away
+        sink.write(DATA[150000:])
+        assert len(sink) == 0
+
+    assert filename.read_bytes() == DATA
+
+
+def test_interval(tmp_path):
+    with open(str(tmp_path / "INCOMPLETEfile.bin"), 'ab+') as file:
+        sink = DownloadSink(file, buffersize=100000, interval=0)
+
+        sink.write(DATA[:1000])
+        assert file.tell() == 1000
+
+        sink = DownloadSink(file, buffersize=100000, interval=60)
+        sink.write(DATA[1000:2000])
+
+        assert sink.flushtime is not None
+        assert file.tell() == 1000
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="preallocation is only supported on Linux")
+def test_preallocate(tmp_path):
+    filename = tmp_path / "INCOMPLETEfile.bin"
+    filename.write_bytes(DATA[:1000])
+
+    with open(str(filename), 'ab+') as file:
+        if not preallocate(file, len(DATA)):
+            pytest.skip("fallocate is not supported by the file system")
+
+        # Resuming depends on the size of the incomplete file
+        assert os.fstat(file.fileno()).st_size == 1000
+
+        file.write(DATA[1000:])
+
+    assert filename.read_bytes() == DATA
+
+
+def test_file_input(tmp_path):
+    config = MagicMock()
+    config.sections = {'server': {'portrange': (1, 2)}, 'transfers': {'downloadlimit': 10}}
+    ui_callback = Mock()
+
+    proto = SlskProtoThread(
+        ui_callback=ui_callback, queue=Mock(), bindip='',
+        port=None, config=config, eventprocessor=Mock()
+    )
+
+    filename = tmp_path / "INCOMPLETEfile.bin"
+    filename.write_bytes(DATA[:1000])
+    file = open(str(filename), 'ab+')
+
+    conn = PeerConnection(conn=Mock(), addr=('127.0.0.1', 2234))
+    conn.filereq = Mock()
+    conn.filedown = DownloadFile(conn.conn, 1000, file, len(DATA))
+    conn.filesink = DownloadSink(file, buffersize=1024 * 1024, interval=60)
+    conn.bytestoread = len(DATA) - 1000
+    proto.last_file_input_update = float("inf")
+
+    buf = MessageBuffer()
+
+    for i in range(1000, len(DATA), 10000):
+        buf.extend(DATA[i:i + 10000])
+        proto.process_file_input(conn, buf)
+
+        if conn.filereadbytes < conn.bytestoread:
+            # Nothing written or sent to the UI until the download completes
+            assert file.tell() == 1000
+
+    msg = ui_callback.call_args[0][0][0]
+
+    assert isinstance(msg, DownloadFile)
+    assert msg.file.tell() == len(DATA)
+
+    file.close()
+    proto.abort()
+
+    assert filename.read_bytes() == DATA
@@ -25,8 +25,8 @@ from unittest.mock import Mock, MagicMock
 
 import pytest
 
-from pynicotine.slskproto import SlskProtoThread
-from pynicotine.slskmessages import ServerConn, Login, SetWaitPort
+from pynicotine.slskproto import NetworkQueue, SlskProtoThread
+from pynicotine.slskmessages import ServerConn, Login, SetGeoBlock, SetWaitPort
 from test.unit.mock_socket import monkeypatch_socket, monkeypatch_select
 
 # Time (in s) needed for SlskProtoThread main loop to run at least once
@@ -37,25 +37,42 @@ LOGIN_DATAFILE = 'data/login/socket_localhost_22420.log'
 @pytest.fixture
 def config():
     config = MagicMock()
-    config.sections = {'server': {'portrange': (1, 2)}, 'transfers': {'downloadlimit': 10}}
+    # Listen on any free port, ports below 1024 need root
+    config.sections = {'server': {'portrange': (0, 0)}, 'transfers': {'downloadlimit': 10}}
     return config
 
 
-def test_instantiate_proto(config) -> None:
+@pytest.fixture
+def protothreads():
+    """ Networking threads started by a test, stopped once it's done """
+
+    threads = []
+    yield threads
+
+    for proto in threads:
+        proto.abort()
+
+        if proto.is_alive():
+            proto.join(1)
+
+
+def test_instantiate_proto(config, protothreads) -> None:
     proto = SlskProtoThread(
         ui_callback=Mock(), queue=Mock(), bindip='',
         port=None, config=config, eventprocessor=Mock()
     )
+    protothreads.append(proto)
     proto.abort()
 
 
-def test_server_conn(config, monkeypatch) -> None:
+def test_server_conn(config, monkeypatch, protothreads) -> None:
     mock_socket = monkeypatch_socket(monkeypatch, LOGIN_DATAFILE)
     monkeypatch_select(monkeypatch)
     proto = SlskProtoThread(
         ui_callback=Mock(), queue=Queue(0), bindip='',
         port=None, config=config, eventprocessor=Mock()
     )
+    protothreads.append(proto)
     proto._queue.put(ServerConn())
 
     sleep(SLSKPROTO_RUN_TIME)
@@ -82,13 +99,16 @@ def test_server_conn(config, monkeypatch) -> None:
     assert mock_socket.close.call_count == 1
 
 
-def test_login(config, monkeypatch) -> None:
+def test_login(config, monkeypatch, protothreads) -> None:
     monkeypatch_select(monkeypatch)
     proto = SlskProtoThread(
         ui_callback=Mock(), queue=Queue(0), bindip='',
         port=None, config=config, eventprocessor=Mock()
     )
-    proto._queue.put(ServerConn())
+    protothreads.append(proto)
+
+    # Nothing listens on the port, the connection is refused
+    proto._queue.put(ServerConn(addr=('127.0.0.1', 1)))
 
     sleep(SLSKPROTO_RUN_TIME / 2)
 
@@ -99,3 +119,23 @@ def test_login(config, monkeypatch) -> None:
 
     proto.abort()
     pytest.skip('Login succeeded, actual test TBD')
+
+
+def test_queue_wakeup(config, protothreads) -> None:
+    proto = SlskProtoThread(
+        ui_callback=Mock(), queue=NetworkQueue(), bindip='',
+        port=None, config=config, eventprocessor=Mock()
+    )
+    protothreads.append(proto)
+
+    # Nothing to wait for, the networking thread only wakes up for the message
+    sleep(SLSKPROTO_RUN_TIME)
+    proto._queue.put(SetGeoBlock(('cc', 'US')))
+    sleep(0.05)
+
+    assert proto._geoip == ('cc', 'US')
+
+    proto.abort()
+    proto.join(1)
+
+    assert not proto.is_alive()
@@ -0,0 +1,115 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import socket
+import struct
+
+from unittest.mock import Mock, MagicMock
+
+import pytest
+
+from pynicotine.slskmessages import AdminMessage
+from pynicotine.slskproto import MessageBuffer
+from pynicotine.slskproto import SlskProtoThread
+
+
+def admin_message(text):
+    payload = text.encode()
+    payload = struct.pack("<I", len(payload)) + payload
+    return struct.pack("<ii", len(payload) + 4, 66) + payload
+
+
+@pytest.fixture
+def proto():
+    config = MagicMock()
+    config.sections = {'server': {'portrange': (1, 2)}, 'transfers': {'downloadlimit': 10}}
+
+    proto = SlskProtoThread(
+        ui_callback=Mock(), queue=Mock(), bindip='',
+        port=None, config=config, eventprocessor=Mock()
+    )
+
+    yield proto
+
+    proto.abort()
+
+
+def test_framing(proto):
+    buf = MessageBuffer()
+    tail = admin_message("last")
+
+    for i in range(1000):
+        buf.extend(admin_message("message %i" % i))
+
+    buf.extend(tail[:6])
+
+    msgs, buf = proto.process_server_input(buf)
+
+    assert len(msgs) == 1000
+    assert all(isinstance(msg, AdminMessage) for msg in msgs)
+    assert msgs[999].msg == "message 999"
+    assert len(buf) == 6
+    assert buf[:] == tail[:6]
+
+    buf.extend(tail[6:])
+    msgs, buf = proto.process_server_input(buf)
+
+    assert [msg.msg for msg in msgs] == ["last"]
+    assert not buf
+    assert buf.offset == 0
+
+
+def test_compaction():
+    buf = MessageBuffer()
+    buf.extend(bytes(range(200)) * 1000)
+
+    buf.consume(50000)
+    assert buf.offset == 50000
+
+    # Past the threshold, but less than half the buffer is consumed
+    buf.consume(20000)
+    assert buf.offset == 70000
+
+    buf.consume(50000)
+    assert buf.offset == 0
+    assert len(buf) == 80000
+    assert buf[0] == 120000 % 200
+    assert buf.unpack("<B", 199)[0] == (120000 + 199) % 200
+
+    buf.consume(100000)
+    assert len(buf) == 0
+    assert len(buf.data) == 0
+
+
+def test_send_write():
+    buf = MessageBuffer()
+    buf.extend(b"0123456789")
+    sock, peer = socket.socketpair()
+
+    with sock, peer:
+        assert buf.send(sock, 4) == 4
+        assert peer.recv(10) == b"0123"
+        assert buf[:] == b"456789"
+
+    file = io.BytesIO()
+
+    assert buf.write(file, 3) == 3
+    assert buf.write(file, 10) == 3
+    assert file.getvalue() == b"456789"
+    assert not buf
@@ -0,0 +1,53 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+from pynicotine.metadatacache import MetadataCache
+
+
+def test_cache_key_changes_with_file(tmp_path):
+    path = tmp_path / "song.mp3"
+    path.write_bytes(b"a" * 10)
+    key = MetadataCache.get_key(os.stat(str(path)))
+
+    assert key == MetadataCache.get_key(os.stat(str(path)))
+
+    path.write_bytes(b"a" * 20)
+    assert key != MetadataCache.get_key(os.stat(str(path)))
+
+
+def test_persist_and_prune(tmp_path):
+    filename = str(tmp_path / "metadata.db")
+    cache = MetadataCache(filename)
+
+    cache.begin_scan()
+    cache.set("1:1:10:0", ((320, 0), 200))
+    cache.set("1:2:10:0", (None, None))
+    cache.end_scan()
+    cache.close()
+
+    cache = MetadataCache(filename)
+    cache.begin_scan()
+    assert cache.get("1:1:10:0") == ((320, 0), 200)
+    cache.end_scan(prune=True)
+
+    assert cache.get("1:2:10:0") is None
+    assert cache.get("1:1:10:0") == ((320, 0), 200)
+    cache.close()
@@ -0,0 +1,79 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from pynicotine.rescancheckpoint import RescanCheckpoint
+
+FILES = [('01 - Hollaback Girl.mp3', 4012345, (320, 0), 199)]
+
+
+def test_resume(tmp_path):
+    filename = str(tmp_path / "shares.checkpoint")
+
+    checkpoint = RescanCheckpoint(filename, interval=0)
+    checkpoint.add('/music/gwen', 1000.0, FILES)
+    assert checkpoint.save()
+    checkpoint.add('/music/auto', 2000.0, [])
+    assert checkpoint.save()
+    checkpoint.close()
+
+    checkpoint = RescanCheckpoint(filename)
+
+    assert checkpoint.load() == 2
+    assert checkpoint.get('/music/gwen', 1000.0) == FILES
+    assert checkpoint.get('/music/gwen', 1001.0) is None
+    assert checkpoint.get('/music/other', 1000.0) is None
+    assert checkpoint.restored == 1
+
+    checkpoint.remove()
+    assert RescanCheckpoint(filename).load() == 0
+
+
+def test_torn_batch(tmp_path):
+    filename = tmp_path / "shares.checkpoint"
+
+    checkpoint = RescanCheckpoint(str(filename), interval=0)
+    checkpoint.add('/music/gwen', 1000.0, FILES)
+    checkpoint.save()
+    size = filename.stat().st_size
+
+    checkpoint.add('/music/auto', 2000.0, FILES)
+    checkpoint.save()
+    checkpoint.close()
+
+    # Interrupted while writing the second batch
+    with open(str(filename), "r+b") as handle:
+        handle.truncate(filename.stat().st_size - 5)
+
+    checkpoint = RescanCheckpoint(str(filename), interval=0)
+
+    assert checkpoint.load() == 1
+    assert filename.stat().st_size == size
+
+    # Later batches are appended after the last complete one
+    checkpoint.add('/music/auto', 2000.0, FILES)
+    checkpoint.save()
+    checkpoint.close()
+
+    assert RescanCheckpoint(str(filename)).load() == 2
+
+
+def test_invalid_file(tmp_path):
+    filename = tmp_path / "shares.checkpoint"
+    filename.write_bytes(b"not a checkpoint")
+
+    assert RescanCheckpoint(str(filename)).load() == 0
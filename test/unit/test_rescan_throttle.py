@@ -0,0 +1,64 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from pynicotine import rescanthrottle
+from pynicotine.rescanthrottle import RescanThrottle
+
+
+def test_files_rate():
+    throttle = RescanThrottle()
+    throttle.set_limits(filesrate=100)
+
+    starttime = time.monotonic()
+
+    for _ in range(10):
+        throttle.wait(1000)
+
+    assert time.monotonic() - starttime >= 0.09
+
+
+def test_bytes_rate():
+    throttle = RescanThrottle()
+    throttle.set_limits(bytesrate=1000000)
+
+    starttime = time.monotonic()
+    throttle.wait(100000)
+
+    assert time.monotonic() - starttime >= 0.09
+
+
+def test_idle_only(monkeypatch):
+    monkeypatch.setattr(rescanthrottle, "IDLE_INTERVAL", 0.01)
+    uploads = [3]
+
+    def busy():
+        uploads[0] -= 1
+        return uploads[0] > 0
+
+    throttle = RescanThrottle(busy=busy)
+    throttle.wait(1000)
+
+    # Not waited on without idle only mode
+    assert uploads[0] == 3
+
+    throttle.set_limits(idleonly=True)
+    throttle.wait(1000)
+
+    assert uploads[0] <= 0
@@ -0,0 +1,423 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from pynicotine import searchindex
+from pynicotine import slskmessages
+from pynicotine.searchindex import FileTable
+from pynicotine.searchindex import SearchIndex
+from pynicotine.searchindex import SearchIndexError
+from pynicotine.searchindex import build_index
+from pynicotine.searchindex import iter_matches
+from pynicotine.searchindex import parse_search_term
+from pynicotine.searchindex import write_search_index
+
+SHARED_FILES = {
+    'Music\\Gwen Stefani': [
+        ('01 - Hollaback Girl.mp3', 4012345, (320, 0), 199),
+        ('cover.jpg', 51234, None, None)
+    ],
+    'Music\\Auto': [
+        ('70 gwen auto.flac', 30123456, (1000, 0), 240),
+        ('Ünïcödé.ogg', 1234, (128, 0), 10)
+    ]
+}
+
+
+@pytest.fixture
+def index_file(tmp_path):
+    filename = str(tmp_path / "searchindex.idx")
+    write_search_index(filename, *build_index(SHARED_FILES))
+    return filename
+
+
+def test_lookup(index_file):
+    index = SearchIndex(index_file)
+
+    assert index.num_files == 4
+    assert list(index.lookup('music')) == [0, 1, 2, 3]
+    assert list(index.lookup('gwen')) == [0, 1, 2]
+    assert list(index.lookup('ünïcödé')) == [3]
+    assert index.lookup('stefanie') is None
+    assert 'auto' in index
+
+    index.close()
+
+
+def test_get_file(index_file):
+    index = SearchIndex(index_file)
+
+    assert index.get_file(0) == ('Music\\Gwen Stefani\\01 - Hollaback Girl.mp3', 4012345, (320, 0), 199)
+    assert index.get_file(1) == ('Music\\Gwen Stefani\\cover.jpg', 51234, None, None)
+    assert index.get_file(3) == ('Music\\Auto\\Ünïcödé.ogg', 1234, (128, 0), 10)
+
+    with pytest.raises(IndexError):
+        index.get_file(4)
+
+    index.close()
+
+
+def test_empty_index(tmp_path):
+    index = SearchIndex(str(tmp_path / "missing.idx"))
+
+    assert len(index) == 0
+    assert index.lookup('gwen') is None
+
+    filename = str(tmp_path / "empty.idx")
+    write_search_index(filename, {}, [])
+    index = SearchIndex(filename)
+
+    assert len(index) == 0
+    assert index.lookup('gwen') is None
+
+
+def test_corrupt_index(tmp_path):
+    filename = tmp_path / "corrupt.idx"
+    filename.write_bytes(b"not an index" * 10)
+
+    with pytest.raises(SearchIndexError):
+        SearchIndex(str(filename))
+
+
+def test_add_remove_files(index_file):
+    index = SearchIndex(index_file)
+
+    assert index.remove_file('Music\\Gwen Stefani\\cover.jpg')
+    assert not index.remove_file('Music\\Gwen Stefani\\cover.jpg')
+
+    new = index.add_file(('Music\\Gwen Stefani\\Rich Girl.mp3', 1234, (192, 0), 236))
+
+    assert new == 4
+    assert len(index) == 4
+    assert index.query(['gwen']) == [0, 2, 4]
+    assert list(index.lookup('rich')) == [4]
+    assert index.query(['cover']) == []
+    assert index.is_removed(1)
+    assert index.get_file(4) == ('Music\\Gwen Stefani\\Rich Girl.mp3', 1234, (192, 0), 236)
+
+    index.close()
+
+
+def test_journal_replay(index_file):
+    index = SearchIndex(index_file)
+    index.remove_file('Music\\Auto\\70 gwen auto.flac')
+    index.add_file(('Music\\Auto\\Rich Girl.mp3', 1234, None, None))
+    index.close()
+
+    index = SearchIndex(index_file)
+
+    assert len(index) == 4
+    assert index.query(['auto']) == [3, 4]
+    assert index.get_file(4) == ('Music\\Auto\\Rich Girl.mp3', 1234, None, None)
+
+    index.close()
+
+
+def test_compaction(index_file, tmp_path):
+    index = SearchIndex(index_file)
+    index.remove_file('Music\\Gwen Stefani\\cover.jpg')
+    index.add_file(('Music\\Auto\\Rich Girl.mp3', 1234, (192, 0), 236))
+
+    snapshot = index.snapshot()
+    compacted = str(tmp_path / "compacted.idx")
+    index.write_compacted(compacted, snapshot)
+
+    # Changes made while compacting are carried over
+    index.add_file(('Music\\Auto\\Sweet Escape.mp3', 5678, None, None))
+    index.remove_file('Music\\Gwen Stefani\\01 - Hollaback Girl.mp3')
+
+    index = index.replace_compacted(compacted, snapshot)
+
+    assert index.num_files == 4
+    assert len(index) == 4
+    assert index.query(['girl']) == [3]
+    assert [index.get_file(i)[0] for i in index.lookup('auto')] == [
+        'Music\\Auto\\70 gwen auto.flac', 'Music\\Auto\\Ünïcödé.ogg',
+        'Music\\Auto\\Rich Girl.mp3', 'Music\\Auto\\Sweet Escape.mp3'
+    ]
+    index.close()
+
+    index = SearchIndex(index_file)
+    assert len(index) == 4
+    assert index.query(['hollaback']) == []
+    index.close()
+
+
+def test_compaction_readded_files(tmp_path):
+    filename = str(tmp_path / "searchindex.idx")
+    write_search_index(filename, *build_index({'M': [('a.mp3', 1, None, None)]}))
+
+    index = SearchIndex(filename)
+    snapshot = index.snapshot()
+    compacted = str(tmp_path / "compacted.idx")
+    index.write_compacted(compacted, snapshot)
+
+    # Removed and added again while compacting
+    index.remove_file('M\\a.mp3')
+    index.add_file(('M\\a.mp3', 999, None, None))
+
+    # Added, removed and added again while compacting
+    index.add_file(('M\\b.mp3', 1, None, None))
+    index.remove_file('M\\b.mp3')
+    index.add_file(('M\\b.mp3', 888, None, None))
+
+    assert [index.get_file(i)[1] for i in index.query(['mp3'])] == [999, 888]
+
+    index = index.replace_compacted(compacted, snapshot)
+
+    assert len(index) == 2
+    assert [index.get_file(i)[1] for i in index.query(['mp3'])] == [999, 888]
+    assert index.get_file(index.find_file('M\\a.mp3'))[1] == 999
+    index.close()
+
+    # Replayed from the journal
+    index = SearchIndex(filename)
+    assert [index.get_file(i)[1] for i in index.query(['mp3'])] == [999, 888]
+    index.close()
+
+
+def test_query(index_file):
+    index = SearchIndex(index_file)
+
+    assert index.query(['gwen']) == [0, 1, 2]
+    assert index.query(['gwen', 'mp3']) == [0]
+    assert index.query(['gwen'], ['auto']) == [0, 1]
+    assert index.query(['gwen'], ['unknown']) == [0, 1, 2]
+    assert index.query(['gwen'], maxresults=2) == [0, 1]
+    assert index.query(['gwen', 'unknown']) == []
+    assert index.query([]) == []
+
+    index.close()
+
+
+def test_iter_matches():
+    evens = list(range(0, 1000, 2))
+    threes = list(range(0, 1000, 3))
+
+    assert list(iter_matches([evens, threes, [6, 7, 12, 999]])) == [6, 12]
+    assert list(iter_matches([evens, threes], [range(0, 1000, 4)]))[:3] == [6, 18, 30]
+    assert list(iter_matches([evens, [1, 3]])) == []
+
+
+def test_parse_search_term():
+    assert parse_search_term('Gwen -Auto hollaback_girl') == (['gwen', 'hollaback', 'girl'], ['auto'])
+    assert parse_search_term('*ippy -*auto* * rich*', wildcards=True) == (['*ippy', 'rich*'], ['*auto*'])
+    assert parse_search_term('*ippy') == (['ippy'], [])
+
+
+def test_wildcard_query(index_file, tmp_path):
+    index = SearchIndex(index_file)
+
+    assert index.expand_pattern('*fani') == ['stefani']
+    assert index.query(['hollab*']) == [0]
+    assert index.query(['*usi*']) == [0, 1, 2, 3]
+    assert index.query(['music'], ['*lac']) == [0, 1, 3]
+    assert index.query(['*ünï*']) == [3]
+
+    # Too short to be looked up
+    assert index.query(['*ic']) == []
+
+    index.add_file(('Music\\Auto\\Rich Girl.mp3', 1234, None, None))
+    assert index.query(['ric*']) == [4]
+
+    index.close()
+
+    filename = str(tmp_path / "notrigrams.idx")
+    write_search_index(filename, *build_index(SHARED_FILES), trigrams=False)
+    index = SearchIndex(filename)
+
+    assert index.query(['hollab*']) == []
+    assert index.query(['hollaback']) == [0]
+
+    index.close()
+
+
+def test_pattern_postings_limit(tmp_path, monkeypatch):
+    filename = str(tmp_path / "large.idx")
+    sharedfiles = {'Music\\Common': [('track %i.mp3' % i, 1000, None, None) for i in range(500)]}
+    write_search_index(filename, *build_index(sharedfiles))
+    monkeypatch.setattr(searchindex, "MAX_PATTERN_POSTINGS", 100)
+
+    index = SearchIndex(filename)
+
+    # A single expanded word matches every file
+    assert index.lookup_pattern('comm*') == list(range(100))
+    assert len(index.lookup_pattern('tra*')) == 100
+
+    index.close()
+
+
+def test_result_entries(index_file):
+    index = SearchIndex(index_file)
+    index.add_file(('Music\\Auto\\Rich Girl.mp3', 1234, None, None))
+
+    message = slskmessages.FileSearchResult(
+        None, "user", 0, 1, [0, 1, 4], index, 1, 100, (0, 0), False, 3
+    )
+    message.parseNetworkMessage(message.makeNetworkMessage())
+
+    assert message.list == [
+        [1, 'Music\\Gwen Stefani\\01 - Hollaback Girl.mp3', 4012345, 'mp3', [320, 199, 0]],
+        [1, 'Music\\Gwen Stefani\\cover.jpg', 51234, '', []],
+        [1, 'Music\\Auto\\Rich Girl.mp3', 1234, '', []]
+    ]
+    assert message.inqueue == 0
+
+    index.close()
+
+
+def test_result_entries_closed_index(index_file):
+    index = SearchIndex(index_file)
+    message = slskmessages.FileSearchResult(None, "user", 0, 1, [1], index, 1, 100, (0, 0), False, 3)
+
+    # Replaced by a rescan or compaction before the message is sent
+    index.close()
+
+    message.parseNetworkMessage(message.makeNetworkMessage())
+    assert message.list == [[1, 'Music\\Gwen Stefani\\cover.jpg', 51234, '', []]]
+
+
+def test_file_table():
+    table = FileTable()
+
+    assert table.append('Music\\Auto', ('70 gwen auto.flac', 30123456, (1000, 0), 240)) == 0
+    assert table.append('Music\\Auto', ('Ünïcödé.ogg', 1234, None, None)) == 1
+
+    assert len(table) == 2
+    assert table.directories == ['Music\\Auto']
+    assert table.get_path(1) == 'Music\\Auto\\Ünïcödé.ogg'
+    assert list(table) == [
+        ('Music\\Auto\\70 gwen auto.flac', 30123456, (1000, 0), 240),
+        ('Music\\Auto\\Ünïcödé.ogg', 1234, None, None)
+    ]
+
+
+def test_find_file(index_file):
+    index = SearchIndex(index_file)
+
+    assert index.find_file('Music\\Auto\\Ünïcödé.ogg') == 3
+    assert index.find_file('Music\\Auto\\cover.jpg') is None
+    assert index.get_path(1) == 'Music\\Gwen Stefani\\cover.jpg'
+
+    index.close()
+
+
+def test_find_file_path_table(tmp_path):
+    filename = str(tmp_path / "large.idx")
+    sharedfiles = {'Music\\Common': [('track %i.mp3' % i, 1000, None, None) for i in range(5000)]}
+    write_search_index(filename, *build_index(sharedfiles))
+
+    index = SearchIndex(filename)
+    reads = []
+    get_path_bytes = index._get_path_bytes
+
+    def counting_get_path_bytes(number):
+        reads.append(number)
+        return get_path_bytes(number)
+
+    index._get_path_bytes = counting_get_path_bytes
+
+    # Every file matches the words of the path, only the files in its slot are compared
+    for i in range(0, 5000, 50):
+        assert index.find_file('Music\\Common\\track %i.mp3' % i) == i
+
+    assert index.find_file('Music\\Common\\track 5000.mp3') is None
+    assert len(reads) < 300
+
+    assert index.remove_file('Music\\Common\\track 7.mp3')
+    assert index.find_file('Music\\Common\\track 7.mp3') is None
+
+    new = index.add_file(('Music\\Common\\track 7.mp3', 2000, None, None))
+    assert index.find_file('Music\\Common\\track 7.mp3') == new
+
+    index.close()
+
+
+def test_lookup_after_removal(tmp_path):
+    filename = str(tmp_path / "large.idx")
+    sharedfiles = {'Music\\Common': [('track %i.mp3' % i, 1000, None, None) for i in range(5000)]}
+    write_search_index(filename, *build_index(sharedfiles))
+
+    index = SearchIndex(filename)
+    index.remove_file('Music\\Common\\track 1.mp3')
+    index.add_file(('Music\\Common\\track 5000.mp3', 1000, None, None))
+
+    class CountingSet(set):
+        checks = 0
+
+        def __contains__(self, item):
+            CountingSet.checks += 1
+            return set.__contains__(self, item)
+
+    index._removed = CountingSet(index._removed)
+    postings = index.lookup('common')
+
+    # Posting lists aren't copied to leave out removed files
+    assert len(postings) == 5001
+    assert CountingSet.checks == 0
+
+    assert index.query(['common'], maxresults=3) == [0, 2, 3]
+    assert index.query(['track', '5000']) == [5000]
+    assert CountingSet.checks <= 5
+
+    assert index.find_file('Music\\Common\\track 1.mp3') is None
+    assert not index.remove_file('Music\\Common\\track 1.mp3')
+
+    index.close()
+
+
+def test_update_file(index_file, tmp_path):
+    index = SearchIndex(index_file)
+
+    assert index.update_file(('Music\\Auto\\Ünïcödé.ogg', 1234, (192, 0), 20))
+    assert not index.update_file(('Music\\Auto\\missing.ogg', 1234, None, None))
+
+    new = index.add_file(('Music\\Auto\\Rich Girl.mp3', 1234, None, None))
+    assert index.update_file(('Music\\Auto\\Rich Girl.mp3', 5678, (320, 0), 236))
+
+    assert index.get_file(3) == ('Music\\Auto\\Ünïcödé.ogg', 1234, (192, 0), 20)
+    assert index.get_file(new) == ('Music\\Auto\\Rich Girl.mp3', 5678, (320, 0), 236)
+    assert index.query(['ünïcödé']) == [3]
+    assert len(index) == 5
+
+    message = slskmessages.FileSearchResult(None, "user", 0, 1, [3], index, 1, 100, (0, 0), False, 3)
+    message.parseNetworkMessage(message.makeNetworkMessage())
+    assert message.list == [[1, 'Music\\Auto\\Ünïcödé.ogg', 1234, 'mp3', [192, 20, 0]]]
+
+    index.close()
+
+    # Replayed from the journal
+    index = SearchIndex(index_file)
+    assert index.get_file(3) == ('Music\\Auto\\Ünïcödé.ogg', 1234, (192, 0), 20)
+    assert index.get_file(4) == ('Music\\Auto\\Rich Girl.mp3', 5678, (320, 0), 236)
+
+    snapshot = index.snapshot()
+    compacted = str(tmp_path / "compacted.idx")
+    index.write_compacted(compacted, snapshot)
+
+    # Updated while compacting
+    index.update_file(('Music\\Gwen Stefani\\cover.jpg', 1, None, None))
+
+    index = index.replace_compacted(compacted, snapshot)
+
+    assert index.num_files == 5
+    assert index.get_file(3) == ('Music\\Auto\\Ünïcödé.ogg', 1234, (192, 0), 20)
+    assert index.get_file(1) == ('Music\\Gwen Stefani\\cover.jpg', 1, None, None)
+
+    index.close()
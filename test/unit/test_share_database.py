@@ -0,0 +1,132 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import time
+
+from pynicotine.sharedb import ShareDatabase
+
+
+def test_store(tmp_path):
+    database = ShareDatabase(str(tmp_path / "shares.sqlite"))
+    files = database.open_store("sharedfiles")
+
+    files['Music\\Auto'] = [('70 gwen auto.flac', 30123456, (1000, 0), 240)]
+
+    assert 'Music\\Auto' in files
+    assert files['Music\\Auto'] == [('70 gwen auto.flac', 30123456, (1000, 0), 240)]
+    assert files.get('Music\\Gwen Stefani', []) == []
+    assert list(files) == ['Music\\Auto']
+
+    del files['Music\\Auto']
+    assert len(files) == 0
+
+    files.close()
+
+
+def test_replace_generation(tmp_path):
+    filename = str(tmp_path / "shares.sqlite")
+    database = ShareDatabase(filename)
+    files = database.open_store("sharedfiles")
+    mtimes = database.open_store("sharedmtimes")
+
+    files['Music\\Auto'] = []
+
+    database.replace({
+        "sharedfiles": {'Music\\Gwen Stefani': [('cover.jpg', 51234, None, None)]},
+        "sharedmtimes": {'/music/gwen': 1.5}
+    })
+
+    assert list(files) == ['Music\\Gwen Stefani']
+    assert dict(mtimes) == {'/music/gwen': 1.5}
+
+    files.close()
+    mtimes.close()
+
+    database = ShareDatabase(filename)
+    files = database.open_store("sharedfiles")
+
+    assert list(files) == ['Music\\Gwen Stefani']
+    assert database.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0] == 2
+
+    files.close()
+
+
+def test_write_while_locked(tmp_path):
+    filename = str(tmp_path / "shares.sqlite")
+    database = ShareDatabase(filename)
+    files = database.open_store("sharedfiles")
+
+    # Hold the write lock, like a rescan storing the shares does
+    connection = sqlite3.connect(filename, isolation_level=None)
+    connection.execute("BEGIN IMMEDIATE")
+
+    start = time.monotonic()
+    files['Music\\Auto'] = [('70 gwen auto.flac', 30123456, (1000, 0), 240)]
+    del files['Music\\Auto']
+    files['Music\\Gwen Stefani'] = []
+
+    assert time.monotonic() - start < 1
+    assert list(files) == ['Music\\Gwen Stefani']
+    assert len(files) == 1
+
+    connection.execute("ROLLBACK")
+    connection.close()
+    database.flush()
+
+    assert not database.pending
+    assert files['Music\\Gwen Stefani'] == []
+
+    files.close()
+
+    database = ShareDatabase(filename)
+    files = database.open_store("sharedfiles")
+
+    assert list(files) == ['Music\\Gwen Stefani']
+
+    files.close()
+
+
+def test_replaced_generation_writes(tmp_path):
+    filename = str(tmp_path / "shares.sqlite")
+    database = ShareDatabase(filename)
+    files = database.open_store("sharedfiles")
+
+    # Queue a write while a rescan holds the write lock, and switch generations meanwhile
+    connection = sqlite3.connect(filename, isolation_level=None)
+    connection.execute("BEGIN IMMEDIATE")
+
+    files['Music\\Auto'] = []
+
+    with database.lock:
+        database.generations["sharedfiles"] = 1
+
+    connection.execute("ROLLBACK")
+    connection.close()
+    database.flush()
+
+    assert database.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0] == 0
+
+    database.replace({"sharedfiles": {'Music\\Gwen Stefani': []}})
+    files['Music\\Auto'] = []
+    database.flush()
+
+    assert list(files) == ['Music\\Auto', 'Music\\Gwen Stefani']
+    assert database.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0] == 2
+
+    files.close()
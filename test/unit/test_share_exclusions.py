@@ -0,0 +1,73 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from pynicotine.shareexclusions import ShareExclusions
+
+RULES = [["*.part", 1], ["sample", 1], ["~.*\\.tmp", 0], ["[unclosed", 0]]
+
+
+def test_match():
+    exclusions = ShareExclusions(RULES)
+
+    assert exclusions.match("01 - Hollaback Girl.mp3.part")
+    assert exclusions.match("Sample")
+    assert exclusions.match("~lock.tmp")
+
+    assert not exclusions.match("01 - Hollaback Girl.mp3")
+    assert not exclusions.match("Samples")
+    assert not exclusions.match("lock.tmp")
+
+    assert list(exclusions.errors) == ["[unclosed"]
+
+
+def test_counts():
+    exclusions = ShareExclusions(RULES)
+
+    for name in ("a.part", "b.PART", "sample", "c.mp3"):
+        exclusions.match(name)
+
+    assert exclusions.get_counts() == [("*.part", 2), ("sample", 1)]
+
+    exclusions.reset_counts()
+    assert exclusions.get_counts() == []
+
+
+def test_inline_flags():
+    exclusions = ShareExclusions([["(?x) sample", 0], ["*.part", 1]])
+
+    assert exclusions.match("Sample")
+    assert exclusions.match("a.part")
+    assert not exclusions.match("a.mp3")
+
+
+def test_backreferences():
+    exclusions = ShareExclusions([["(a|b)x", 0], ["(.)\\1", 0], ["(?P<name>.)-(?P=name)", 0], ["*.part", 1]])
+
+    assert exclusions.match("ax")
+    assert exclusions.match("cc")
+    assert exclusions.match("d-d")
+    assert exclusions.match("a.part")
+
+    assert not exclusions.match("cd")
+    assert not exclusions.match("d-e")
+
+    assert exclusions.get_counts() == [("(a|b)x", 1), ("(.)\\1", 1), ("(?P<name>.)-(?P=name)", 1), ("*.part", 1)]
+
+
+def test_no_rules():
+    assert not ShareExclusions().match("anything")
@@ -0,0 +1,119 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+from queue import Empty
+from queue import Queue
+
+import pytest
+
+from pynicotine.sharewatcher import ShareWatcher
+from pynicotine.sharewatcher import get_file_changes
+from pynicotine.sharewatcher import is_supported
+
+
+@pytest.fixture
+def watch(tmp_path):
+    if not is_supported():
+        pytest.skip("inotify is not available")
+
+    shared = tmp_path / "Music"
+    (shared / "Auto").mkdir(parents=True)
+    (shared / "Auto" / "70 gwen auto.flac").write_bytes(b"flac")
+
+    changes = Queue()
+    watcher = ShareWatcher([str(shared), str(shared / "Auto")], changes.put, delay=0.1, maxdelay=1)
+    watcher.start()
+
+    def wait():
+        """ Returns the folders of the next change """
+
+        try:
+            return changes.get(timeout=5)
+        except Empty:
+            pytest.fail("No change reported")
+
+    # Let the watcher add its watches before changing anything
+    while len(watcher.paths) < 2:
+        time.sleep(0.01)
+
+    yield shared, wait
+
+    watcher.stop()
+    watcher.join(2)
+
+
+def test_create(watch):
+    shared, wait = watch
+
+    (shared / "Auto" / "Ünïcödé.ogg").write_bytes(b"ogg")
+    assert wait() == {str(shared / "Auto")}
+
+    (shared / "Gwen Stefani").mkdir()
+    (shared / "Gwen Stefani" / "cover.jpg").write_bytes(b"jpg")
+
+    folders = wait()
+    assert str(shared) in folders
+    assert str(shared / "Gwen Stefani") in folders
+
+
+def test_delete(watch):
+    shared, wait = watch
+
+    os.unlink(str(shared / "Auto" / "70 gwen auto.flac"))
+    assert wait() == {str(shared / "Auto")}
+
+    os.rmdir(str(shared / "Auto"))
+    assert wait() == {str(shared), str(shared / "Auto")}
+
+
+def test_rename(watch):
+    shared, wait = watch
+
+    os.rename(str(shared / "Auto" / "70 gwen auto.flac"), str(shared / "Auto" / "gwen.flac"))
+    assert wait() == {str(shared / "Auto")}
+
+    os.rename(str(shared / "Auto"), str(shared / "Gwen Stefani"))
+    folders = wait()
+
+    # The old folder is removed from the shares, the new one is read
+    assert str(shared / "Auto") in folders
+    assert str(shared / "Gwen Stefani") in folders
+
+    (shared / "Gwen Stefani" / "cover.jpg").write_bytes(b"jpg")
+    assert wait() == {str(shared / "Gwen Stefani")}
+
+
+def test_file_changes():
+    oldfiles = [
+        ('70 gwen auto.flac', 30123456, (1000, 0), 240),
+        ('cover.jpg', 51234, None, None),
+        ('Ünïcödé.ogg', 1234, None, None)
+    ]
+    newfiles = [
+        ('70 gwen auto.flac', 30123456, (1000, 0), 240),
+        ('Ünïcödé.ogg', 1234, (128, 0), 10),
+        ('Rich Girl.mp3', 1234, (192, 0), 236)
+    ]
+
+    assert get_file_changes(oldfiles, newfiles) == (
+        ['cover.jpg'], [('Rich Girl.mp3', 1234, (192, 0), 236)], [('Ünïcödé.ogg', 1234, (128, 0), 10)]
+    )
+    assert get_file_changes(oldfiles, oldfiles) == ([], [], [])
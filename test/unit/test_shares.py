@@ -0,0 +1,349 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import wave
+
+from queue import Queue
+from unittest.mock import Mock
+
+import pytest
+
+pytest.importorskip("gi")
+pytest.importorskip("taglib")
+
+from gi.repository import GLib  # noqa: E402
+
+from pynicotine import slskmessages  # noqa: E402
+from pynicotine.config import Config  # noqa: E402
+from pynicotine.rescancheckpoint import RescanCheckpoint  # noqa: E402
+from pynicotine.shares import Shares  # noqa: E402
+from pynicotine.transfers import Transfers  # noqa: E402
+
+
+def run_main_loop():
+    """ Run the callbacks the shares queued for the GUI thread """
+
+    context = GLib.MainContext.default()
+
+    while context.pending():
+        context.iteration(False)
+
+
+class ProgressBar:
+    """ Idle callbacks are repeated if they return a true value, unlike
+    the methods of a mock """
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+class Frame:
+    """ Writes and switches to the shares of a rescan like the GUI does """
+
+    def __init__(self, config):
+        self.config = config
+        self.SharesProgress = ProgressBar()
+        self.BuddySharesProgress = ProgressBar()
+        self.shares = None
+
+    def RescanFinished(self, files, streams, wordindex, fileindex, mtimes, type, changed=True):
+
+        pending = self.config.writeShares(type, files, streams, wordindex, fileindex, mtimes)
+
+        def switch():
+            self.config.swapShares(pending)
+
+            if pending is not None and changed:
+                self.shares.browsecaches[type].bump()
+
+            self.shares.reapplyFolderChanges(type)
+
+        GLib.idle_add(switch)
+        return pending is not None
+
+
+@pytest.fixture
+def music(tmp_path):
+    folder = tmp_path / "music"
+
+    for path in ("Gwen Stefani/01 - Hollaback Girl.mp3", "Gwen Stefani/cover.jpg",
+                 "Auto/70 gwen auto.flac", "Auto/Sample/sample.flac", "Auto/track.mp3.part"):
+        filename = folder / path
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        filename.write_bytes(b"x" * 100)
+
+    return folder
+
+
+@pytest.fixture
+def shares(tmp_path, music):
+    config = Config(str(tmp_path / "config"), str(tmp_path / "data"))
+    config.readConfig()
+
+    transfers = config.sections["transfers"]
+    transfers["shared"] = [("Music", str(music))]
+    transfers["shareexclusions"] = [["sample", 1], ["*.part", 1]]
+
+    np = Mock(config=config, queue=Queue(), transfers=None, peerconns=[])
+    np.frame = Frame(config)
+    np.CheckUser.return_value = (1, "")
+    np.logMessage.return_value = None
+
+    shares = np.frame.shares = Shares(np)
+
+    # Rescans replace the databases the shared file lists are compressed from at startup
+    deadline = time.monotonic() + 5
+
+    while (shares.CompressedSharesNormal.built is None or shares.CompressedSharesBuddy.built is None) \
+            and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    yield shares
+
+    shares.close()
+
+
+def rescan(shares, rebuild=False):
+
+    shares.trackFolderChanges("normal")
+    shares.RescanShares(slskmessages.RescanShares(shares.config.sections["transfers"]["shared"], None), rebuild)
+    run_main_loop()
+
+
+def apply_changes(shares, *folders):
+    """ Like an event of the share watcher for folders """
+
+    shares.updateSharedFolders(set(str(folder) for folder in folders))
+    run_main_loop()
+
+
+def search(shares, term):
+
+    searchindex = shares.config.sections["transfers"]["searchindex"]
+    return sorted(searchindex.get_file(i)[0] for i in searchindex.query(term.split()))
+
+
+def test_rescan_exclusions(shares):
+    rescan(shares)
+
+    transfers = shares.config.sections["transfers"]
+
+    assert sorted(transfers["sharedfiles"]) == ['Music', 'Music\\Auto', 'Music\\Gwen Stefani']
+    assert [f[0] for f in transfers["sharedfiles"]['Music\\Auto']] == ['70 gwen auto.flac']
+    assert search(shares, 'gwen') == ['Music\\Auto\\70 gwen auto.flac', 'Music\\Gwen Stefani\\01 - Hollaback Girl.mp3',
+                                      'Music\\Gwen Stefani\\cover.jpg']
+    assert search(shares, 'sample') == []
+
+    assert shares.np.logMessage.call_count
+    messages = [str(call) for call in shares.np.logMessage.call_args_list]
+    assert any("sample" in message and "skipped 1" in message for message in messages)
+
+
+def test_exclusion_counts(shares, music):
+    exclusions = shares.loadShareExclusions()
+
+    # Folders read for the share watcher don't count towards a rescan
+    shares.readSharedFolder(str(music / "Auto"))
+    assert exclusions.get_counts() == []
+
+    list(shares.iterSharedFolders([str(music)], None, exclusions))
+    assert exclusions.get_counts() == [("sample", 1), ("*.part", 1)]
+
+
+def test_watcher_excluded_ancestor(shares, music):
+    (music / "Auto" / "Live").mkdir()
+    (music / "Auto" / "Live" / "live.flac").write_bytes(b"x" * 100)
+    rescan(shares)
+
+    transfers = shares.config.sections["transfers"]
+    assert 'Music\\Auto\\Live' in transfers["sharedfiles"]
+
+    transfers["shareexclusions"].append(["auto", 1])
+    shares.loadShareExclusions()
+
+    assert shares.excludedFolderCheck(str(music / "Auto" / "Live"))
+    assert not shares.excludedFolderCheck(str(music / "Gwen Stefani"))
+
+    # A change in a folder below an excluded folder drops it from the shares
+    (music / "Auto" / "Live" / "live2.flac").write_bytes(b"x" * 100)
+    apply_changes(shares, music / "Auto" / "Live")
+
+    assert 'Music\\Auto\\Live' not in transfers["sharedfiles"]
+    assert search(shares, 'live') == []
+
+
+def test_watcher_changes(shares, music):
+    rescan(shares)
+
+    transfers = shares.config.sections["transfers"]
+    generation = shares.browsecaches["normal"].generation
+    folder = music / "Gwen Stefani"
+
+    # Added
+    (folder / "02 - Rich Girl.mp3").write_bytes(b"x" * 200)
+    apply_changes(shares, folder)
+
+    assert search(shares, 'rich') == ['Music\\Gwen Stefani\\02 - Rich Girl.mp3']
+    assert b"Rich Girl" in transfers["sharedfilesstreams"]['Music\\Gwen Stefani']
+    assert shares.browsecaches["normal"].generation == generation + 1
+
+    # Updated
+    (folder / "02 - Rich Girl.mp3").write_bytes(b"x" * 300)
+    apply_changes(shares, folder)
+
+    searchindex = transfers["searchindex"]
+    assert searchindex.get_file(searchindex.find_file('Music\\Gwen Stefani\\02 - Rich Girl.mp3'))[1] == 300
+    assert shares.browsecaches["normal"].generation == generation + 2
+
+    # Unchanged
+    apply_changes(shares, folder)
+    assert shares.browsecaches["normal"].generation == generation + 2
+
+    # Removed
+    (folder / "02 - Rich Girl.mp3").unlink()
+    apply_changes(shares, folder)
+
+    assert search(shares, 'rich') == []
+    assert b"Rich Girl" not in transfers["sharedfilesstreams"]['Music\\Gwen Stefani']
+    assert shares.browsecaches["normal"].generation == generation + 3
+
+
+def test_watcher_removed_folder(shares, music):
+    rescan(shares)
+
+    for path in (music / "Gwen Stefani").iterdir():
+        path.unlink()
+
+    (music / "Gwen Stefani").rmdir()
+    apply_changes(shares, music / "Gwen Stefani")
+
+    transfers = shares.config.sections["transfers"]
+    assert 'Music\\Gwen Stefani' not in transfers["sharedfiles"]
+    assert 'Music\\Gwen Stefani' not in transfers["sharedfilesstreams"]
+    assert search(shares, 'hollaback') == []
+
+
+def test_lazy_metadata(shares, music):
+    with wave.open(str(music / "Gwen Stefani" / "02 - Cool.wav"), "wb") as audio:
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(8000)
+        audio.writeframes(bytes(2 * 8000 * 3))
+
+    transfers = shares.config.sections["transfers"]
+    transfers["lazymetadata"] = True
+    published = {}
+
+    def readPendingMetadata(folders, scans):
+        run_main_loop()
+        published.update(folders=set(folders), files=list(transfers["sharedfiles"]['Music\\Gwen Stefani']))
+        return readpending(folders, scans)
+
+    readpending = shares.readPendingMetadata
+    shares.readPendingMetadata = readPendingMetadata
+    rescan(shares)
+
+    # Files are shared before their metadata is read
+    assert str(music / "Gwen Stefani") in published["folders"]
+    assert ('02 - Cool.wav', 48044, None, None) in published["files"]
+    assert search(shares, 'cool') == ['Music\\Gwen Stefani\\02 - Cool.wav']
+
+    # The metadata is applied to the shares once it's read
+    assert ('02 - Cool.wav', 48044, (128, 0), 3) in transfers["sharedfiles"]['Music\\Gwen Stefani']
+
+    searchindex = transfers["searchindex"]
+    assert searchindex.get_file(searchindex.find_file('Music\\Gwen Stefani\\02 - Cool.wav'))[2:] == ((128, 0), 3)
+
+
+def test_checkpoint_resume(shares, music):
+    checkpoint = RescanCheckpoint(os.path.join(shares.config.data_dir, "shares.checkpoint"), interval=0)
+    folder = str(music / "Gwen Stefani")
+    checkpoint.add(folder, os.path.getmtime(folder), [('restored.mp3', 1234, None, None)])
+    checkpoint.save()
+    checkpoint.close()
+
+    rescan(shares, rebuild=True)
+
+    transfers = shares.config.sections["transfers"]
+    assert [f[0] for f in transfers["sharedfiles"]['Music\\Gwen Stefani']] == ['restored.mp3']
+    assert [f[0] for f in transfers["sharedfiles"]['Music\\Auto']] == ['70 gwen auto.flac']
+
+    # The checkpoint is removed once the shares are stored
+    assert not os.path.exists(os.path.join(shares.config.data_dir, "shares.checkpoint"))
+
+
+def test_download_added_to_shares(shares, music, tmp_path):
+    transfers = shares.config.sections["transfers"]
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+
+    transfers["sharedownloaddir"] = True
+    transfers["downloaddir"] = str(downloads)
+    rescan(shares)
+
+    filename = downloads / "Sweet Escape.mp3"
+    filename.write_bytes(b"x" * 50)
+    shares.addToShared(str(filename))
+
+    assert search(shares, 'escape') == ['Downloaded\\Sweet Escape.mp3']
+    assert b"Sweet Escape" in transfers["sharedfilesstreams"]['Downloaded']
+    assert not shares.addFileToShares("", str(filename))
+
+
+def test_search_request(shares):
+    rescan(shares)
+
+    shares.np.transfers = Mock()
+    shares.np.transfers.getUploadQueueSizes.return_value = (0, 0)
+    shares.np.transfers.allowNewUploads.return_value = 1
+    shares.np.speed = 100
+
+    shares.processSearchRequest("hollaback girl -flac", "user", 1)
+
+    message = shares.np.ProcessRequestToPeer.call_args[0][1]
+    message.parseNetworkMessage(message.makeNetworkMessage())
+
+    assert [entry[1] for entry in message.list] == ['Music\\Gwen Stefani\\01 - Hollaback Girl.mp3']
+
+
+def test_folder_contents_request(shares):
+    rescan(shares)
+
+    conn = Mock()
+    shares.np.peerconns = [Mock(conn=conn, username="user")]
+    shares.FolderContentsRequest(Mock(conn=Mock(conn=conn), dir='Music\\Gwen Stefani\\'))
+
+    message = shares.queue.get_nowait()
+    message.parseNetworkMessage(message.makeNetworkMessage())
+
+    assert sorted(f[1] for f in message.list['Music\\Gwen Stefani\\']['Music\\Gwen Stefani\\']) == [
+        '01 - Hollaback Girl.mp3', 'cover.jpg'
+    ]
+
+
+def test_file_is_shared(shares, music):
+    rescan(shares)
+
+    transfers = Mock(eventprocessor=shares.np)
+    filename = str(music / "Gwen Stefani" / "cover.jpg")
+
+    assert Transfers.fileIsShared(transfers, "user", 'Music\\Gwen Stefani\\cover.jpg', filename)
+    assert not Transfers.fileIsShared(transfers, "user", 'Music\\Gwen Stefani\\missing.jpg', filename)
+    assert not Transfers.fileIsShared(transfers, "user", 'Music\\Auto\\track.mp3.part', str(music / "Auto" / "track.mp3.part"))
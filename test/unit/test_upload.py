@@ -0,0 +1,94 @@
+# COPYRIGHT (C) 2020 Nicotine+ Team
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import socket
+
+from unittest.mock import Mock, MagicMock
+
+import pytest
+
+from pynicotine.slskmessages import UploadFile
+from pynicotine.slskproto import PeerConnection
+from pynicotine.slskproto import SlskProtoThread
+
+DATA = os.urandom(300000)
+
+
+@pytest.fixture
+def upload(tmp_path):
+    config = MagicMock()
+    config.sections = {'server': {'portrange': (1, 2)}, 'transfers': {'downloadlimit': 10}}
+
+    proto = SlskProtoThread(
+        ui_callback=Mock(), queue=Mock(), bindip='',
+        port=None, config=config, eventprocessor=Mock()
+    )
+
+    filename = tmp_path / "upload.bin"
+    filename.write_bytes(DATA)
+    sock, peer = socket.socketpair()
+    peer.settimeout(1)
+
+    conn = PeerConnection(conn=sock, addr=('127.0.0.1', 2234))
+    conn.fileupl = UploadFile(sock, file=open(str(filename), 'rb'), size=len(DATA), offset=1000)
+
+    yield proto, conn, peer
+
+    proto.abort()
+    conn.fileupl.file.close()
+    sock.close()
+    peer.close()
+
+
+def transfer(proto, conn, peer):
+    """ Write the upload, and read it on the other end of the socket until it's complete """
+
+    data = bytearray()
+
+    while conn.fileupl.offset + conn.fileupl.sentbytes < len(DATA) or conn.obuf:
+        proto.writeData(None, {conn.conn: conn}, conn.conn)
+
+        while len(data) < conn.fileupl.sentbytes:
+            data.extend(peer.recv(65536))
+
+    return data
+
+
+@pytest.mark.skipif(not hasattr(os, "sendfile"), reason="os.sendfile is not available")
+def test_sendfile(upload):
+    proto, conn, peer = upload
+
+    proto._ulimits[conn.conn] = 5000
+    proto.writeData(None, {conn.conn: conn}, conn.conn)
+
+    assert conn.fileupl.sentbytes == 5000
+
+    proto._ulimits = {}
+    data = transfer(proto, conn, peer)
+
+    assert conn.sendfile
+    assert data == DATA[1000:]
+
+
+def test_buffered_fallback(upload):
+    proto, conn, peer = upload
+    conn.sendfile = False
+    conn.fileupl.file.seek(1000)
+
+    assert transfer(proto, conn, peer) == DATA[1000:]